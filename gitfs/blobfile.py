@@ -0,0 +1,174 @@
+import errno
+import os
+
+from gitfs import commands
+
+class BlobFile(object):
+    """
+    Read-only, seekable file object streaming a blob.
+
+    Data is read from the object store one chunk at a time, so memory
+    use does not depend on the size of the blob. Seeking forward
+    skips data; seeking backward past the current chunk starts
+    reading the blob again from the beginning.
+
+    If the contents are already at hand, pass them as C{data} and
+    the object store is never touched.
+    """
+
+    chunk_size = 65536
+
+    def __init__(self, repo, object, size, backend=None, data=None):
+        self.repo = repo
+        self.object = object
+        self.size = size
+        self.backend = backend
+        self.name = object
+        self.mode = 'rb'
+        self.closed = False
+        self._stream = None
+        # blob offset of the next byte the stream will return
+        self._stream_pos = 0
+        # the most recently read chunk, and its offset in the blob
+        self._buf = ''
+        self._buf_start = 0
+        self._pos = 0
+        if data is not None:
+            assert len(data) == size
+            self._buf = data
+
+    def __repr__(self):
+        return '%s(repo=%r, object=%r)' % (
+            self.__class__.__name__,
+            self.repo,
+            self.object,
+            )
+
+    def _check_open(self):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+
+    def _close_stream(self):
+        if self._stream is not None:
+            stream = self._stream
+            self._stream = None
+            stream.close()
+
+    def _load(self, offset):
+        """
+        Make the buffer hold the chunk containing C{offset}.
+        """
+        if (self._stream is None
+            or offset < self._stream_pos):
+            self._close_stream()
+            self._stream = commands.cat_file_stream(
+                repo=self.repo,
+                object=self.object,
+                backend=self.backend,
+                )
+            self._stream_pos = 0
+        while True:
+            data = self._stream.read(self.chunk_size)
+            if not data:
+                raise RuntimeError('git cat-file exited early')
+            start = self._stream_pos
+            self._stream_pos += len(data)
+            if self._stream_pos > offset:
+                self._buf = data
+                self._buf_start = start
+                break
+        if self._stream_pos >= self.size:
+            self._close_stream()
+
+    def _chunk(self):
+        """
+        Make sure the buffer holds the current position.
+
+        Returns the index of the current position in the buffer, or
+        C{None} at end of file.
+        """
+        if self._pos >= self.size:
+            return None
+        if not (self._buf_start
+                <= self._pos
+                < self._buf_start + len(self._buf)):
+            self._load(self._pos)
+        return self._pos - self._buf_start
+
+    def read(self, size=-1):
+        self._check_open()
+        if size is None or size < 0:
+            size = self.size
+        pieces = []
+        while size > 0:
+            i = self._chunk()
+            if i is None:
+                break
+            data = self._buf[i:i+size]
+            pieces.append(data)
+            self._pos += len(data)
+            size -= len(data)
+        return ''.join(pieces)
+
+    def readline(self, size=-1):
+        self._check_open()
+        if size is None or size < 0:
+            size = self.size
+        pieces = []
+        while size > 0:
+            i = self._chunk()
+            if i is None:
+                break
+            end = self._buf.find('\n', i, i+size)
+            if end >= 0:
+                end += 1
+            else:
+                end = i + size
+            data = self._buf[i:end]
+            pieces.append(data)
+            self._pos += len(data)
+            size -= len(data)
+            if data.endswith('\n'):
+                break
+        return ''.join(pieces)
+
+    def readlines(self):
+        return list(self)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def seek(self, offset, whence=0):
+        self._check_open()
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.size
+        if offset < 0:
+            raise IOError(
+                errno.EINVAL,
+                os.strerror(errno.EINVAL),
+                )
+        self._pos = offset
+
+    def tell(self):
+        self._check_open()
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._buf = ''
+            self._close_stream()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
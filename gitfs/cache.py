@@ -0,0 +1,224 @@
+"""
+Process-wide cache of git objects.
+
+Objects are immutable and named by their sha, so a cached object is
+valid forever, for any repository, and can be shared between
+snapshots and filesystems freely.
+"""
+
+from __future__ import with_statement
+
+import threading
+from collections import OrderedDict
+
+from gitfs import commands
+from gitfs import entries
+from gitfs import objects
+
+_TREE_MODE = 040000
+
+# rough per-entry cost of a parsed tree, on top of the raw data,
+# once its names are indexed
+_TREE_ENTRY_OVERHEAD = 100
+# rough cost of a cached size or sha
+_SCALAR_OVERHEAD = 50
+
+class ObjectCache(object):
+    """
+    LRU cache of parsed trees, blob contents and object sizes.
+
+    Holds at most C{max_bytes} worth of objects (approximately),
+    evicting the least recently used ones first. Blobs larger than
+    C{max_object_size} are never cached. C{used} is the approximate
+    number of bytes held, and C{hits} and C{misses} count lookups.
+    """
+
+    def __init__(self, max_bytes=None, max_object_size=None):
+        if max_bytes is None:
+            max_bytes = 64*1024*1024
+        self.max_bytes = max_bytes
+        if max_object_size is None:
+            max_object_size = 1024*1024
+        self.max_object_size = max_object_size
+        self._lock = threading.Lock()
+        self.clear()
+
+    def __repr__(self):
+        return '%s(max_bytes=%r, max_object_size=%r)' % (
+            self.__class__.__name__,
+            self.max_bytes,
+            self.max_object_size,
+            )
+
+    def clear(self):
+        with self._lock:
+            # (kind, sha) -> (cost, value)
+            self._items = OrderedDict()
+            self.used = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                count=len(self._items),
+                used=self.used,
+                )
+
+    def _get(self, key):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return None
+            # move to the most recently used end
+            self._items[key] = item
+            self.hits += 1
+            return item[1]
+
+    def _put(self, key, value, cost):
+        if cost > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.used -= old[0]
+            self._items[key] = (cost, value)
+            self.used += cost
+            while self.used > self.max_bytes:
+                (_, (old_cost, _)) = self._items.popitem(last=False)
+                self.used -= old_cost
+
+    def tree(self, repo, sha):
+        """
+        Return the entries of a tree, in tree order, as an
+        C{entries.Listing} of C{TreeRecord}s with the names as
+        paths.
+
+        The listing is shared; don't change it.
+        """
+        key = ('tree', sha)
+        listing = self._get(key)
+        if listing is None:
+            data = commands.cat_file(
+                repo=repo,
+                object=sha,
+                type_='tree',
+                )
+            listing = entries.Listing()
+            for (mode, name, binsha) in objects.parse_tree(
+                data,
+                binary=True,
+                ):
+                listing.add(int(mode, 8), binsha, name)
+            self._put(
+                key,
+                listing,
+                len(data) + _TREE_ENTRY_OVERHEAD*len(listing),
+                )
+        return listing
+
+    def blob(self, repo, sha):
+        """
+        Return the contents of a blob.
+        """
+        key = ('blob', sha)
+        data = self._get(key)
+        if data is None:
+            data = commands.cat_file(
+                repo=repo,
+                object=sha,
+                type_='blob',
+                )
+            if len(data) <= self.max_object_size:
+                self._put(key, data, len(data))
+            self._put(('size', sha), len(data), _SCALAR_OVERHEAD)
+        return data
+
+    def size(self, repo, sha):
+        """
+        Return the size of an object.
+        """
+        key = ('size', sha)
+        size = self._get(key)
+        if size is None:
+            size = commands.get_object_size(
+                repo=repo,
+                object=sha,
+                )
+            self._put(key, size, _SCALAR_OVERHEAD)
+        return size
+
+    def sizes(self, repo, shas):
+        """
+        Return C{{sha: size}} for many objects, asking git about all
+        the uncached ones at once. Missing objects are left out.
+        """
+        sizes = {}
+        unknown = []
+        for sha in shas:
+            size = self._get(('size', sha))
+            if size is None:
+                unknown.append(sha)
+            else:
+                sizes[sha] = size
+        for answer in commands.batch_check(repo=repo, objects=unknown):
+            if answer['type'] == 'missing':
+                continue
+            sizes[answer['object']] = answer['size']
+            self._put(
+                ('size', answer['object']),
+                answer['size'],
+                _SCALAR_OVERHEAD,
+                )
+        return sizes
+
+    def lookup(self, repo, tree, path):
+        """
+        Return C{(mode, sha)} for C{path} in C{tree}, or C{None}.
+
+        Resolves one path segment at a time through the parsed trees,
+        so once a tree is cached every question about its children is
+        answered in memory. The root directory is C{''}.
+        """
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        found = (_TREE_MODE, tree)
+        if not path:
+            return found
+        for name in path.split('/'):
+            if found[0] != _TREE_MODE:
+                return None
+            record = self.tree(repo=repo, sha=found[1]).get(name)
+            if record is None:
+                return None
+            found = (record.mode, record.object)
+        return found
+
+    def root(self, repo, rev):
+        """
+        Return the sha of the tree of C{rev}, or C{None} if there's no
+        such revision.
+
+        Only full shas are remembered; refs can move.
+        """
+        key = ('root', rev)
+        if objects.is_sha(rev):
+            tree = self._get(key)
+            if tree is not None:
+                return tree
+        try:
+            info = commands.get_object_info(
+                repo=repo,
+                object='%s^{tree}' % rev,
+                )
+        except RuntimeError:
+            return None
+        tree = info['object']
+        if objects.is_sha(rev):
+            self._put(key, tree, _SCALAR_OVERHEAD)
+        return tree
+
+object_cache = ObjectCache()
@@ -1,10 +1,39 @@
+from __future__ import with_statement
+
+import Queue
+import atexit
 import errno
+import hashlib
 import os
 import shutil
 import subprocess
+import sys
+import threading
+import time
 
 from cStringIO import StringIO
 
+from gitfs import objects
+from gitfs.entries import (
+    TreeRecord,
+    IndexRecord,
+    )
+
+# Object backend used by cat_file, get_object_size and ls_tree when
+# the caller does not ask for one: 'git' runs git, 'python' reads the
+# object store in-process and only falls back to git for things it
+# does not understand.
+default_backend = os.environ.get('GITFS_BACKEND', 'git')
+
+def _get_database(repo, backend):
+    if backend is None:
+        backend = default_backend
+    if backend == 'git':
+        return None
+    if backend != 'python':
+        raise RuntimeError('unknown object backend: %r' % backend)
+    return objects.get_database(repo)
+
 def init_bare(repo):
     returncode = subprocess.call(
         args=[
@@ -173,7 +202,19 @@ def ls_tree(
     treeish=None,
     children=None,
     recursive=None,
+    backend=None,
+    trees=None,
+    records=None,
     ):
+    """
+    List tree entries like C{git ls-tree}.
+
+    With C{recursive}, subtrees are descended into; with C{trees}
+    as well, the entries of the subtrees themselves are listed too,
+    each just before its contents.
+
+    Yields dicts, or compact C{TreeRecord}s if C{records} is true.
+    """
     if path is None:
         path = ''
     if treeish is None:
@@ -182,8 +223,75 @@ def ls_tree(
         children = False
     if recursive is None:
         recursive = False
+    if trees is None:
+        trees = False
+    if records is None:
+        records = False
     assert not path.startswith('/')
     assert not path.endswith('/')
+    listing = None
+    db = _get_database(repo=repo, backend=backend)
+    if db is not None:
+        tree = db.resolve('%s^{tree}' % treeish)
+        if tree is not None:
+            listing = db.ls_tree(
+                tree=tree,
+                path=path,
+                children=children,
+                recursive=recursive,
+                trees=trees,
+                )
+    if listing is None:
+        listing = _ls_tree_process(
+            repo=repo,
+            path=path,
+            treeish=treeish,
+            children=children,
+            recursive=recursive,
+            trees=trees,
+            )
+    if records:
+        return (
+            TreeRecord.from_hex(mode, object, filename)
+            for (mode, type_, object, filename) in listing
+            )
+    return (
+        dict(mode=mode, type=type_, object=object, path=filename)
+        for (mode, type_, object, filename) in listing
+        )
+
+def _read_records(f, command):
+    """
+    Parse the C{-z} output of C{git ls-tree} or C{git ls-files}.
+
+    Each NUL-terminated record is yielded as a tuple of the
+    space-separated fields before the tab, followed by the path.
+    The data is scanned by offset, one chunk at a time, so only the
+    fields themselves and the unfinished record at the end of each
+    chunk get copied.
+    """
+    data = ''
+    while True:
+        new = f.read(65536)
+        if not new:
+            break
+        data += new
+        start = 0
+        while True:
+            end = data.find('\0', start)
+            if end < 0:
+                break
+            tab = data.find('\t', start, end)
+            fields = data[start:tab].split(' ')
+            fields.append(data[tab+1:end])
+            yield tuple(fields)
+            start = end + 1
+        data = data[start:]
+    if data:
+        raise RuntimeError(
+            'git %s output did not end in NUL' % command)
+
+def _ls_tree_process(repo, path, treeish, children, recursive, trees):
     if children:
         if path:
             path = path+'/'
@@ -196,45 +304,25 @@ def ls_tree(
         ]
     if recursive:
         args.append('-r')
-    args.extend([
-        treeish,
-        '--',
-        path,
-        ])
+        if trees:
+            args.append('-t')
+    args.append(treeish)
+    if path:
+        # newer gits refuse an empty pathspec; no pathspec means
+        # the whole tree anyway
+        args.extend(['--', path])
     process = subprocess.Popen(
         args=args,
         close_fds=True,
         stdout=subprocess.PIPE,
         )
-    buf = ''
-    while True:
-        new = process.stdout.read(8192)
-        buf += new
-        while True:
-            try:
-                (entry, buf) = buf.split('\0', 1)
-            except ValueError:
-                break
-            meta, filename = entry.split('\t', 1)
-            mode, type_, object = meta.split(' ', 2)
-            yield dict(
-                mode=mode,
-                type=type_,
-                object=object,
-                path=filename,
-                )
-        if not new:
-            break
-    if buf:
-        raise RuntimeError(
-            'git ls-tree output did not end in NUL')
+    for record in _read_records(process.stdout, 'ls-tree'):
+        yield record
     returncode = process.wait()
     if returncode != 0:
         raise RuntimeError('git ls-tree failed')
 
-def cat_file(repo, object, type_=None):
-    if type_ is None:
-        type_ = 'blob'
+def _cat_file_process(repo, object, type_):
     process = subprocess.Popen(
         args=[
             'git',
@@ -253,53 +341,106 @@ def cat_file(repo, object, type_=None):
         raise RuntimeError('git cat-file failed')
     return data
 
-def batch_cat_file(repo):
+def cat_file(repo, object, type_=None, backend=None):
+    if type_ is None:
+        type_ = 'blob'
+    db = _get_database(repo=repo, backend=backend)
+    if db is not None:
+        sha = db.resolve(object)
+        if sha is not None:
+            found = db.read(sha)
+            if found is not None and found[0] == type_:
+                return found[1]
+    if '\n' in object:
+        # can't be expressed in the line-based batch protocol
+        return _cat_file_process(repo=repo, object=object, type_=type_)
+    answer = cat_file_pool.request(repo=repo, object=object)
+    if answer['type'] == 'missing':
+        raise RuntimeError('git cat-file failed')
+    if answer['type'] != type_:
+        # git cat-file <type> peels tags and commits as needed; let
+        # git do that for us in the rare case someone relies on it
+        return _cat_file_process(repo=repo, object=object, type_=type_)
+    return answer['contents'].getvalue()
+
+def _parse_batch_response(response):
+    if response.endswith(' missing'):
+        # the name may contain spaces, so don't split it
+        return dict(
+            object=response[:-len(' missing')],
+            type='missing',
+            )
+    got_object, rest = response.split(' ', 1)
+    type_, size = rest.split(' ', 1)
+    return dict(
+        object=got_object,
+        type=type_,
+        size=int(size),
+        )
+
+def batch_cat_file(repo, check=None):
+    """
+    Start a C{git cat-file --batch} process.
+
+    Returns a generator; C{send} it object names and it answers with
+    dicts describing the objects. If C{check} is true, run
+    C{--batch-check} instead and leave out the contents.
+
+    A list of names gets a list of answers, with all the names
+    written before any answer is read. Keep such lists short enough
+    for the names to fit in a pipe buffer, or the writes may block
+    for good.
+    """
+    if check is None:
+        check = False
     def do_batch_cat_file(repo):
+        if check:
+            mode = '--batch-check'
+        else:
+            mode = '--batch'
         process = subprocess.Popen(
             args=[
                 'git',
                 '--git-dir=%s' % repo,
                 'cat-file',
-                '--batch',
+                mode,
                 ],
             close_fds=True,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             )
+        def read_answer():
+            response = process.stdout.readline()
+            if (not response
+                or response[-1] != '\n'):
+                # eof with possible partial line
+                # TODO get exit status & process
+                raise RuntimeError('git cat-file exited early')
+            answer = _parse_batch_response(response[:-1])
+            if not check and answer['type'] != 'missing':
+                size = answer['size']
+                data = process.stdout.read(size)
+                if len(data) != size:
+                    raise RuntimeError('git cat-file exited early')
+                lf = process.stdout.read(1)
+                if lf != '\n':
+                    raise RuntimeError('git cat-file missing newline')
+                answer['contents'] = StringIO(data)
+            return answer
         answer = None
         try:
             while True:
                 want_object = (yield answer)
-                process.stdin.write('%s\n' % want_object)
-                process.stdin.flush()
-                response = process.stdout.readline()
-                if (not response
-                    or response[-1] != '\n'):
-                    # eof with possible partial line
-                    # TODO get exit status & process
-                    raise RuntimeError('git cat-file exited early')
-                response = response[:-1]
-                got_object, rest = response.split(' ', 1)
-                if rest == 'missing':
-                    answer = dict(
-                        object=got_object,
-                        type=rest,
-                        )
+                if isinstance(want_object, list):
+                    # ask for all of them before reading any answers
+                    process.stdin.write(
+                        ''.join('%s\n' % name for name in want_object))
+                    process.stdin.flush()
+                    answer = [read_answer() for name in want_object]
                 else:
-                    type_, size = rest.split(' ', 1)
-                    size = int(size)
-                    data = process.stdout.read(size)
-                    if len(data) != size:
-                        raise RuntimeError('git cat-file exited early')
-                    lf = process.stdout.read(1)
-                    if lf != '\n':
-                        raise RuntimeError('git cat-file missing newline')
-                    answer = dict(
-                        object=got_object,
-                        type=type_,
-                        size=size,
-                        contents=StringIO(data),
-                        )
+                    process.stdin.write('%s\n' % want_object)
+                    process.stdin.flush()
+                    answer = read_answer()
         except GeneratorExit:
             process.stdin.close()
             data = process.stdout.read()
@@ -308,44 +449,500 @@ def batch_cat_file(repo):
             returncode = process.wait()
             if returncode != 0:
                 raise RuntimeError('git cat-file failed')
+        except:
+            # the protocol is out of sync or the process is gone;
+            # make sure it goes away and doesn't linger as a zombie
+            try:
+                process.stdin.close()
+            except IOError:
+                pass
+            process.stdout.close()
+            process.wait()
+            raise
     g = do_batch_cat_file(repo)
     g.next()
     return g
 
-def get_object_size(repo, object):
+class BatchCatFilePool(object):
+    """
+    Pool of long-lived C{git cat-file --batch} processes.
+
+    Processes are keyed by repository, so a read costs one pipe round
+    trip instead of a fork and exec. At most C{max_processes} idle
+    processes are kept around, least recently used ones are closed
+    first, and processes idle for longer than C{idle_timeout} seconds
+    are closed the next time the pool is used. A process that has
+    died is replaced transparently.
+
+    Each process is only ever used by one caller at a time; concurrent
+    callers get processes of their own.
+    """
+
+    def __init__(self, max_processes=None, idle_timeout=None):
+        if max_processes is None:
+            max_processes = 8
+        if idle_timeout is None:
+            idle_timeout = 60
+        self.max_processes = max_processes
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # (last_used, repo, check, generator), oldest first
+        self._idle = []
+        self._pid = os.getpid()
+
+    def _close(self, g):
+        try:
+            g.close()
+        except (RuntimeError, IOError, OSError):
+            # it's going away anyway
+            pass
+
+    def _checkout(self, repo, check):
+        now = time.time()
+        expired = []
+        found = None
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked; the pipes belong to our parent, just forget
+                # about them
+                self._reset()
+            keep = []
+            for item in self._idle:
+                (last_used, item_repo, item_check, g) = item
+                if now - last_used > self.idle_timeout:
+                    expired.append(g)
+                else:
+                    keep.append(item)
+            self._idle = keep
+            for i in xrange(len(self._idle)-1, -1, -1):
+                (last_used, item_repo, item_check, g) = self._idle[i]
+                if item_repo == repo and item_check == check:
+                    found = g
+                    del self._idle[i]
+                    break
+        for g in expired:
+            self._close(g)
+        return found
+
+    def _checkin(self, repo, check, g):
+        evicted = []
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            self._idle.append((time.time(), repo, check, g))
+            while len(self._idle) > self.max_processes:
+                evicted.append(self._idle.pop(0)[3])
+        for g in evicted:
+            self._close(g)
+
+    def request(self, repo, object, check=None):
+        """
+        Look up one object, or a list of them, like
+        C{batch_cat_file(repo).send(object)}.
+        """
+        if check is None:
+            check = False
+        g = self._checkout(repo, check)
+        if g is not None:
+            try:
+                answer = g.send(object)
+            except (RuntimeError, IOError, OSError, StopIteration):
+                # the pooled process died while idle; start a fresh
+                # one below
+                self._close(g)
+            else:
+                self._checkin(repo, check, g)
+                return answer
+        g = batch_cat_file(repo=repo, check=check)
+        try:
+            answer = g.send(object)
+        except:
+            self._close(g)
+            raise
+        self._checkin(repo, check, g)
+        return answer
+
+    def close(self):
+        """
+        Close all idle processes.
+        """
+        with self._lock:
+            idle = self._idle
+            forked = self._pid != os.getpid()
+            self._reset()
+        if forked:
+            return
+        for (last_used, repo, check, g) in idle:
+            self._close(g)
+
+cat_file_pool = BatchCatFilePool()
+atexit.register(cat_file_pool.close)
+
+class _BatchContents(object):
+    """
+    Contents of one object in the middle of C{git cat-file --batch}
+    output; readable only until the next object is asked for.
+    """
+
+    def __init__(self, f, size):
+        self._f = f
+        self.remaining = size
+        self.closed = False
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self._f.read(size)
+        if len(data) != size:
+            raise RuntimeError('git cat-file exited early')
+        self.remaining -= size
+        return data
+
+    def close(self):
+        # skip whatever wasn't read, to get to the next object
+        while self.remaining and not self.closed:
+            self.read(65536)
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
+
+_DONE = object()
+
+def cat_file_many(repo, requests, check=None):
+    """
+    Look up many objects with one C{git cat-file --batch} process.
+
+    C{requests} is an iterable of C{(key, object name)}; yields
+    C{(key, answer)} in the same order, with answers as from
+    C{batch_cat_file}, except that C{contents} can only be read
+    until the next answer is asked for.
+
+    Names are written to git from a separate thread, as fast as git
+    takes them, so reading never waits for a round trip.
+    """
+    if check is None:
+        check = False
+    if check:
+        mode = '--batch-check'
+    else:
+        mode = '--batch'
     process = subprocess.Popen(
         args=[
             'git',
             '--git-dir=%s' % repo,
             'cat-file',
-            '-s',
-            object,
+            mode,
             ],
         close_fds=True,
+        stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         )
-    data = process.stdout.read()
-    returncode = process.wait()
-    if returncode != 0:
+    # (key, name, whether it was sent) for each request, in order
+    pending = Queue.Queue()
+    failure = []
+
+    def feed():
+        try:
+            try:
+                for (key, name) in requests:
+                    if '\n' in name:
+                        # can't be asked for, can't be an object name
+                        # either
+                        pending.put((key, name, False))
+                        continue
+                    pending.put((key, name, True))
+                    process.stdin.write(name + '\n')
+                    process.stdin.flush()
+            finally:
+                process.stdin.close()
+        except IOError:
+            # git went away; the reader will notice
+            pass
+        except:
+            failure.append(sys.exc_info())
+        finally:
+            pending.put(_DONE)
+
+    feeder = threading.Thread(target=feed)
+    feeder.setDaemon(True)
+    feeder.start()
+    try:
+        while True:
+            item = pending.get()
+            if item is _DONE:
+                break
+            (key, name, sent) = item
+            if not sent:
+                yield (key, dict(object=name, type='missing'))
+                continue
+            response = process.stdout.readline()
+            if (not response
+                or response[-1] != '\n'):
+                raise RuntimeError('git cat-file exited early')
+            answer = _parse_batch_response(response[:-1])
+            if check or answer['type'] == 'missing':
+                yield (key, answer)
+                continue
+            contents = answer['contents'] = _BatchContents(
+                process.stdout,
+                answer['size'],
+                )
+            yield (key, answer)
+            contents.close()
+            lf = process.stdout.read(1)
+            if lf != '\n':
+                raise RuntimeError('git cat-file missing newline')
+        if failure:
+            (type_, value, traceback) = failure[0]
+            raise type_, value, traceback
+        data = process.stdout.read()
+        if data:
+            raise RuntimeError('git cat-file gave weird trailer data')
+        returncode = process.wait()
+        if returncode != 0:
+            raise RuntimeError('git cat-file failed')
+    finally:
+        if process.returncode is None:
+            # stopped early or out of sync; make it go away, which
+            # also unblocks the feeder
+            try:
+                process.kill()
+            except OSError:
+                pass
+            process.stdout.close()
+            process.wait()
+        feeder.join()
+
+def _get_object_info_process(repo, object):
+    # the batch protocol can't carry newlines, so look up the sha
+    # first
+    try:
+        sha = rev_parse(repo=repo, rev=object)
+    except RuntimeError:
         raise RuntimeError('git cat-file failed')
-    data = int(data)
-    return data
+    if sha is None:
+        raise RuntimeError('git cat-file failed')
+    return get_object_info(repo=repo, object=sha, backend='git')
+
+def get_object_info(repo, object, backend=None):
+    """
+    Look up the sha, type and size of an object.
+
+    Returns a dict with keys C{object}, C{type} and C{size}.
+    """
+    db = _get_database(repo=repo, backend=backend)
+    if db is not None:
+        sha = db.resolve(object)
+        if sha is not None:
+            found = db.info(sha)
+            if found is not None:
+                type_, size = found
+                return dict(
+                    object=sha,
+                    type=type_,
+                    size=size,
+                    )
+    if '\n' in object:
+        return _get_object_info_process(repo=repo, object=object)
+    answer = cat_file_pool.request(repo=repo, object=object, check=True)
+    if answer['type'] == 'missing':
+        raise RuntimeError('git cat-file failed')
+    return answer
+
+# most bytes of names, and of answers, in one pipelined batch_check
+# request; well below a pipe buffer, so git never blocks writing
+# answers while we are still writing names
+_BATCH_CHECK_BYTES = 16*1024
+# longest answer for an object that exists: sha, type and size
+_BATCH_CHECK_ANSWER = 70
+
+def batch_check(repo, objects, backend=None):
+    """
+    Look up the sha, type and size of many objects at once.
+
+    Returns a list with a dict for each of C{objects}, like those
+    from C{get_object_info}, except that missing objects get C{type}
+    C{'missing'} and no C{size}. Objects the in-process backend
+    doesn't find are asked from a pooled C{git cat-file
+    --batch-check} in batches of a few kilobytes, one round trip
+    each.
+    """
+    objects = list(objects)
+    answers = [None] * len(objects)
+    db = _get_database(repo=repo, backend=backend)
+    if db is not None:
+        for i, object in enumerate(objects):
+            sha = db.resolve(object)
+            if sha is not None:
+                found = db.info(sha)
+                if found is not None:
+                    (type_, size) = found
+                    answers[i] = dict(
+                        object=sha,
+                        type=type_,
+                        size=size,
+                        )
+    ask = []
+    for i, object in enumerate(objects):
+        if answers[i] is not None:
+            continue
+        if '\n' in object:
+            # can't be asked for, can't be an object name either
+            answers[i] = dict(object=object, type='missing')
+            continue
+        ask.append(i)
+    def request(batch):
+        got = cat_file_pool.request(
+            repo=repo,
+            object=[objects[i] for i in batch],
+            check=True,
+            )
+        for (i, answer) in zip(batch, got):
+            answers[i] = answer
+    batch = []
+    sent = 0
+    answered = 0
+    for i in ask:
+        name = objects[i]
+        size = len(name) + 1
+        # names that aren't found are echoed back
+        answer = max(_BATCH_CHECK_ANSWER, len(name) + len(' ambiguous\n'))
+        if (batch
+            and (sent + size > _BATCH_CHECK_BYTES
+                 or answered + answer > _BATCH_CHECK_BYTES)):
+            request(batch)
+            batch = []
+            sent = 0
+            answered = 0
+        batch.append(i)
+        sent += size
+        answered += answer
+    if batch:
+        request(batch)
+    return answers
+
+def get_object_size(repo, object, backend=None):
+    info = get_object_info(repo=repo, object=object, backend=backend)
+    return info['size']
+
+class _ProcessOutput(object):
+    """
+    Readable stream of the output of a git process.
+    """
+
+    def __init__(self, process, error):
+        self.process = process
+        self.error = error
+        self.eof = False
+
+    def read(self, size=-1):
+        data = self.process.stdout.read(size)
+        if size < 0 or not data:
+            self.eof = True
+            self.close()
+        return data
 
-def write_object(repo, content):
-    # TODO don't require content to be in RAM
+    def close(self):
+        if self.process is None:
+            return
+        process = self.process
+        self.process = None
+        process.stdout.close()
+        returncode = process.wait()
+        if (self.eof
+            and returncode != 0):
+            # if we stopped reading early, git was most likely
+            # killed by SIGPIPE; that's no error
+            raise RuntimeError(self.error)
+
+def cat_file_stream(repo, object, type_=None, backend=None):
+    """
+    Open the contents of an object for streaming.
+
+    Returns a file-like object supporting C{read} and C{close}. As
+    the contents are not read in advance, errors are reported at
+    end of file instead of here.
+    """
+    if type_ is None:
+        type_ = 'blob'
+    db = _get_database(repo=repo, backend=backend)
+    if db is not None:
+        sha = db.resolve(object)
+        if sha is not None:
+            found = db.stream(sha)
+            if found is not None and found[0] == type_:
+                return found[2]
+            if found is not None:
+                found[2].close()
     process = subprocess.Popen(
         args=[
             'git',
             '--git-dir=%s' % repo,
-            'hash-object',
-            '-w',
-            '--stdin',
+            'cat-file',
+            type_,
+            object,
             ],
         close_fds=True,
+        stdout=subprocess.PIPE,
+        )
+    return _ProcessOutput(process=process, error='git cat-file failed')
+
+def write_object(repo, content=None, path=None, type_=None, backend=None):
+    """
+    Store an object, by default a blob, in the repository and return
+    its sha.
+
+    The data comes from one of C{content}, either a string or a
+    file-like object that is copied in fixed-size chunks, or
+    C{path}, a file git reads directly.
+
+    With the in-process backend, strings and files are written as
+    loose objects without running git.
+    """
+    if (content is None) == (path is None):
+        raise TypeError('write_object needs exactly one of content, path')
+    if type_ is None:
+        type_ = 'blob'
+    db = _get_database(repo=repo, backend=backend)
+    if (db is not None
+        and (path is not None or isinstance(content, str))):
+        return db.write(type_=type_, content=content, path=path)
+    args = [
+        'git',
+        '--git-dir=%s' % repo,
+        'hash-object',
+        '-w',
+        '--no-filters',
+        '-t',
+        type_,
+        ]
+    if path is not None:
+        args.extend([
+                '--',
+                path,
+                ])
+    else:
+        args.append('--stdin')
+    process = subprocess.Popen(
+        args=args,
+        close_fds=True,
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         )
-    process.stdin.write(content)
+    if content is not None:
+        if isinstance(content, basestring):
+            process.stdin.write(content)
+        else:
+            shutil.copyfileobj(content, process.stdin, 65536)
     process.stdin.close()
     sha = process.stdout.read().rstrip('\n')
     returncode = process.wait()
@@ -355,6 +952,80 @@ def write_object(repo, content):
         raise RuntimeError('git hash-object did not return a hash')
     return sha
 
+# how much content write_blobs holds on to while checking which blobs
+# already exist
+_WRITE_BLOBS_BATCH_BYTES = 8*1024*1024
+_WRITE_BLOBS_BATCH_SIZE = 500
+
+def write_blobs(repo, contents):
+    """
+    Store many blobs with one C{git fast-import} process.
+
+    C{contents} is an iterable of strings. Returns the shas of the
+    blobs, in order; they are computed here, so nothing needs to be
+    read back from git. Blobs the repository already has are found
+    with C{batch_check} and not sent to git at all.
+    """
+    process = subprocess.Popen(
+        args=[
+            'git',
+            '--git-dir=%s' % repo,
+            'fast-import',
+            '--quiet',
+            '--done',
+            ],
+        stdin=subprocess.PIPE,
+        close_fds=True,
+        )
+    shas = []
+
+    def store(batch):
+        # skip the blobs git already has
+        found = batch_check(
+            repo=repo,
+            objects=[sha for (sha, content) in batch],
+            )
+        for ((sha, content), answer) in zip(batch, found):
+            if answer['type'] != 'missing':
+                continue
+            process.stdin.write('blob\ndata %d\n' % len(content))
+            process.stdin.write(content)
+            process.stdin.write('\n')
+
+    try:
+        try:
+            batch = []
+            batch_bytes = 0
+            for content in contents:
+                header = 'blob %d\0' % len(content)
+                sha = hashlib.sha1(header)
+                sha.update(content)
+                sha = sha.hexdigest()
+                shas.append(sha)
+                batch.append((sha, content))
+                batch_bytes += len(content)
+                if (len(batch) >= _WRITE_BLOBS_BATCH_SIZE
+                    or batch_bytes >= _WRITE_BLOBS_BATCH_BYTES):
+                    store(batch)
+                    batch = []
+                    batch_bytes = 0
+            store(batch)
+            # without this, fast-import fails instead of storing a
+            # partial stream
+            process.stdin.write('done\n')
+        finally:
+            process.stdin.close()
+    except IOError:
+        # fast-import went away; its exit status says more
+        pass
+    except:
+        process.wait()
+        raise
+    returncode = process.wait()
+    if returncode != 0:
+        raise RuntimeError('git fast-import failed')
+    return shas
+
 def read_tree(repo, treeish, index):
     env = {}
     env.update(os.environ)
@@ -449,11 +1120,18 @@ def ls_files(
     index,
     path=None,
     children=None,
+    records=None,
     ):
+    """
+    List the entries of an index file, as dicts or, if C{records}
+    is true, compact C{IndexRecord}s.
+    """
     if path is None:
         path = ''
     if children is None:
         children = True
+    if records is None:
+        records = False
     assert not path.startswith('/')
     assert not path.endswith('/')
     if children:
@@ -462,43 +1140,35 @@ def ls_files(
     env = {}
     env.update(os.environ)
     env['GIT_INDEX_FILE'] = index
+    args = [
+        'git',
+        '--git-dir=%s' % repo,
+        'ls-files',
+        '--stage',
+        '--full-name',
+        '-z',
+        ]
+    if path:
+        args.extend(['--', path])
     process = subprocess.Popen(
-        args=[
-            'git',
-            '--git-dir=%s' % repo,
-            'ls-files',
-            '--stage',
-            '--full-name',
-            '-z',
-            '--',
-            path,
-            ],
+        args=args,
         close_fds=True,
         env=env,
         stdout=subprocess.PIPE,
         )
-    buf = ''
-    while True:
-        new = process.stdout.read(8192)
-        buf += new
-        while True:
-            try:
-                (entry, buf) = buf.split('\0', 1)
-            except ValueError:
-                break
-            meta, filename = entry.split('\t', 1)
-            mode, object, stage = meta.split(' ', 2)
-            assert stage == '0', 'unprepared to handle merges'
+    for (mode, object, stage, filename) in _read_records(
+        process.stdout,
+        'ls-files',
+        ):
+        assert stage == '0', 'unprepared to handle merges'
+        if records:
+            yield IndexRecord.from_hex(mode, object, filename)
+        else:
             yield dict(
                 mode=mode,
                 object=object,
                 path=filename,
                 )
-        if not new:
-            break
-    if buf:
-        raise RuntimeError(
-            'git ls-files output did not end in NUL')
     returncode = process.wait()
     if returncode != 0:
         raise RuntimeError('git ls-files failed')
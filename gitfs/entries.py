@@ -0,0 +1,182 @@
+"""
+Compact representations of tree and index entries.
+
+Shas are kept as 20 raw bytes and modes as ints; the hex shas and
+the dicts the commands have always returned are made on demand.
+"""
+
+import binascii
+from array import array
+
+_TREE_MODE = 040000
+_GITLINK_MODE = 0160000
+
+def mode_type(mode):
+    """
+    Return the type of object an entry with C{mode} (an int) names.
+    """
+    if mode == _TREE_MODE:
+        return 'tree'
+    if mode == _GITLINK_MODE:
+        return 'commit'
+    return 'blob'
+
+class IndexRecord(object):
+    """
+    An entry of C{git ls-files --stage}.
+    """
+
+    __slots__ = ['mode', 'binsha', 'path']
+
+    def __init__(self, mode, binsha, path):
+        self.mode = mode
+        self.binsha = binsha
+        self.path = path
+
+    @classmethod
+    def from_hex(cls, mode, object, path):
+        """
+        Make a record from an octal mode string and a hex sha, as git
+        prints them.
+        """
+        return cls(int(mode, 8), binascii.unhexlify(object), path)
+
+    def __repr__(self):
+        return '%s(mode=0%o, object=%r, path=%r)' % (
+            self.__class__.__name__,
+            self.mode,
+            self.object,
+            self.path,
+            )
+
+    def _key(self):
+        return (self.mode, self.binsha, self.path)
+
+    def __eq__(self, other):
+        if not isinstance(other, IndexRecord):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __ne__(self, other):
+        if not isinstance(other, IndexRecord):
+            return NotImplemented
+        return self._key() != other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    @property
+    def object(self):
+        return binascii.hexlify(self.binsha)
+
+    @property
+    def type(self):
+        return mode_type(self.mode)
+
+    def as_dict(self):
+        return dict(
+            mode='%06o' % self.mode,
+            object=self.object,
+            path=self.path,
+            )
+
+class TreeRecord(IndexRecord):
+    """
+    An entry of C{git ls-tree}.
+    """
+
+    __slots__ = []
+
+    def as_dict(self):
+        return dict(
+            mode='%06o' % self.mode,
+            type=self.type,
+            object=self.object,
+            path=self.path,
+            )
+
+class Listing(object):
+    """
+    Columnar list of records, for holding large listings.
+
+    Modes are kept in an array, shas back to back in one buffer and
+    paths in a list, which takes a fraction of the memory of a list
+    of records or dicts. Records are made when accessed.
+    """
+
+    def __init__(self, records=None, record_type=None):
+        if record_type is None:
+            record_type = TreeRecord
+        self.record_type = record_type
+        self.paths = []
+        self._modes = array('L')
+        self._shas = bytearray()
+        # path -> position, made by the first get
+        self._positions = None
+        if records is not None:
+            self.extend(records)
+
+    def __repr__(self):
+        return '<%s of %d %s>' % (
+            self.__class__.__name__,
+            len(self),
+            self.record_type.__name__,
+            )
+
+    def add(self, mode, binsha, path):
+        """
+        Append a record given as its fields, without making one.
+        """
+        self._modes.append(mode)
+        self._shas.extend(binsha)
+        if self._positions is not None:
+            self._positions[path] = len(self.paths)
+        self.paths.append(path)
+
+    def append(self, record):
+        self.add(record.mode, record.binsha, record.path)
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('listing index out of range')
+        return self.record_type(
+            self._modes[i],
+            str(self._shas[i*20:i*20+20]),
+            self.paths[i],
+            )
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def get(self, path):
+        """
+        Return the record for C{path}, or C{None}.
+
+        The first call indexes the paths.
+        """
+        positions = self._positions
+        if positions is None:
+            positions = dict(
+                (path_, i) for (i, path_) in enumerate(self.paths))
+            self._positions = positions
+        i = positions.get(path)
+        if i is None:
+            return None
+        return self[i]
+
+    def dicts(self):
+        """
+        Iterate over the records as the dicts the commands return.
+        """
+        for record in self:
+            yield record.as_dict()
@@ -0,0 +1,426 @@
+"""
+In-process reader and writer for git index files.
+
+Only the parts of the format pygitfs needs are understood: versions
+2 and 3, stage 0 entries. Extensions are dropped on write; git
+recreates what it needs.
+"""
+
+from __future__ import with_statement
+
+import binascii
+import bisect
+import errno
+import hashlib
+import os
+import struct
+
+from gitfs import entries
+
+_HEADER = struct.Struct('>4sLL')
+_ENTRY = struct.Struct('>40s20sH')
+# offset of the mode in the stat data
+_MODE = struct.Struct('>L')
+_MODE_OFFSET = 24
+
+_FLAG_ASSUME_VALID = 0x8000
+_FLAG_EXTENDED = 0x4000
+_FLAG_STAGE = 0x3000
+_FLAG_NAME_LENGTH = 0x0fff
+
+_EMPTY_STAT = '\0' * 40
+
+_TREE_MODE = 040000
+
+class IndexEntry(entries.IndexRecord):
+    """
+    An entry of the index file.
+
+    C{stat} is the packed ctime, mtime, dev, ino, mode, uid, gid and
+    size fields as found in the file; the mode stored there is
+    ignored in favour of C{mode}.
+    """
+
+    __slots__ = ['stat', 'flags', 'extended_flags']
+
+    def __init__(self, mode, binsha, path, stat, flags, extended_flags):
+        super(IndexEntry, self).__init__(mode, binsha, path)
+        self.stat = stat
+        self.flags = flags
+        self.extended_flags = extended_flags
+
+def _path(path):
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return path
+
+class Index(object):
+    """
+    Entries of a git index file, kept sorted in memory.
+
+    Alongside the entries, every directory implied by their paths is
+    tracked with the names of its immediate children, so listing a
+    directory or asking whether one exists doesn't have to look at
+    the entries below it.
+
+    Every change made since the file was loaded is also recorded in
+    C{changes}, mapping paths to C{(mode, object)}, or C{None} for
+    removed paths, so the new tree can be built from the old one
+    without looking at unchanged entries.
+
+    Changes are only written back to the file by C{write} (or
+    C{flush}, which only writes if something changed); if
+    C{autoflush} is true, C{sync} does that too, otherwise C{sync}
+    does nothing.
+
+    An entry may also stand for a whole unexpanded subtree, with the
+    tree mode and the sha of the tree; see C{expand}. git can't read
+    those from a file, so they must be expanded before writing.
+    """
+
+    def __init__(self, path, autoflush=None):
+        if autoflush is None:
+            autoflush = True
+        self.path = path
+        self.autoflush = autoflush
+        self.dirty = False
+        self.changes = {}
+        # sorted list of paths, and the entries by path
+        self._paths = []
+        self._entries = {}
+        # directory path -> {child name: number of entries below it}
+        self._dirs = {}
+        self.load()
+
+    def __repr__(self):
+        return '%s(path=%r)' % (
+            self.__class__.__name__,
+            self.path,
+            )
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __iter__(self):
+        for path in self._paths:
+            yield self._entries[path]
+
+    def load(self):
+        """
+        (Re)read the index file, discarding any unwritten changes.
+        """
+        self._paths = []
+        self._entries = {}
+        self._dirs = {}
+        self.changes = {}
+        self.dirty = False
+        try:
+            f = file(self.path, 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                # no index yet is just an empty index
+                return
+            raise
+        with f:
+            data = f.read()
+        if len(data) < _HEADER.size + 20:
+            raise RuntimeError('index file too short: %s' % self.path)
+        checksum = data[-20:]
+        if (checksum != '\0' * 20
+            and hashlib.sha1(data[:-20]).digest() != checksum):
+            raise RuntimeError('index checksum mismatch: %s' % self.path)
+        signature, version, count = _HEADER.unpack_from(data, 0)
+        if signature != 'DIRC':
+            raise RuntimeError('not an index file: %s' % self.path)
+        if version not in [2, 3]:
+            raise RuntimeError(
+                'unsupported index version %d: %s' % (version, self.path))
+        offset = _HEADER.size
+        paths = []
+        entries = {}
+        for i in xrange(count):
+            (stat, binsha, flags) = _ENTRY.unpack_from(data, offset)
+            (mode,) = _MODE.unpack_from(stat, _MODE_OFFSET)
+            start = offset
+            offset += _ENTRY.size
+            extended_flags = 0
+            if flags & _FLAG_EXTENDED:
+                (extended_flags,) = struct.unpack_from('>H', data, offset)
+                offset += 2
+            if flags & _FLAG_STAGE:
+                raise RuntimeError('unprepared to handle merges')
+            end = data.index('\0', offset)
+            path = data[offset:end]
+            # entries are padded with 1-8 NULs to a multiple of 8
+            offset = start + ((end - start + 8) & ~7)
+            paths.append(path)
+            entries[path] = IndexEntry(
+                path=path,
+                mode=mode,
+                binsha=binsha,
+                stat=stat,
+                flags=flags & _FLAG_ASSUME_VALID,
+                extended_flags=extended_flags,
+                )
+        self._paths = paths
+        self._entries = entries
+        for path in paths:
+            self._link(path, 1)
+
+    def write(self):
+        """
+        Atomically replace the index file with the current entries.
+        """
+        extended = False
+        for path in self._paths:
+            if self._entries[path].extended_flags:
+                extended = True
+                break
+        if extended:
+            version = 3
+        else:
+            version = 2
+        lock = os.path.extsep.join([self.path, 'lock'])
+        fd = os.open(lock, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0666)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                digest = hashlib.sha1()
+                def write(data):
+                    digest.update(data)
+                    f.write(data)
+                write(_HEADER.pack('DIRC', version, len(self._paths)))
+                for path in self._paths:
+                    entry = self._entries[path]
+                    flags = entry.flags | min(len(path), _FLAG_NAME_LENGTH)
+                    stat = ''.join([
+                            entry.stat[:_MODE_OFFSET],
+                            _MODE.pack(entry.mode),
+                            entry.stat[_MODE_OFFSET+_MODE.size:],
+                            ])
+                    if entry.extended_flags:
+                        flags |= _FLAG_EXTENDED
+                    pieces = [_ENTRY.pack(stat, entry.binsha, flags)]
+                    if entry.extended_flags:
+                        pieces.append(struct.pack('>H', entry.extended_flags))
+                    pieces.append(path)
+                    length = sum(len(piece) for piece in pieces)
+                    pieces.append('\0' * (8 - length % 8))
+                    write(''.join(pieces))
+                f.write(digest.digest())
+            os.rename(lock, self.path)
+        except:
+            try:
+                os.unlink(lock)
+            except OSError:
+                pass
+            raise
+        self.dirty = False
+
+    def flush(self):
+        """
+        Write the index file if there are unwritten changes.
+        """
+        if self.dirty:
+            self.write()
+
+    def sync(self):
+        """
+        Flush if C{autoflush} is on; call after each logical change.
+        """
+        if self.autoflush:
+            self.flush()
+
+    def _link(self, path, delta):
+        """
+        Adjust the entry counts of all directories leading to C{path}.
+        """
+        dirs = self._dirs
+        parent = ''
+        for name in path.split('/'):
+            children = dirs.get(parent)
+            if children is None:
+                children = dirs[parent] = {}
+            count = children.get(name, 0) + delta
+            if count:
+                children[name] = count
+            else:
+                del children[name]
+                if not children and parent:
+                    del dirs[parent]
+            if parent:
+                parent = parent + '/' + name
+            else:
+                parent = name
+
+    def get(self, path):
+        """
+        Return the entry for C{path}, or C{None}.
+        """
+        return self._entries.get(_path(path))
+
+    def children(self, path):
+        """
+        Iterate over the entries below directory C{path}, sorted.
+
+        The root directory is C{''}.
+        """
+        path = _path(path)
+        if path:
+            prefix = path + '/'
+        else:
+            prefix = ''
+        paths = self._paths
+        i = bisect.bisect_left(paths, prefix)
+        while i < len(paths) and paths[i].startswith(prefix):
+            yield self._entries[paths[i]]
+            i += 1
+
+    def isdir(self, path):
+        """
+        Is C{path} a directory, that is, are there entries below it?
+        """
+        return _path(path) in self._dirs
+
+    def listdir(self, path):
+        """
+        Return the names of the immediate children of directory
+        C{path}, in git tree order, or C{None} if it's not a
+        directory.
+        """
+        path = _path(path)
+        children = self._dirs.get(path)
+        if children is None:
+            return None
+        if path:
+            prefix = path + '/'
+        else:
+            prefix = ''
+        dirs = self._dirs
+        entries = self._entries
+        def key(name):
+            # git sorts directories as if they ended in a slash
+            if prefix + name in dirs:
+                return name + '/'
+            entry = entries.get(prefix + name)
+            if entry is not None and entry.mode == _TREE_MODE:
+                return name + '/'
+            return name
+        return sorted(children, key=key)
+
+    def set(self, path, mode, object):
+        """
+        Make C{path} an entry with the given mode (an int) and sha.
+
+        Like git, this replaces whatever is in the way: the entries
+        below C{path}, and files at the directories leading to it,
+        are removed. A path inside an unexpanded subtree entry is
+        refused; see C{expand}.
+        """
+        path = _path(path)
+        assert path
+        assert not path.startswith('/')
+        assert not path.endswith('/')
+        files = []
+        i = path.rfind('/')
+        while i > 0:
+            parent = self._entries.get(path[:i])
+            if parent is not None:
+                if parent.mode == _TREE_MODE:
+                    raise RuntimeError(
+                        'path is inside an unexpanded tree: %s' % path)
+                files.append(parent.path)
+            i = path.rfind('/', 0, i)
+        for parent in files:
+            # a file where a directory has to go
+            self.remove(parent)
+        old = self._entries.get(path)
+        if old is None:
+            bisect.insort_left(self._paths, path)
+            self._link(path, 1)
+            stat = _EMPTY_STAT
+            flags = 0
+            extended_flags = 0
+        else:
+            stat = old.stat
+            flags = old.flags
+            extended_flags = old.extended_flags
+        self._entries[path] = IndexEntry(
+            path=path,
+            mode=mode,
+            binsha=binascii.unhexlify(object),
+            stat=stat,
+            flags=flags,
+            extended_flags=extended_flags,
+            )
+        if (mode == _TREE_MODE
+            or path in self._dirs):
+            # replaces anything that was below the path
+            self._remove_below(path)
+        self.changes[path] = (mode, object)
+        self.dirty = True
+
+    def _remove_below(self, path):
+        """
+        Drop the entries below C{path}, and the changes made there,
+        for something that replaces them all.
+        """
+        prefix = path + '/'
+        paths = self._paths
+        start = bisect.bisect_left(paths, prefix)
+        end = start
+        while end < len(paths) and paths[end].startswith(prefix):
+            del self._entries[paths[end]]
+            self._link(paths[end], -1)
+            end += 1
+        del paths[start:end]
+        for stale in [p for p in self.changes if p.startswith(prefix)]:
+            del self.changes[stale]
+
+    def remove(self, path):
+        """
+        Remove the entry for C{path}, if any.
+        """
+        path = _path(path)
+        if self._entries.pop(path, None) is None:
+            return
+        i = bisect.bisect_left(self._paths, path)
+        assert self._paths[i] == path
+        del self._paths[i]
+        self._link(path, -1)
+        self.changes[path] = None
+        self.dirty = True
+
+    def expand(self, path, children):
+        """
+        Replace the subtree entry at C{path} with entries for the
+        C{children} of the tree, records named relative to it, like
+        the C{entries.Listing} of a cached tree.
+
+        This is not a change, as the files are the same as before,
+        and is not recorded in C{changes}. An empty C{path} adds
+        the children at the top level.
+        """
+        path = _path(path)
+        if path:
+            entry = self._entries.pop(path)
+            assert entry.mode == _TREE_MODE
+            i = bisect.bisect_left(self._paths, path)
+            del self._paths[i]
+            self._link(path, -1)
+            prefix = path + '/'
+        else:
+            prefix = ''
+        for record in children:
+            child = prefix + record.path
+            if child not in self._entries:
+                bisect.insort_left(self._paths, child)
+                self._link(child, 1)
+            self._entries[child] = IndexEntry(
+                path=child,
+                mode=record.mode,
+                binsha=record.binsha,
+                stat=_EMPTY_STAT,
+                flags=0,
+                extended_flags=0,
+                )
+        self.dirty = True
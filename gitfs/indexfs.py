@@ -1,10 +1,13 @@
 from __future__ import with_statement
 
+import Queue
 import errno
 import hashlib
 import os
 import posix
 import stat
+import sys
+import threading
 
 from filesystem import (
     InsecurePathError,
@@ -12,7 +15,18 @@ from filesystem import (
     CrossDeviceRenameError,
     )
 
+from gitfs import blobfile
+from gitfs import cache
 from gitfs import commands
+from gitfs import index as index_
+from gitfs import objects
+from gitfs import tree as tree_
+from gitfs import workfile
+
+# files opened for editing are kept in memory up to this size
+SPOOL_THRESHOLD = 1024*1024
+
+_TREE_MODE = 040000
 
 def maybe_mkdir(*a, **kw):
     try:
@@ -32,23 +46,241 @@ def maybe_unlink(*a, **kw):
         else:
             raise
 
-class NotifyOnCloseFile(file):
-    def __init__(self, *a, **kw):
-        self.__callback = kw.pop('callback')
-        self.__notified = False
-        super(NotifyOnCloseFile, self).__init__(*a, **kw)
+def _expand(repo, entries, path, inclusive=None):
+    """
+    Expand the subtree entries on the way to C{path}, and C{path}
+    itself if C{inclusive}, one level at a time.
+    """
+    if not path:
+        return
+    segments = path.split('/')
+    if not inclusive:
+        del segments[-1]
+    prefix = None
+    for name in segments:
+        if prefix is None:
+            prefix = name
+        else:
+            prefix = prefix + '/' + name
+        entry = entries.get(prefix)
+        if entry is None:
+            # a directory, or nothing
+            continue
+        if entry.mode != _TREE_MODE:
+            # a file in the way
+            return
+        tree = cache.object_cache.tree(repo=repo, sha=entry.object)
+        entries.expand(prefix, tree)
+
+def _isdir(entries, path):
+    entry = entries.get(path)
+    if entry is not None:
+        return entry.mode == _TREE_MODE
+    return entries.isdir(path)
+
+def _expand_merge(repo, entries, path, other):
+    """
+    Expand C{path} and C{other}, and the subdirectories they both
+    have, down to where they differ, so the entries of C{path} can be
+    put at C{other} one by one without hiding any of those there.
+    """
+    _expand(repo=repo, entries=entries, path=path, inclusive=True)
+    _expand(repo=repo, entries=entries, path=other, inclusive=True)
+    for name in entries.listdir(path) or []:
+        child = path + '/' + name
+        other_child = other + '/' + name
+        if not (_isdir(entries, child)
+                and _isdir(entries, other_child)):
+            continue
+        entry = entries.get(child)
+        other_entry = entries.get(other_child)
+        if (entry is not None
+            and other_entry is not None
+            and entry.binsha == other_entry.binsha):
+            # the same tree, nothing to merge
+            continue
+        _expand_merge(
+            repo=repo,
+            entries=entries,
+            path=child,
+            other=other_child,
+            )
 
-    def close(self):
-        if not self.__notified:
-            self.__callback(self)
-            self.__notified = True
-        super(NotifyOnCloseFile, self).close()
+def _expand_all(repo, entries):
+    """
+    Expand every subtree entry, so the index can be written out.
+    """
+    while True:
+        trees = [
+            entry.path
+            for entry in entries
+            if entry.mode == _TREE_MODE
+            ]
+        if not trees:
+            return
+        for path in trees:
+            _expand(repo=repo, entries=entries, path=path, inclusive=True)
+
+class WriteBehind(object):
+    """
+    Store closed files in background threads.
 
-    def __exit__(self, *a, **kw):
-        if not self.__notified:
-            self.__callback(self)
-            self.__notified = True
-        return super(NotifyOnCloseFile, self).__exit__(*a, **kw)
+    Jobs are run by C{workers} threads; at most C{max_pending} may be
+    waiting for one, after which C{submit} blocks, so the memory and
+    work files held stay bounded. The resulting shas are put in the
+    index C{entries} in one go, in submission order, by C{flush}, or
+    for just the paths that are needed by C{wait}.
+    """
+
+    def __init__(self, entries, workers=None, max_pending=None):
+        self.entries = entries
+        if workers is None:
+            workers = 4
+        self.workers = workers
+        if max_pending is None:
+            max_pending = 2*workers
+        self._queue = Queue.Queue(max_pending)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._cond = threading.Condition(self._lock)
+        self._seq = 0
+        # path -> number of its jobs not finished yet
+        self._pending = {}
+        # path -> [(seq, sha)] of finished jobs
+        self._done = {}
+        # (seq, path, exc_info) of failed jobs
+        self._errors = []
+
+    def __repr__(self):
+        return '%s(workers=%r)' % (
+            self.__class__.__name__,
+            self.workers,
+            )
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                (seq, path, store) = job
+                try:
+                    sha = store()
+                except:
+                    exc_info = sys.exc_info()
+                    with self._lock:
+                        self._errors.append((seq, path, exc_info))
+                        self._finished(path)
+                else:
+                    with self._lock:
+                        self._done.setdefault(path, []).append((seq, sha))
+                        self._finished(path)
+            finally:
+                self._queue.task_done()
+
+    def _finished(self, path):
+        count = self._pending[path] - 1
+        if count:
+            self._pending[path] = count
+        else:
+            del self._pending[path]
+        self._cond.notifyAll()
+
+    def submit(self, path, store):
+        """
+        Queue C{store}, a callable returning the sha of the new
+        contents of C{path}.
+        """
+        with self._lock:
+            if not self._threads:
+                for i in xrange(self.workers):
+                    t = threading.Thread(target=self._run)
+                    t.setDaemon(True)
+                    t.start()
+                    self._threads.append(t)
+            self._seq += 1
+            seq = self._seq
+            self._pending[path] = self._pending.get(path, 0) + 1
+        self._queue.put((seq, path, store))
+
+    def wait(self, path):
+        """
+        Wait for the jobs storing C{path} or any directory above it,
+        and update the index for those only.
+
+        Re-raises the exception of the first of them that failed.
+        """
+        paths = [path]
+        i = path.rfind('/')
+        while i > 0:
+            paths.append(path[:i])
+            i = path.rfind('/', 0, i)
+        with self._lock:
+            while True:
+                for p in paths:
+                    if p in self._pending:
+                        break
+                else:
+                    break
+                self._cond.wait()
+            done = []
+            for p in paths:
+                for (seq, sha) in self._done.pop(p, []):
+                    done.append((seq, p, sha))
+            errors = [
+                error for error in self._errors
+                if error[1] in paths
+                ]
+            if errors:
+                self._errors = [
+                    error for error in self._errors
+                    if error[1] not in paths
+                    ]
+        self._apply(done, errors)
+
+    def flush(self):
+        """
+        Wait for all queued jobs and update the index.
+
+        Re-raises the exception of the first job that failed.
+        """
+        self._queue.join()
+        with self._lock:
+            done = []
+            for (path, results) in self._done.iteritems():
+                for (seq, sha) in results:
+                    done.append((seq, path, sha))
+            self._done = {}
+            errors = self._errors
+            self._errors = []
+        self._apply(done, errors)
+
+    def _apply(self, done, errors):
+        if done:
+            done.sort()
+            for (seq, path, sha) in done:
+                self.entries.set(
+                    path=path,
+                    mode=0100644,
+                    object=sha,
+                    )
+            self.entries.sync()
+        if errors:
+            errors.sort()
+            exc_info = errors[0][2]
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def close(self):
+        """
+        Stop the threads, after they finish what is queued.
+        """
+        with self._lock:
+            threads = self._threads
+            self._threads = []
+        for t in threads:
+            self._queue.put(None)
+        for t in threads:
+            t.join()
 
 class IndexFS(WalkMixin):
     """
@@ -66,18 +298,62 @@ class IndexFS(WalkMixin):
     mechanism.
 
     Do not start two seperate IndexFS instances with the same index
-    file, that will result in file corruption and exceptions.
+    file, that will result in file corruption and exceptions. The
+    index is read into memory once, and every change is written
+    back to the index file as it happens, unless C{autoflush} is
+    false; then changes only reach the file on C{flush}, all at
+    once.
+
+    Open files are kept in memory until they grow past
+    C{spool_threshold} bytes (by default, C{SPOOL_THRESHOLD}), and
+    only then written to a work file.
+
+    If C{write_behind} is set, closed files are stored by that many
+    background threads instead of by the closing caller; see
+    C{WriteBehind}. Looking at a file only waits for the files
+    stored at or above its path; listing directories, changing
+    entries and C{flush} wait for all of them. Errors storing the
+    files surface there.
+
+    Directories may be held in the index as single entries naming an
+    existing tree, which are only expanded into their contents when
+    something below them is looked at. Moving or copying such a
+    directory moves or copies that one entry.
     """
 
-    def __init__(self, repo, index, path=None, _open_files=None):
+    def __init__(
+        self,
+        repo,
+        index,
+        path=None,
+        spool_threshold=None,
+        write_behind=None,
+        autoflush=None,
+        _open_files=None,
+        _entries=None,
+        _pack=None,
+        _writer=None,
+        ):
         self.repo = repo
         self.index = index
         if path is None:
             path = ''
         self.path = path
+        if spool_threshold is None:
+            spool_threshold = SPOOL_THRESHOLD
+        self.spool_threshold = spool_threshold
         if _open_files is None:
             _open_files = {}
         self.open_files = _open_files
+        if _entries is None:
+            _entries = index_.Index(index, autoflush=autoflush)
+        self._entries = _entries
+        # an objects.PackWriter new blobs go to, if any
+        self.pack = _pack
+        if (_writer is None
+            and write_behind):
+            _writer = WriteBehind(entries=_entries, workers=write_behind)
+        self.writer = _writer
 
     def __repr__(self):
         return '%s(path=%r, index=%r, repo=%r)' % (
@@ -87,6 +363,49 @@ class IndexFS(WalkMixin):
             self.repo,
             )
 
+    @property
+    def entries(self):
+        if self.writer is not None:
+            self.writer.flush()
+        _expand(repo=self.repo, entries=self._entries, path=self.path)
+        return self._entries
+
+    def _wait(self, path):
+        if self.writer is not None:
+            self.writer.wait(path)
+
+    def _expand(self, path=None):
+        if path is None:
+            path = self.path
+        # only files stored in the background above the path can
+        # change the trees on the way there
+        self._wait(os.path.dirname(path))
+        _expand(
+            repo=self.repo,
+            entries=self._entries,
+            path=path,
+            inclusive=True,
+            )
+
+    def _entry(self):
+        """
+        Return the index entry for this path, or C{None}, waiting
+        only for files stored in the background at or above it.
+        """
+        self._wait(self.path)
+        _expand(repo=self.repo, entries=self._entries, path=self.path)
+        return self._entries.get(self.path)
+
+    def flush(self):
+        """
+        Wait for files being stored in the background, and write out
+        the index file if it has unwritten changes.
+        """
+        if self.writer is not None:
+            self.writer.flush()
+        _expand_all(repo=self.repo, entries=self._entries)
+        self._entries.flush()
+
     def name(self):
         """Return last segment of path."""
         return os.path.basename(self.path)
@@ -98,7 +417,11 @@ class IndexFS(WalkMixin):
             repo=self.repo,
             index=self.index,
             path=os.path.join(self.path, relpath),
+            spool_threshold=self.spool_threshold,
             _open_files=self.open_files,
+            _entries=self._entries,
+            _pack=self.pack,
+            _writer=self.writer,
             )
 
     def child(self, *segments):
@@ -114,21 +437,52 @@ class IndexFS(WalkMixin):
             p = p.join(segment)
         return p
 
+    def _store(self, content=None, path=None):
+        """
+        Store a blob, in the pack if there is one, and return its sha.
+        """
+        if self.pack is not None:
+            return self.pack.add(
+                type_='blob',
+                content=content,
+                path=path,
+                )
+        return commands.write_object(
+            repo=self.repo,
+            content=content,
+            path=path,
+            )
+
+    def _read_blob(self, object):
+        if self.pack is not None:
+            found = self.pack.read(object)
+            if found is not None:
+                return found[1]
+        return cache.object_cache.blob(
+            repo=self.repo,
+            sha=object,
+            )
+
+    def _size(self, object):
+        if self.pack is not None:
+            found = self.pack.info(object)
+            if found is not None:
+                return found[1]
+        return cache.object_cache.size(
+            repo=self.repo,
+            sha=object,
+            )
+
     def git_get_sha1(self):
         """
         Get the git sha1 for the object.
 
         Does not work on ope
         """
-        for data in commands.ls_files(
-            repo=self.repo,
-            index=self.index,
-            path=self.path,
-            children=False,
-            ):
-            if data['path'] != self.path:
-                continue
-            return data['object']
+        entry = self._entry()
+        if (entry is not None
+            and entry.mode != _TREE_MODE):
+            return entry.object
 
         # not found
         raise OSError(
@@ -145,26 +499,47 @@ class IndexFS(WalkMixin):
 
         See also C{git_set_sha1}.
         """
-        def g(edits):
-            for edit in edits:
-                (p, object) = edit
-                if not isinstance(p, IndexFS):
-                    raise RuntimeError(
-                        'Path must be an IndexFS path.')
-                if (p.repo != self.repo
-                    or p.index != self.index):
-                    raise RuntimeError(
-                        'Path is from a different IndexFS.')
-                yield dict(
-                    # TODO mode
-                    path=p.path,
-                    object=object,
-                    )
-        commands.update_index(
-            repo=self.repo,
-            index=self.index,
-            files=g(edits),
-            )
+        for edit in edits:
+            (p, object) = edit
+            if not isinstance(p, IndexFS):
+                raise RuntimeError(
+                    'Path must be an IndexFS path.')
+            if (p.repo != self.repo
+                or p.index != self.index):
+                raise RuntimeError(
+                    'Path is from a different IndexFS.')
+            _expand(repo=self.repo, entries=self.entries, path=p.path)
+            self.entries.set(
+                # TODO mode
+                path=p.path,
+                mode=0100644,
+                object=object,
+                )
+        self.entries.sync()
+
+    def write_many(self, files):
+        """
+        Write many files at once.
+
+        C{files} maps paths relative to this one to their new
+        contents, as a dict or an iterable of pairs. All the contents
+        are stored by one git process, and the index is updated once.
+        """
+        if isinstance(files, dict):
+            files = files.iteritems()
+        paths = []
+        def contents():
+            for (path, data) in files:
+                paths.append(self.join(path))
+                yield data
+        if self.pack is not None:
+            shas = [self._store(content=data) for data in contents()]
+        else:
+            shas = commands.write_blobs(
+                repo=self.repo,
+                contents=contents(),
+                )
+        self.git_mass_set_sha1(zip(paths, shas))
 
     def git_set_sha1(self, object):
         """
@@ -178,114 +553,156 @@ class IndexFS(WalkMixin):
                 (self, object),
                 ])
 
+    def _open_blob(self, object):
+        size = self._size(object)
+        data = None
+        if (self.pack is not None
+            and self.pack.info(object) is not None):
+            data = self._read_blob(object)
+        elif size <= cache.object_cache.max_object_size:
+            data = cache.object_cache.blob(
+                repo=self.repo,
+                sha=object,
+                )
+        return blobfile.BlobFile(
+            repo=self.repo,
+            object=object,
+            size=size,
+            data=data,
+            )
+
     def open(self, mode='r'):
-        path_sha = hashlib.sha1(self.path).hexdigest()
-        work = os.path.extsep.join([
-                self.index,
-                path_sha,
-                'work',
-                ])
+        """
+        Open the file.
 
+        Reading a file nobody has open for writing streams it from
+        the object store, or the object cache, and does not see later
+        writes. Otherwise all the users of a file share its contents.
+        """
+        self._expand()
         current_users = self.open_files.get(self.path)
+        if (current_users is None
+            and mode in ['r', 'rb']):
+            entry = self._entry()
+            if entry is not None:
+                return self._open_blob(entry.object)
+
         if current_users is None:
 
-            try:
-                object = self.git_get_sha1()
-            except OSError, e:
-                if e.errno == errno.ENOENT:
-                    content = ''
-                else:
-                    raise
+            if mode.startswith('w'):
+                # truncated anyway
+                content = ''
             else:
-                # it exists
-                content = commands.cat_file(
-                    repo=self.repo,
-                    object=object,
-                    )
-            tmp = os.path.extsep.join([
+                try:
+                    object = self.git_get_sha1()
+                except OSError, e:
+                    if e.errno == errno.ENOENT:
+                        content = ''
+                    else:
+                        raise
+                else:
+                    # it exists
+                    content = self._read_blob(object)
+            path_sha = hashlib.sha1(self.path).hexdigest()
+            work = os.path.extsep.join([
                     self.index,
                     path_sha,
-                    'tmp',
+                    'work',
                     ])
-            with file(tmp, 'wb') as f:
-                f.write(content)
-            os.rename(tmp, work)
             current_users = self.open_files[self.path] = dict(
                 users=set(),
                 writable=False,
+                buffer=workfile.WorkBuffer(
+                    path=work,
+                    threshold=self.spool_threshold,
+                    data=content,
+                    ),
                 )
 
-        f = NotifyOnCloseFile(work, mode, callback=self._close_file)
+        f = workfile.WorkFile(
+            buffer=current_users['buffer'],
+            mode=mode,
+            callback=self._close_file,
+            )
         current_users['users'].add(f)
         if mode not in ['r', 'rb']:
             current_users['writable'] = True
         return f
 
     def _close_file(self, f):
-        if f.mode not in ['r', 'rb']:
-            # flush it so we can open it by name and actually see the
-            # data
-            f.flush()
         current_users = self.open_files[self.path]
         current_users['users'].remove(f)
-        if (current_users['writable']
-            and not current_users['users']):
-            # last user closed a file that has been writable at some
-            # point, write it to git object storage and update index
-            with file(f.name, 'rb') as slurp:
-                content = slurp.read()
-            os.unlink(f.name)
-            object = commands.write_object(
-                repo=self.repo,
-                content=content,
-                )
-            self.git_set_sha1(object)
-            del self.open_files[self.path]
-
-    def __iter__(self):
-        last_subdir = None
-        saw_children = False
-        for data in commands.ls_files(
-            repo=self.repo,
-            index=self.index,
-            path=self.path,
-            children=True,
-            ):
-            saw_children = True
-
-            # TODO OMG THIS IS STUPID, always retrieves full subtree
-            # (so for root, always dumps whole index)
-            if self.path == '':
-                prefix = ''
-            else:
-                prefix = self.path + '/'
-                assert data['path'][:len(prefix)] == prefix
-            relative = data['path'][len(prefix):]
-
-            if relative == '.gitfs-placeholder':
-                # hide the magic
-                continue
+        if current_users['users']:
+            return
+        del self.open_files[self.path]
+        buffer = current_users['buffer']
+        if not current_users['writable']:
+            buffer.close()
+            if buffer.spilled:
+                os.unlink(buffer.path)
+            return
+        # last user closed a file that has been writable at some
+        # point, write it to git object storage and update index
+        def store():
+            return self._store_buffer(buffer)
+        if self.writer is not None:
+            self.writer.submit(path=self.path, store=store)
+        else:
+            self.git_set_sha1(store())
 
-            if '/' in relative:
-                # it's a subdir, really; combine multiple files into
-                # one dir entry
-                head = relative.split(os.path.sep, 1)[0]
-                if head == last_subdir:
-                    # already handled this one
-                    continue
-                else:
-                    last_subdir = head
-                    yield self.child(head)
-            else:
-                yield self.child(relative)
+    def _store_buffer(self, buffer):
+        """
+        Store the contents of a closed file and return the sha.
+
+        A git object id hashes the size of the object before its
+        contents, so it can't be worked out while the file is still
+        being written to; the contents are read once more here. A
+        spilled work file is read once: the pack writer and the
+        in-process object store hash and compress it in one pass,
+        and with the git backend, C{git hash-object} reads it.
+        """
+        if buffer.spilled:
+            buffer.close()
+            object = self._store(path=buffer.path)
+            os.unlink(buffer.path)
+        else:
+            object = self._store(content=buffer.getvalue())
+            buffer.close()
+        return object
 
-        if not saw_children:
+    def __iter__(self):
+        self._expand()
+        names = self.entries.listdir(self.path)
+        if names is None:
             # it's either not a dir or it doesn't exist..
             # TODO make tests differentiate between those
             if self.path == '':
                 # except root always exists
                 return
             raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
+        for name in names:
+            if name == '.gitfs-placeholder':
+                # hide the magic
+                continue
+            yield self.child(name)
+
+    def stat_children(self):
+        """
+        Iterate over C{(child, child.stat())} for each child.
+
+        The sizes of all the children are looked up at once, instead
+        of one by one.
+        """
+        children = list(self)
+        shas = []
+        for child in children:
+            entry = self.entries.get(child.path)
+            if (entry is not None
+                and entry.mode != _TREE_MODE):
+                shas.append(entry.object)
+        cache.object_cache.sizes(repo=self.repo, shas=shas)
+        for child in children:
+            yield (child, child.stat())
 
     def parent(self):
         head, tail = os.path.split(self.path)
@@ -293,7 +710,11 @@ class IndexFS(WalkMixin):
             repo=self.repo,
             index=self.index,
             path=head,
+            spool_threshold=self.spool_threshold,
             _open_files=self.open_files,
+            _entries=self._entries,
+            _pack=self.pack,
+            _writer=self.writer,
             )
 
     def __eq__(self, other):
@@ -352,34 +773,20 @@ class IndexFS(WalkMixin):
                         os.strerror(errno.ENOENT),
                         )
 
-        empty = commands.write_object(
-            repo=self.repo,
-            content='',
-            )
-        commands.update_index(
-            repo=self.repo,
-            index=self.index,
-            files=[
-                dict(
-                    mode='100644',
-                    object=empty,
-                    path=self.child('.gitfs-placeholder').path,
-                    ),
-                ],
+        empty = self._store(content='')
+        self._expand()
+        self.entries.set(
+            path=self.child('.gitfs-placeholder').path,
+            mode=0100644,
+            object=empty,
             )
+        self.entries.sync()
 
     def remove(self):
-        commands.update_index(
-            repo=self.repo,
-            index=self.index,
-            files=[
-                dict(
-                    mode='0',
-                    object=40*'0',
-                    path=self.path,
-                    ),
-                ],
-            )
+        # removing a directory is not this
+        self._expand()
+        self.entries.remove(self.path)
+        self.entries.sync()
 
     def unlink(self):
         self.remove()
@@ -387,50 +794,32 @@ class IndexFS(WalkMixin):
     def isdir(self):
         if self.path == '':
             return True
-        for data in commands.ls_files(
-            repo=self.repo,
-            index=self.index,
-            path=self.path,
-            ):
-            return True
-
+        entry = self.entries.get(self.path)
+        if entry is not None:
+            return entry.mode == _TREE_MODE
         # i have no children, therefore i am not a directory
-        return False
+        return self.entries.isdir(self.path)
 
     def isfile(self):
         if self.path == '':
             # root directory is never a file
             return False
-        for data in commands.ls_files(
-            repo=self.repo,
-            index=self.index,
-            path=self.path,
-            children=False,
-            ):
-            if data['path'] == self.path:
-                return data['mode'] in ['100644', '100755']
-            else:
-                # if current path has children, it can't be a file
-                assert data['path'].startswith(self.path + '/')
-                return False
-
-        # didn't match anything -> don't even exist
+        entry = self._entry()
+        if entry is not None:
+            return entry.mode in [0100644, 0100755]
+        # if current path has children, it can't be a file; if it
+        # didn't match anything, it doesn't even exist
         return False
 
     def exists(self):
         if self.path == '':
             # root directory always exists
             return True
-        for data in commands.ls_files(
-            repo=self.repo,
-            index=self.index,
-            path=self.path,
-            children=False,
-            ):
-            # doesn't matter if it matches the file itself, or files
-            # in a subdirectory; anyway, current path exists
+        # doesn't matter if it matches the file itself, or files in a
+        # subdirectory; anyway, current path exists
+        if self.entries.get(self.path) is not None:
             return True
-        return False
+        return self.entries.isdir(self.path)
 
     def rmdir(self):
         self.child('.gitfs-placeholder').remove()
@@ -439,44 +828,29 @@ class IndexFS(WalkMixin):
         if self.path == '':
             # root directory is never a link
             return False
-        for data in commands.ls_files(
-            repo=self.repo,
-            index=self.index,
-            path=self.path,
-            children=False,
-            ):
-            if data['path'] == self.path:
-                return data['mode'] == '120000'
-            else:
-                # if current path has children, it can't be a symlink
-                assert data['path'].startswith(self.path + '/')
-                return False
-
-        # didn't match anything -> don't even exist
+        entry = self._entry()
+        if entry is not None:
+            return entry.mode == 0120000
+        # if current path has children, it can't be a symlink; if it
+        # didn't match anything, it doesn't even exist
         return False
 
     def stat(self):
         if self.path == '':
             return posix.stat_result(
                 [stat.S_IFDIR + 0777, 0,0,0,0,0,0,0,0,0])
-        for data in commands.ls_files(
-            repo=self.repo,
-            index=self.index,
-            path=self.path,
-            children=False,
-            ):
-            if data['path'] == self.path:
-                mode = int(data['mode'], 8)
-                size = commands.get_object_size(
-                    repo=self.repo,
-                    object=data['object'],
-                    )
-                return posix.stat_result([mode, 0,0,0,0,0,size,0,0,0])
-            else:
-                # if current path has children, it must be a dir
-                assert data['path'].startswith(self.path + '/')
-                return posix.stat_result(
-                    [stat.S_IFDIR + 0777, 0,0,0,0,0,0,0,0,0])
+        entry = self._entry()
+        if (entry is not None
+            and entry.mode == _TREE_MODE):
+            return posix.stat_result(
+                [stat.S_IFDIR + 0777, 0,0,0,0,0,0,0,0,0])
+        if entry is not None:
+            size = self._size(entry.object)
+            return posix.stat_result([entry.mode, 0,0,0,0,0,size,0,0,0])
+        if self.entries.isdir(self.path):
+            # if current path has children, it must be a dir
+            return posix.stat_result(
+                [stat.S_IFDIR + 0777, 0,0,0,0,0,0,0,0,0])
 
         # not found
         raise OSError(
@@ -484,56 +858,62 @@ class IndexFS(WalkMixin):
             os.strerror(errno.ENOENT),
             )
 
-    def rename(self, new_path):
+    def _copy(self, new_path, remove):
         if not isinstance(new_path, IndexFS):
             raise CrossDeviceRenameError()
 
-        def g():
-            for data in commands.ls_files(
+        entries = self.entries
+        # a subtree there would hide, and later clobber, the entries
+        # put below it
+        new_path._expand()
+        if new_path.exists():
+            # merging with what is there, one entry at a time
+            _expand_merge(
                 repo=self.repo,
-                index=self.index,
+                entries=entries,
                 path=self.path,
-                children=False,
-                ):
-                if data['path'] == self.path:
-                    # delete the old one
-                    delete = {}
-                    delete.update(data)
-                    delete['mode'] = '0'
-                    yield delete
-
-                    # add the new one
-                    data['path'] = new_path.path
-                    yield data
-                else:
-                    prefix = self.path + '/'
-                    assert data['path'][:len(prefix)] == prefix
+                other=new_path.path,
+                )
 
-                    # delete the old one
-                    delete = {}
-                    delete.update(data)
-                    delete['mode'] = '0'
-                    yield delete
+        moves = []
+        entry = entries.get(self.path)
+        if entry is not None:
+            moves.append((entry, new_path.path))
+        prefix = self.path + '/'
+        for entry in entries.children(self.path):
+            moves.append(
+                (entry, new_path.path + '/' + entry.path[len(prefix):]))
+        if remove:
+            for (entry, path) in moves:
+                # delete the old one
+                entries.remove(entry.path)
+        for (entry, path) in moves:
+            # add the new one
+            entries.set(
+                path=path,
+                mode=entry.mode,
+                object=entry.object,
+                )
+        entries.sync()
 
-                    # add the new one
-                    data['path'] = new_path.path + '/' + data['path'][len(prefix):]
-                    yield data
+    def rename(self, new_path):
+        self._copy(new_path, remove=True)
+        self.path = new_path.path
 
-        commands.update_index(
-            repo=self.repo,
-            index=self.index,
-            files=g(),
-            )
+    def copytree(self, new_path):
+        """
+        Copy this file or directory, and everything below it, to
+        C{new_path}.
 
-        self.path = new_path.path
+        Only index entries are copied, no file contents; a directory
+        still held as a single tree entry is copied as that entry.
+        """
+        self._copy(new_path, remove=False)
 
     def size(self):
         object = self.git_get_sha1()
         # it exists
-        return commands.get_object_size(
-            repo=self.repo,
-            object=object,
-            )
+        return self._size(object)
 
 class TemporaryIndexFS(object):
     """
@@ -541,7 +921,9 @@ class TemporaryIndexFS(object):
 
     On non-error exit of the context, the index is written to the
     repository. The resulting tree SHA can be read from the C{tree}
-    attribute.
+    attribute. The new tree is built by editing the tree of C{rev}
+    (or the empty tree), so only trees containing changes are
+    rewritten.
 
     For example::
 
@@ -552,6 +934,11 @@ class TemporaryIndexFS(object):
     >>> t.tree
     '4d9fa708931786c374d879e71f89f97a68e73f94'
 
+    If C{pack} is true, new objects go to one packfile, installed on
+    exit, instead of being written loose. C{spool_threshold} and
+    C{write_behind} are passed on to the C{IndexFS}; files still
+    being stored in the background are waited for on exit, and any
+    error storing them is raised from there.
     """
 
     tree = None
@@ -568,6 +955,9 @@ class TemporaryIndexFS(object):
         self.repo = repo
 
         self.rev = kw.pop('rev', None)
+        self.pack = kw.pop('pack', None)
+        self.spool_threshold = kw.pop('spool_threshold', None)
+        self.write_behind = kw.pop('write_behind', None)
 
         index = kw.pop('index', None)
         if index is None:
@@ -585,23 +975,90 @@ class TemporaryIndexFS(object):
 
     def __enter__(self):
         if self.rev is not None:
-            commands.read_tree(
+            # replaced by the tree
+            maybe_unlink(self.index)
+        # we own the index file, so there's no need to write it out
+        # until the tree is needed
+        self.entries = index_.Index(self.index, autoflush=False)
+        if self.rev is not None:
+            self.base = commands.get_object_info(
                 repo=self.repo,
-                treeish=self.rev,
-                index=self.index,
+                object='%s^{tree}' % self.rev,
+                )['object']
+            # claim the file
+            self.entries.write()
+            # start from the top level of the tree; subtrees are
+            # expanded as they are needed
+            tree = cache.object_cache.tree(repo=self.repo, sha=self.base)
+            self.entries.expand('', tree)
+        elif len(self.entries) == 0:
+            self.base = None
+        else:
+            # someone handed us an index with stuff already in it;
+            # there's no tree to start from
+            self.base = False
+        self.packer = None
+        if self.pack:
+            self.packer = objects.PackWriter(self.repo)
+        self.writer = None
+        if self.write_behind:
+            self.writer = WriteBehind(
+                entries=self.entries,
+                workers=self.write_behind,
                 )
         return IndexFS(
             repo=self.repo,
             index=self.index,
+            spool_threshold=self.spool_threshold,
+            _entries=self.entries,
+            _pack=self.packer,
+            _writer=self.writer,
             )
 
-    def __exit__(self, type_, value, traceback):
-        if (type_ is None
-            and value is None
-            and traceback is None):
-            # no exception -> write tree
+    def _write_tree(self, packer):
+        if self.writer is not None:
+            self.writer.flush()
+        if self.base is False:
+            if packer is not None:
+                # git needs to see the blobs
+                packer.finish()
+            _expand_all(repo=self.repo, entries=self.entries)
+            self.entries.write()
             self.tree = commands.write_tree(
                 repo=self.repo,
                 index=self.index,
                 )
-        maybe_unlink(self.index)
+        else:
+            builder = tree_.TreeBuilder(
+                repo=self.repo,
+                tree=self.base,
+                pack=packer,
+                )
+            builder.update(self.entries.changes)
+            self.tree = builder.write()
+            if packer is not None:
+                packer.finish()
+
+    def __exit__(self, type_, value, traceback):
+        packer = self.packer
+        self.packer = None
+        try:
+            if (type_ is None
+                and value is None
+                and traceback is None):
+                # no exception -> write tree
+                try:
+                    self._write_tree(packer)
+                except:
+                    if packer is not None:
+                        packer.abort()
+                    raise
+            elif packer is not None:
+                if self.writer is not None:
+                    # don't let the workers write to an aborted pack
+                    self.writer.close()
+                packer.abort()
+        finally:
+            if self.writer is not None:
+                self.writer.close()
+            maybe_unlink(self.index)
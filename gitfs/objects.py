@@ -0,0 +1,1258 @@
+"""
+Read git objects, and write loose ones, without running git.
+
+Understands loose objects, packfiles (index versions 1 and 2, with
+both kinds of deltas), alternates, loose and packed refs, and the
+simplest revision syntax: full shas, ref names, C{<rev>^{tree}} and
+friends, and C{<rev>:<path>}. Anything fancier is left to git;
+callers get C{None} back and are expected to fall back to running
+git.
+"""
+
+from __future__ import with_statement
+
+import binascii
+import errno
+import hashlib
+import itertools
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+import zlib
+
+from cStringIO import StringIO
+
+_TYPES = {
+    1: 'commit',
+    2: 'tree',
+    3: 'blob',
+    4: 'tag',
+    }
+_OFS_DELTA = 6
+_REF_DELTA = 7
+
+_PACK_HEADER = struct.Struct('>4sLL')
+
+# compressed bytes fed at a time when looking for a delta's sizes
+_DELTA_HEAD_CHUNK = 64
+
+_SHA_RE = re.compile(r'^[0-9a-f]{40}$')
+_REF_NAME_RE = re.compile(r'^[A-Za-z0-9._/-]+$')
+
+# git knows the empty tree even when it is not in the object store
+EMPTY_TREE = '4b825dc642cb6eb9a060e54bf8d69288fbee4904'
+
+# how much compressed data to feed to zlib at a time
+_CHUNK = 65536
+
+# when to fsync new loose objects: 'never', 'file' (the object, before
+# it is renamed into place) or 'dir' (its directory after that, too)
+fsync_policy = os.environ.get('GITFS_FSYNC', 'file')
+_FSYNC_POLICIES = ['never', 'file', 'dir']
+
+# zlib level git uses for loose objects by default
+_LOOSE_COMPRESSION = 1
+
+def is_sha(name):
+    return _SHA_RE.match(name) is not None
+
+def _read_file(path):
+    try:
+        with file(path, 'rb') as f:
+            return f.read()
+    except IOError, e:
+        if e.errno in [errno.ENOENT, errno.ENOTDIR, errno.EISDIR]:
+            return None
+        raise
+
+def parse_tree(data, binary=None):
+    """
+    Parse a raw tree object.
+
+    Yields C{(mode, name, sha)} tuples, with C{mode} as the octal
+    string stored in the tree (no leading zeroes) and C{sha} in hex,
+    or as the 20 raw bytes if C{binary} is true.
+    """
+    if binary is None:
+        binary = False
+    i = 0
+    end = len(data)
+    while i < end:
+        space = data.index(' ', i)
+        nul = data.index('\0', space)
+        mode = data[i:space]
+        name = data[space+1:nul]
+        sha = data[nul+1:nul+21]
+        if not binary:
+            sha = binascii.hexlify(sha)
+        i = nul + 21
+        yield (mode, name, sha)
+
+def mode_type(mode):
+    """
+    Object type an entry with the given octal mode string points to.
+    """
+    mode = int(mode, 8)
+    if mode == 040000:
+        return 'tree'
+    if mode == 0160000:
+        return 'commit'
+    return 'blob'
+
+def _inflate(data, offset, size):
+    """
+    Inflate C{size} bytes from the zlib stream starting at C{offset}.
+    """
+    d = zlib.decompressobj()
+    out = []
+    got = 0
+    while got < size:
+        buf = data[offset:offset+_CHUNK]
+        if not buf:
+            raise RuntimeError('truncated zlib stream')
+        offset += len(buf)
+        piece = d.decompress(buf, size - got)
+        while True:
+            if piece:
+                out.append(piece)
+                got += len(piece)
+            if (got >= size
+                or not d.unconsumed_tail):
+                break
+            piece = d.decompress(d.unconsumed_tail, size - got)
+        if d.unused_data:
+            break
+    if got != size:
+        raise RuntimeError('bad object size in pack')
+    return ''.join(out)
+
+def _delta_varint(delta, i):
+    value = 0
+    shift = 0
+    while True:
+        c = ord(delta[i])
+        i += 1
+        value |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return value, i
+
+def delta_target_size(delta):
+    src_size, i = _delta_varint(delta, 0)
+    dst_size, i = _delta_varint(delta, i)
+    return dst_size
+
+def apply_delta(base, delta):
+    src_size, i = _delta_varint(delta, 0)
+    if src_size != len(base):
+        raise RuntimeError('delta base size mismatch')
+    dst_size, i = _delta_varint(delta, i)
+    out = []
+    end = len(delta)
+    while i < end:
+        c = ord(delta[i])
+        i += 1
+        if c & 0x80:
+            offset = 0
+            for bit, shift in [(0x01, 0), (0x02, 8), (0x04, 16), (0x08, 24)]:
+                if c & bit:
+                    offset |= ord(delta[i]) << shift
+                    i += 1
+            length = 0
+            for bit, shift in [(0x10, 0), (0x20, 8), (0x40, 16)]:
+                if c & bit:
+                    length |= ord(delta[i]) << shift
+                    i += 1
+            if length == 0:
+                length = 0x10000
+            out.append(base[offset:offset+length])
+        elif c:
+            out.append(delta[i:i+c])
+            i += c
+        else:
+            raise RuntimeError('invalid delta opcode')
+    result = ''.join(out)
+    if len(result) != dst_size:
+        raise RuntimeError('delta result size mismatch')
+    return result
+
+class InflateReader(object):
+    """
+    File-like object inflating a zlib stream as it is read.
+
+    C{read_raw(n)} supplies the compressed data; anything after the
+    end of the zlib stream is ignored.
+    """
+
+    def __init__(self, read_raw, close=None):
+        self._read_raw = read_raw
+        self._close = close
+        self._z = zlib.decompressobj()
+        self._pending = ''
+        self._eof = False
+
+    def _more(self):
+        tail = self._z.unconsumed_tail
+        if tail:
+            data = self._z.decompress(tail, _CHUNK)
+        else:
+            raw = self._read_raw(_CHUNK)
+            if not raw:
+                self._eof = True
+                return self._z.flush()
+            data = self._z.decompress(raw, _CHUNK)
+        if self._z.unused_data:
+            self._eof = True
+        return data
+
+    def read(self, size=-1):
+        pieces = [self._pending]
+        got = len(self._pending)
+        while (not self._eof
+               and (size < 0 or got < size)):
+            data = self._more()
+            pieces.append(data)
+            got += len(data)
+        data = ''.join(pieces)
+        if size < 0:
+            self._pending = ''
+            return data
+        self._pending = data[size:]
+        return data[:size]
+
+    def skip_header(self):
+        """
+        Skip a loose object header; returns C{(type, size)}.
+        """
+        data = self.read(64)
+        nul = data.index('\0')
+        self._pending = data[nul+1:] + self._pending
+        type_, size = data[:nul].split(' ', 1)
+        return type_, int(size)
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+def _hash_object(type_, content):
+    """
+    Hash an object whose data is C{content}, a string.
+
+    Returns the object header and the hex sha.
+    """
+    header = '%s %d\0' % (type_, len(content))
+    digest = hashlib.sha1(header)
+    digest.update(content)
+    return header, digest.hexdigest()
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _check_fsync(fsync):
+    if fsync is None:
+        fsync = fsync_policy
+    if fsync not in _FSYNC_POLICIES:
+        raise RuntimeError('unknown fsync policy: %r' % fsync)
+    return fsync
+
+class Pack(object):
+    """
+    A packfile and its index, both mmapped.
+    """
+
+    def __init__(self, path):
+        # path without the .idx/.pack extension
+        self.path = path
+        with file(path + '.idx', 'rb') as f:
+            self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with file(path + '.pack', 'rb') as f:
+            self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.pack[:4] != 'PACK':
+            raise RuntimeError('not a packfile: %s.pack' % path)
+        if self.idx[:4] == '\377tOc':
+            (version,) = struct.unpack('>L', self.idx[4:8])
+            if version != 2:
+                raise RuntimeError(
+                    'unsupported pack index version: %d' % version)
+            self.version = 2
+            self._fanout = 8
+        else:
+            self.version = 1
+            self._fanout = 0
+        self.fanout = struct.unpack(
+            '>256L', self.idx[self._fanout:self._fanout+1024])
+        self.count = self.fanout[255]
+        if self.version == 2:
+            self._shas = self._fanout + 1024
+            self._offsets = self._shas + 24*self.count
+            self._large_offsets = self._offsets + 4*self.count
+
+    def close(self):
+        self.idx.close()
+        self.pack.close()
+
+    def _sha_at(self, i):
+        if self.version == 2:
+            start = self._shas + 20*i
+        else:
+            start = self._fanout + 1024 + 24*i + 4
+        return self.idx[start:start+20]
+
+    def _offset_at(self, i):
+        if self.version == 1:
+            start = self._fanout + 1024 + 24*i
+            (offset,) = struct.unpack('>L', self.idx[start:start+4])
+            return offset
+        start = self._offsets + 4*i
+        (offset,) = struct.unpack('>L', self.idx[start:start+4])
+        if offset & 0x80000000:
+            start = self._large_offsets + 8*(offset & 0x7fffffff)
+            (offset,) = struct.unpack('>Q', self.idx[start:start+8])
+        return offset
+
+    def find(self, binsha):
+        """
+        Return the pack offset of the object, or C{None}.
+        """
+        first = ord(binsha[0])
+        if first == 0:
+            lo = 0
+        else:
+            lo = self.fanout[first-1]
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            got = self._sha_at(mid)
+            if got < binsha:
+                lo = mid + 1
+            elif got > binsha:
+                hi = mid
+            else:
+                return self._offset_at(mid)
+        return None
+
+    def _header(self, offset):
+        pack = self.pack
+        c = ord(pack[offset])
+        offset += 1
+        type_ = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        while c & 0x80:
+            c = ord(pack[offset])
+            offset += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        return type_, size, offset
+
+    def _delta_base(self, type_, offset, data_offset):
+        """
+        Locate a delta base; returns C{(base_offset, base_sha, offset)}.
+        """
+        pack = self.pack
+        if type_ == _REF_DELTA:
+            return None, pack[data_offset:data_offset+20], data_offset+20
+        c = ord(pack[data_offset])
+        data_offset += 1
+        base = c & 0x7f
+        while c & 0x80:
+            c = ord(pack[data_offset])
+            data_offset += 1
+            base = ((base + 1) << 7) | (c & 0x7f)
+        return offset - base, None, data_offset
+
+    def read_at(self, offset, db):
+        """
+        Read the object at C{offset}; returns C{(type, data)}.
+
+        C{db} is used to find the bases of C{REF_DELTA} objects.
+        """
+        deltas = []
+        while True:
+            type_, size, data_offset = self._header(offset)
+            if type_ not in [_OFS_DELTA, _REF_DELTA]:
+                base_type = _TYPES.get(type_)
+                if base_type is None:
+                    raise RuntimeError(
+                        'unknown object type in pack: %d' % type_)
+                data = _inflate(self.pack, data_offset, size)
+                break
+            base_offset, base_sha, data_offset = self._delta_base(
+                type_, offset, data_offset)
+            deltas.append(_inflate(self.pack, data_offset, size))
+            if base_offset is None:
+                found = db._read_binsha(base_sha)
+                if found is None:
+                    raise RuntimeError(
+                        'missing delta base %s'
+                        % binascii.hexlify(base_sha))
+                base_type, data = found
+                break
+            offset = base_offset
+        for delta in reversed(deltas):
+            data = apply_delta(data, delta)
+        return base_type, data
+
+    def stream_at(self, offset, db):
+        """
+        Like C{read_at}, but returns C{(type, size, file)}.
+
+        Only undeltified objects are really streamed.
+        """
+        type_, size, data_offset = self._header(offset)
+        if type_ in [_OFS_DELTA, _REF_DELTA]:
+            type_, data = self.read_at(offset, db)
+            return type_, len(data), StringIO(data)
+        position = [data_offset]
+        def read_raw(n):
+            start = position[0]
+            data = self.pack[start:start+n]
+            position[0] = start + len(data)
+            return data
+        return _TYPES[type_], size, InflateReader(read_raw)
+
+    def _delta_head(self, data_offset):
+        """
+        Inflate just enough of the delta at C{data_offset} to hold
+        the source and target sizes at its start.
+        """
+        z = zlib.decompressobj()
+        head = ''
+        pos = data_offset
+        # each size ends with the first byte without the high bit
+        while sum(1 for c in head if not ord(c) & 0x80) < 2:
+            raw = z.unconsumed_tail
+            if not raw:
+                raw = self.pack[pos:pos+_DELTA_HEAD_CHUNK]
+                pos += len(raw)
+            if not raw or z.unused_data:
+                raise RuntimeError('truncated delta in pack')
+            head += z.decompress(raw, 20)
+        return head
+
+    def info_at(self, offset, db):
+        """
+        Like C{read_at}, but only returns C{(type, size)}.
+        """
+        type_, size, data_offset = self._header(offset)
+        if type_ not in [_OFS_DELTA, _REF_DELTA]:
+            return _TYPES[type_], size
+        base_offset, base_sha, data_offset = self._delta_base(
+            type_, offset, data_offset)
+        size = delta_target_size(self._delta_head(data_offset))
+        while type_ in [_OFS_DELTA, _REF_DELTA]:
+            if base_offset is None:
+                found = db._info_binsha(base_sha)
+                if found is None:
+                    raise RuntimeError(
+                        'missing delta base %s'
+                        % binascii.hexlify(base_sha))
+                return found[0], size
+            offset = base_offset
+            type_, _, data_offset = self._header(offset)
+            if type_ in [_OFS_DELTA, _REF_DELTA]:
+                base_offset, base_sha, data_offset = self._delta_base(
+                    type_, offset, data_offset)
+        return _TYPES[type_], size
+
+class ObjectDirectory(object):
+    """
+    One C{objects} directory: loose objects and packs.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.packs = {}
+        self._lock = threading.Lock()
+        self.rescan()
+
+    def rescan(self):
+        """
+        Pick up packs created or removed since the last scan.
+        """
+        pack_dir = os.path.join(self.path, 'pack')
+        try:
+            names = os.listdir(pack_dir)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                names = []
+            else:
+                raise
+        found = set()
+        for name in names:
+            if not name.endswith('.idx'):
+                continue
+            base = os.path.join(pack_dir, name[:-len('.idx')])
+            if not os.path.exists(base + '.pack'):
+                continue
+            found.add(base)
+        with self._lock:
+            for base in list(self.packs):
+                if base not in found:
+                    self.packs.pop(base).close()
+            for base in found:
+                if base not in self.packs:
+                    self.packs[base] = Pack(base)
+
+    def loose_path(self, sha):
+        return os.path.join(self.path, sha[:2], sha[2:])
+
+    def read_loose(self, sha):
+        raw = _read_file(self.loose_path(sha))
+        if raw is None:
+            return None
+        data = zlib.decompress(raw)
+        nul = data.index('\0')
+        type_, size = data[:nul].split(' ', 1)
+        data = data[nul+1:]
+        if len(data) != int(size):
+            raise RuntimeError('bad loose object size: %s' % sha)
+        return type_, data
+
+    def stream_loose(self, sha):
+        try:
+            f = file(self.loose_path(sha), 'rb')
+        except IOError, e:
+            if e.errno in [errno.ENOENT, errno.ENOTDIR]:
+                return None
+            raise
+        reader = InflateReader(read_raw=f.read, close=f.close)
+        type_, size = reader.skip_header()
+        return type_, size, reader
+
+    def info_loose(self, sha):
+        raw = _read_file(self.loose_path(sha))
+        if raw is None:
+            return None
+        # the header is tiny, don't inflate the whole thing
+        head = zlib.decompressobj().decompress(raw, 64)
+        nul = head.index('\0')
+        type_, size = head[:nul].split(' ', 1)
+        return type_, int(size)
+
+    def find_packed(self, binsha):
+        with self._lock:
+            packs = self.packs.values()
+        for pack in packs:
+            offset = pack.find(binsha)
+            if offset is not None:
+                return pack, offset
+        return None, None
+
+class ObjectDatabase(object):
+    """
+    In-process reader for the objects and refs of a repository.
+    """
+
+    def __init__(self, repo):
+        self.repo = repo
+        objects = os.path.join(repo, 'objects')
+        self.dirs = [ObjectDirectory(objects)]
+        alternates = _read_file(os.path.join(objects, 'info', 'alternates'))
+        if alternates is not None:
+            for line in alternates.splitlines():
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                self.dirs.append(
+                    ObjectDirectory(os.path.join(objects, line)))
+        self._packed_refs = None
+        self._packed_refs_stat = None
+
+    def _lookup(self, binsha, packed, loose, empty_tree):
+        sha = binascii.hexlify(binsha)
+        for rescan in [False, True]:
+            for d in self.dirs:
+                if rescan:
+                    d.rescan()
+                pack, offset = d.find_packed(binsha)
+                if pack is not None:
+                    return packed(pack, offset)
+                found = loose(d, sha)
+                if found is not None:
+                    return found
+        if sha == EMPTY_TREE:
+            return empty_tree
+        return None
+
+    def _read_binsha(self, binsha):
+        return self._lookup(
+            binsha,
+            packed=lambda pack, offset: pack.read_at(offset, self),
+            loose=lambda d, sha: d.read_loose(sha),
+            empty_tree=('tree', ''),
+            )
+
+    def _info_binsha(self, binsha):
+        return self._lookup(
+            binsha,
+            packed=lambda pack, offset: pack.info_at(offset, self),
+            loose=lambda d, sha: d.info_loose(sha),
+            empty_tree=('tree', 0),
+            )
+
+    def has(self, sha):
+        """
+        Does the object with full hex sha C{sha} exist?
+
+        Unlike the readers, this does not look for packs created
+        since the last scan.
+        """
+        binsha = binascii.unhexlify(sha)
+        for d in self.dirs:
+            pack, offset = d.find_packed(binsha)
+            if pack is not None:
+                return True
+            if os.path.exists(d.loose_path(sha)):
+                return True
+        return sha == EMPTY_TREE
+
+    def write(self, type_, content=None, path=None, fsync=None):
+        """
+        Store a loose object and return its sha.
+
+        The data is either C{content}, a string, or read from the
+        file at C{path}. A string is hashed before anything is
+        written, and objects that already exist are not written
+        again. A file is read only once, hashed and compressed at the
+        same time, and the result dropped if the object turned out to
+        exist. Otherwise the object is compressed into a temporary
+        file, fsynced as C{fsync} (by default, C{fsync_policy}) says,
+        and renamed into place.
+        """
+        if (content is None) == (path is None):
+            raise TypeError('write needs exactly one of content, path')
+        fsync = _check_fsync(fsync)
+        if path is not None:
+            return self._write_file(type_=type_, path=path, fsync=fsync)
+        (header, sha) = _hash_object(type_=type_, content=content)
+        if self.has(sha):
+            return sha
+
+        d = self.dirs[0]
+        (fd, tmp) = tempfile.mkstemp(prefix='tmp_obj_', dir=d.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                compress = zlib.compressobj(_LOOSE_COMPRESSION)
+                f.write(compress.compress(header))
+                f.write(compress.compress(content))
+                f.write(compress.flush())
+                if fsync != 'never':
+                    f.flush()
+                    os.fsync(f.fileno())
+        except:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        self._install(tmp=tmp, sha=sha, fsync=fsync)
+        return sha
+
+    def _write_file(self, type_, path, fsync):
+        d = self.dirs[0]
+        with file(path, 'rb') as src:
+            size = os.fstat(src.fileno()).st_size
+            header = '%s %d\0' % (type_, size)
+            digest = hashlib.sha1(header)
+            (fd, tmp) = tempfile.mkstemp(prefix='tmp_obj_', dir=d.path)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    compress = zlib.compressobj(_LOOSE_COMPRESSION)
+                    f.write(compress.compress(header))
+                    length = 0
+                    while True:
+                        data = src.read(_CHUNK)
+                        if not data:
+                            break
+                        length += len(data)
+                        digest.update(data)
+                        f.write(compress.compress(data))
+                    if length != size:
+                        raise RuntimeError(
+                            'file changed while being stored: %s' % path)
+                    f.write(compress.flush())
+                    sha = digest.hexdigest()
+                    if self.has(sha):
+                        os.unlink(tmp)
+                        return sha
+                    if fsync != 'never':
+                        f.flush()
+                        os.fsync(f.fileno())
+            except:
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+                raise
+        self._install(tmp=tmp, sha=sha, fsync=fsync)
+        return sha
+
+    def _install(self, tmp, sha, fsync):
+        """
+        Move the finished temporary file C{tmp} to be loose object
+        C{sha}.
+        """
+        dest = self.dirs[0].loose_path(sha)
+        try:
+            os.chmod(tmp, 0444)
+            try:
+                os.mkdir(os.path.dirname(dest))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            # if someone else just stored it, this replaces the same
+            # bytes
+            os.rename(tmp, dest)
+        except:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        if fsync == 'dir':
+            _fsync_dir(os.path.dirname(dest))
+
+    def stream(self, sha):
+        """
+        Open an object by full hex sha for streaming; returns C{(type,
+        size, file)} or C{None} if it can't be found.
+        """
+        return self._lookup(
+            binascii.unhexlify(sha),
+            packed=lambda pack, offset: pack.stream_at(offset, self),
+            loose=lambda d, sha: d.stream_loose(sha),
+            empty_tree=('tree', 0, StringIO('')),
+            )
+
+    def read(self, sha):
+        """
+        Read an object by full hex sha; returns C{(type, data)} or
+        C{None} if it can't be found.
+        """
+        return self._read_binsha(binascii.unhexlify(sha))
+
+    def info(self, sha):
+        """
+        Like C{read} but only returns C{(type, size)}.
+        """
+        return self._info_binsha(binascii.unhexlify(sha))
+
+    def _get_packed_refs(self):
+        path = os.path.join(self.repo, 'packed-refs')
+        try:
+            st = os.stat(path)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return {}
+            raise
+        key = (st.st_ino, st.st_size, st.st_mtime)
+        if key != self._packed_refs_stat:
+            refs = {}
+            data = _read_file(path) or ''
+            for line in data.splitlines():
+                if (not line
+                    or line.startswith('#')
+                    or line.startswith('^')):
+                    continue
+                sha, name = line.split(' ', 1)
+                refs[name] = sha
+            self._packed_refs = refs
+            self._packed_refs_stat = key
+        return self._packed_refs
+
+    def read_ref(self, name):
+        """
+        Resolve a full ref name like C{HEAD} or C{refs/heads/master}.
+
+        Returns the sha, or C{None} if the ref does not exist.
+        """
+        for i in xrange(10):
+            if name != 'HEAD' and not name.startswith('refs/'):
+                return None
+            if ('..' in name
+                or not _REF_NAME_RE.match(name)):
+                return None
+            data = _read_file(os.path.join(self.repo, name))
+            if data is None:
+                return self._get_packed_refs().get(name)
+            data = data.strip()
+            if data.startswith('ref: '):
+                name = data[len('ref: '):]
+                continue
+            if is_sha(data):
+                return data
+            return None
+        # symref loop
+        return None
+
+    def _resolve_name(self, name):
+        if is_sha(name):
+            return name
+        if not _REF_NAME_RE.match(name):
+            return None
+        if name == 'HEAD' or name.startswith('refs/'):
+            return self.read_ref(name)
+        for pattern in [
+            'refs/%s',
+            'refs/tags/%s',
+            'refs/heads/%s',
+            'refs/remotes/%s',
+            'refs/remotes/%s/HEAD',
+            ]:
+            sha = self.read_ref(pattern % name)
+            if sha is not None:
+                return sha
+        return None
+
+    def peel(self, sha, type_):
+        """
+        Peel tags and commits until reaching an object of C{type_}.
+        """
+        while True:
+            found = self.read(sha)
+            if found is None:
+                return None
+            got_type, data = found
+            if got_type == type_:
+                return sha
+            if got_type == 'tag':
+                sha = data.split('\n', 1)[0][len('object '):]
+            elif got_type == 'commit' and type_ == 'tree':
+                sha = data.split('\n', 1)[0][len('tree '):]
+            else:
+                return None
+
+    def lookup_path(self, tree, path):
+        """
+        Find C{path} inside C{tree}; returns C{(mode, sha)} or C{None}.
+        """
+        mode = '40000'
+        sha = tree
+        for segment in path.split('/'):
+            if mode_type(mode) != 'tree':
+                return None
+            found = self.read(sha)
+            if found is None or found[0] != 'tree':
+                return None
+            for (entry_mode, name, entry_sha) in parse_tree(found[1]):
+                if name == segment:
+                    mode, sha = entry_mode, entry_sha
+                    break
+            else:
+                return None
+        return mode, sha
+
+    def resolve(self, name):
+        """
+        Resolve a revision to a full hex sha.
+
+        Returns C{None} if the name can't be resolved in-process;
+        that includes both missing objects and syntax this module
+        does not understand.
+        """
+        if ':' in name:
+            rev, path = name.split(':', 1)
+            if not rev:
+                # index lookups are git's business
+                return None
+            tree = self.resolve('%s^{tree}' % rev)
+            if tree is None:
+                return None
+            path = path.strip('/')
+            if not path:
+                return tree
+            found = self.lookup_path(tree, path)
+            if found is None:
+                return None
+            return found[1]
+        for suffix, type_ in [
+            ('^{tree}', 'tree'),
+            ('^{commit}', 'commit'),
+            ('^{blob}', 'blob'),
+            ('^{tag}', 'tag'),
+            ]:
+            if name.endswith(suffix):
+                sha = self.resolve(name[:-len(suffix)])
+                if sha is None:
+                    return None
+                return self.peel(sha, type_)
+        return self._resolve_name(name)
+
+    def ls_tree(self, tree, path, children, recursive, trees=False):
+        """
+        List a tree like C{git ls-tree --full-name}, as C{(mode,
+        type, sha, path)} tuples.
+
+        C{tree} is a tree sha; see C{commands.ls_tree} for the rest.
+        """
+        def listing(sha, prefix):
+            found = self.read(sha)
+            if found is None or found[0] != 'tree':
+                raise RuntimeError('git ls-tree failed')
+            for (mode, name, entry_sha) in parse_tree(found[1]):
+                type_ = mode_type(mode)
+                full = prefix + name
+                if not recursive or type_ != 'tree' or trees:
+                    yield ('%06o' % int(mode, 8), type_, entry_sha, full)
+                if recursive and type_ == 'tree':
+                    for data in listing(entry_sha, full + '/'):
+                        yield data
+
+        if not path:
+            return listing(tree, '')
+        found = self.lookup_path(tree, path)
+        if found is None:
+            return iter([])
+        mode, sha = found
+        type_ = mode_type(mode)
+        if type_ == 'tree' and (children or recursive):
+            if recursive and trees:
+                # git lists the trees leading to the path, too
+                leading = []
+                segments = path.split('/')
+                for i in xrange(1, len(segments)+1):
+                    parent = '/'.join(segments[:i])
+                    (parent_mode, parent_sha) = self.lookup_path(tree, parent)
+                    leading.append((
+                            '%06o' % int(parent_mode, 8),
+                            'tree',
+                            parent_sha,
+                            parent,
+                            ))
+                return itertools.chain(leading, listing(sha, path + '/'))
+            return listing(sha, path + '/')
+        if children:
+            return iter([])
+        return iter([('%06o' % int(mode, 8), type_, sha, path)])
+
+_TYPE_CODES = dict((type_, code) for (code, type_) in _TYPES.items())
+
+class PackWriter(object):
+    """
+    Collect new objects into a single packfile.
+
+    Objects are appended to a temporary pack as they are added, whole
+    (no deltas). Nothing outside this object can see them until
+    C{finish} writes the pack index and installs both files; C{read}
+    and C{info} serve them in the meantime. C{abort} throws them all
+    away. Objects can be added and read from many threads.
+    """
+
+    def __init__(self, repo, fsync=None):
+        self.repo = repo
+        self.fsync = _check_fsync(fsync)
+        self._db = get_database(repo)
+        self._pack_dir = os.path.join(repo, 'objects', 'pack')
+        self._file = None
+        self._tmp = None
+        # binsha -> (offset, end, crc32, type, size)
+        self._entries = {}
+        self._offset = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '%s(repo=%r)' % (
+            self.__class__.__name__,
+            self.repo,
+            )
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _mkdir(self):
+        try:
+            os.mkdir(self._pack_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _open(self):
+        self._mkdir()
+        (fd, self._tmp) = tempfile.mkstemp(
+            prefix='tmp_pack_',
+            dir=self._pack_dir,
+            )
+        self._file = os.fdopen(fd, 'w+b')
+        # the object count is filled in when finishing
+        header = _PACK_HEADER.pack('PACK', 2, 0)
+        self._file.write(header)
+        self._offset = len(header)
+
+    def add(self, type_, content=None, path=None):
+        """
+        Add an object, unless it exists already, and return its sha.
+
+        The data is either C{content}, a string, or read from the
+        file at C{path}. A string is hashed before anything else is
+        done; a file is read only once, hashed and compressed at the
+        same time into a temporary file, which is dropped if the
+        object turned out to exist. Only appending the compressed
+        object to the pack is done under the lock, so many threads
+        can add objects at once.
+        """
+        if (content is None) == (path is None):
+            raise TypeError('add needs exactly one of content, path')
+        if path is not None:
+            return self._add_file(type_=type_, path=path)
+        (header, sha) = _hash_object(type_=type_, content=content)
+        binsha = binascii.unhexlify(sha)
+        if (binsha in self._entries
+            or self._db.has(sha)):
+            return sha
+        size = len(content)
+        pieces = []
+        crc = self._deflate(type_, size, [content], pieces.append)
+        self._append(binsha, type_, size, crc, pieces)
+        return sha
+
+    def _add_file(self, type_, path):
+        self._mkdir()
+        with file(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            digest = hashlib.sha1('%s %d\0' % (type_, size))
+            def chunks():
+                length = 0
+                while True:
+                    data = f.read(_CHUNK)
+                    if not data:
+                        break
+                    length += len(data)
+                    digest.update(data)
+                    yield data
+                if length != size:
+                    raise RuntimeError(
+                        'file changed while being stored: %s' % path)
+            with tempfile.TemporaryFile(
+                prefix='tmp_obj_',
+                dir=self._pack_dir,
+                ) as spool:
+                crc = self._deflate(type_, size, chunks(), spool.write)
+                sha = digest.hexdigest()
+                binsha = binascii.unhexlify(sha)
+                if (binsha in self._entries
+                    or self._db.has(sha)):
+                    return sha
+                spool.seek(0)
+                def pieces():
+                    while True:
+                        data = spool.read(_CHUNK)
+                        if not data:
+                            break
+                        yield data
+                self._append(binsha, type_, size, crc, pieces())
+        return sha
+
+    def _deflate(self, type_, size, chunks, write):
+        """
+        Pass an object, as it goes in a pack, to C{write}, and return
+        its crc32.
+        """
+        # type and size, the size in little-endian groups of 7 bits
+        # after the first 4
+        byte = (_TYPE_CODES[type_] << 4) | (size & 0x0f)
+        rest = size >> 4
+        pieces = []
+        while rest:
+            pieces.append(chr(byte | 0x80))
+            byte = rest & 0x7f
+            rest >>= 7
+        pieces.append(chr(byte))
+        data = ''.join(pieces)
+        crc = zlib.crc32(data)
+        write(data)
+        compress = zlib.compressobj()
+        for data in chunks:
+            data = compress.compress(data)
+            crc = zlib.crc32(data, crc)
+            write(data)
+        data = compress.flush()
+        crc = zlib.crc32(data, crc)
+        write(data)
+        return crc & 0xffffffff
+
+    def _append(self, binsha, type_, size, crc, pieces):
+        """
+        Append an object passed through C{_deflate} to the pack and
+        record it, unless another thread got there first.
+        """
+        with self._lock:
+            if binsha in self._entries:
+                return
+            if self._file is None:
+                self._open()
+            self._file.seek(self._offset)
+            try:
+                for data in pieces:
+                    self._file.write(data)
+            except:
+                # drop what was written
+                self._file.flush()
+                self._file.truncate(self._offset)
+                raise
+            end = self._file.tell()
+            self._entries[binsha] = (self._offset, end, crc, type_, size)
+            self._offset = end
+
+    def info(self, sha):
+        """
+        Return C{(type, size)} of an object added here, or C{None}.
+        """
+        entry = self._entries.get(binascii.unhexlify(sha))
+        if entry is None:
+            return None
+        (offset, end, crc, type_, size) = entry
+        return type_, size
+
+    def read(self, sha):
+        """
+        Return C{(type, data)} of an object added here, or C{None}.
+        """
+        entry = self._entries.get(binascii.unhexlify(sha))
+        if entry is None:
+            return None
+        (offset, end, crc, type_, size) = entry
+        with self._lock:
+            self._file.seek(offset)
+            raw = self._file.read(end - offset)
+        i = 0
+        while ord(raw[i]) & 0x80:
+            i += 1
+        data = zlib.decompress(raw[i+1:])
+        if len(data) != size:
+            raise RuntimeError('bad object size in pack: %s' % sha)
+        return type_, data
+
+    def _write_index(self, f, checksum):
+        binshas = sorted(self._entries)
+        digest = hashlib.sha1()
+        def write(data):
+            digest.update(data)
+            f.write(data)
+        write('\377tOc' + struct.pack('>L', 2))
+        fanout = [0] * 256
+        for binsha in binshas:
+            fanout[ord(binsha[0])] += 1
+        total = 0
+        for i in xrange(256):
+            total += fanout[i]
+            fanout[i] = total
+        write(struct.pack('>256L', *fanout))
+        write(''.join(binshas))
+        write(''.join(
+                struct.pack('>L', self._entries[binsha][2])
+                for binsha in binshas))
+        large = []
+        offsets = []
+        for binsha in binshas:
+            offset = self._entries[binsha][0]
+            if offset >= 0x80000000:
+                offsets.append(struct.pack('>L', 0x80000000 | len(large)))
+                large.append(struct.pack('>Q', offset))
+            else:
+                offsets.append(struct.pack('>L', offset))
+        write(''.join(offsets))
+        write(''.join(large))
+        write(checksum)
+        f.write(digest.digest())
+
+    def finish(self):
+        """
+        Install the pack and its index, making the objects visible.
+
+        Returns the path of the pack without its extension, or
+        C{None} if no objects were added; no empty pack is made.
+        """
+        if not self._entries:
+            self.abort()
+            return None
+        try:
+            f = self._file
+            f.seek(0)
+            f.write(_PACK_HEADER.pack('PACK', 2, len(self._entries)))
+            f.flush()
+            f.seek(0)
+            digest = hashlib.sha1()
+            while True:
+                data = f.read(_CHUNK)
+                if not data:
+                    break
+                digest.update(data)
+            checksum = digest.digest()
+            f.seek(0, 2)
+            f.write(checksum)
+            f.flush()
+            if self.fsync != 'never':
+                os.fsync(f.fileno())
+            f.close()
+            os.chmod(self._tmp, 0444)
+            base = os.path.join(
+                self._pack_dir,
+                'pack-%s' % binascii.hexlify(checksum),
+                )
+            (fd, tmp_idx) = tempfile.mkstemp(
+                prefix='tmp_idx_',
+                dir=self._pack_dir,
+                )
+            try:
+                with os.fdopen(fd, 'wb') as idx:
+                    self._write_index(idx, checksum)
+                    idx.flush()
+                    if self.fsync != 'never':
+                        os.fsync(idx.fileno())
+                os.chmod(tmp_idx, 0444)
+                # readers look for the index, so the pack has to be
+                # there first
+                os.rename(self._tmp, base + '.pack')
+                self._tmp = None
+                os.rename(tmp_idx, base + '.idx')
+            except:
+                try:
+                    os.unlink(tmp_idx)
+                except OSError:
+                    pass
+                raise
+        except:
+            self.abort()
+            raise
+        if self.fsync == 'dir':
+            _fsync_dir(self._pack_dir)
+        self._file = None
+        self._entries = {}
+        return base
+
+    def abort(self):
+        """
+        Throw away everything added.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._tmp is not None:
+            try:
+                os.unlink(self._tmp)
+            except OSError:
+                pass
+            self._tmp = None
+        self._entries = {}
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+def get_database(repo):
+    """
+    Return the shared C{ObjectDatabase} for C{repo}.
+    """
+    with _databases_lock:
+        db = _databases.get(repo)
+        if db is None:
+            db = _databases[repo] = ObjectDatabase(repo)
+        return db
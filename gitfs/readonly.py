@@ -3,7 +3,6 @@ from __future__ import with_statement
 import errno
 import hashlib
 import os
-from cStringIO import StringIO
 
 from filesystem import (
     InsecurePathError,
@@ -11,17 +10,13 @@ from filesystem import (
     CrossDeviceRenameError,
     )
 
+from gitfs import blobfile
+from gitfs import cache
 from gitfs import commands
 
-class ContextManagedFile(object):
-    def __init__(self, data):
-        self.data = data
-
-    def __enter__(self):
-        return StringIO(self.data)
-
-    def __exit__(self, type_, value, traceback):
-        pass
+_TREE_MODE = 040000
+_SYMLINK_MODE = 0120000
+_GITLINK_MODE = 0160000
 
 class ReadOnlyGitFS(WalkMixin):
     """
@@ -95,38 +90,256 @@ class ReadOnlyGitFS(WalkMixin):
     def __exit__(self, type_, value, traceback):
         pass
 
+    def _lookup(self):
+        """
+        Return C{(mode, sha)} of the tree entry at this path, or
+        C{None} if there's nothing there.
+        """
+        tree = cache.object_cache.root(
+            repo=self.repo,
+            rev=self.rev,
+            )
+        if tree is None:
+            return None
+        return cache.object_cache.lookup(
+            repo=self.repo,
+            tree=tree,
+            path=self.path,
+            )
+
     def open(self, mode='r'):
         if mode not in ['r', 'rb']:
             raise IOError(
                 errno.EROFS,
                 os.strerror(errno.EROFS),
                 )
-        # TODO don't read big files fully into RAM
-        data = commands.cat_file(
+        found = self._lookup()
+        if found is None or found[0] in [_TREE_MODE, _GITLINK_MODE]:
+            raise RuntimeError('git cat-file failed')
+        (_, object) = found
+        size = cache.object_cache.size(
+            repo=self.repo,
+            sha=object,
+            )
+        data = None
+        if size <= cache.object_cache.max_object_size:
+            data = cache.object_cache.blob(
+                repo=self.repo,
+                sha=object,
+                )
+        return blobfile.BlobFile(
             repo=self.repo,
-            type_='blob',
-            object='%s:%s' % (self.rev, self.path),
+            object=object,
+            size=size,
+            data=data,
             )
-        return ContextManagedFile(data)
+
+    def read_many(self, paths, stream_threshold=None):
+        """
+        Read many files at once.
+
+        C{paths} is an iterable of paths relative to this directory,
+        or of C{ReadOnlyGitFS} objects in the same repository. Yields
+        C{(path, data)} in the same order, where C{path} is as given
+        and C{data} is the contents, or C{None} if there's no file
+        there.
+
+        Files bigger than C{stream_threshold} bytes (by default, the
+        biggest the object cache will hold) are given as file-like
+        objects instead, readable only until the next pair is asked
+        for.
+
+        All the files are read through one C{git cat-file --batch}
+        process, which is sent the names ahead of reading the
+        answers.
+        """
+        if stream_threshold is None:
+            stream_threshold = cache.object_cache.max_object_size
+        tree = cache.object_cache.root(
+            repo=self.repo,
+            rev=self.rev,
+            )
+        if tree is None:
+            for path in paths:
+                yield (path, None)
+            return
+
+        def requests():
+            for path in paths:
+                if isinstance(path, ReadOnlyGitFS):
+                    full = path.path
+                else:
+                    full = self.join(path).path
+                if isinstance(full, unicode):
+                    full = full.encode('utf-8')
+                yield (path, '%s:%s' % (tree, full))
+
+        for (path, answer) in commands.cat_file_many(
+            repo=self.repo,
+            requests=requests(),
+            ):
+            if answer['type'] != 'blob':
+                yield (path, None)
+            elif answer['size'] > stream_threshold:
+                yield (path, answer['contents'])
+            else:
+                yield (path, answer['contents'].read())
 
     def __iter__(self):
-        for data in commands.ls_tree(
+        found = self._lookup()
+        if found is None or found[0] != _TREE_MODE:
+            return
+        entries = cache.object_cache.tree(
             repo=self.repo,
-            path=self.path,
+            sha=found[1],
+            )
+        for name in entries.paths:
+            if name == '.gitfs-placeholder':
+                # hide the magic
+                continue
+            yield self.child(name)
+
+    def _listing(self, prefix, depth, trees):
+        """
+        Stream the entries below C{prefix} in this directory from a
+        single recursive C{git ls-tree}, as C{(path relative to this
+        directory, level below the prefix, is directory)}, skipping
+        the magic placeholders and anything deeper than C{depth}.
+        """
+        if self._lookup() is None:
+            return
+        own = self.path
+        if isinstance(own, unicode):
+            own = own.encode('utf-8')
+        if isinstance(prefix, unicode):
+            prefix = prefix.encode('utf-8')
+        path = own
+        if prefix:
+            path = os.path.join(own, prefix)
+        if own:
+            own = own + '/'
+        if path:
+            base = path + '/'
+        else:
+            base = ''
+        for record in commands.ls_tree(
+            repo=self.repo,
+            path=path,
             treeish=self.rev,
             children=True,
+            recursive=True,
+            trees=trees,
+            records=True,
             ):
-            if self.path == '':
-                prefix = ''
-            else:
-                prefix = self.path + '/'
-                assert data['path'][:len(prefix)] == prefix
-            relative = data['path'][len(prefix):]
-            if relative == '.gitfs-placeholder':
+            if not record.path.startswith(base):
+                # a tree leading to the prefix
+                continue
+            level = record.path.count('/') - base.count('/') + 1
+            if depth is not None and level > depth:
+                continue
+            if os.path.basename(record.path) == '.gitfs-placeholder':
                 # hide the magic
                 continue
-            yield self.child(relative)
+            yield (record.path[len(own):], level, record.type == 'tree')
 
+    def walk_files(self, prefix=None, depth=None):
+        """
+        Iterate over all the files below this directory.
+
+        C{prefix} limits the walk to a subdirectory given relative to
+        this one; C{depth} limits how many levels to descend, with 1
+        meaning just the immediate children. Entries are read lazily
+        from a single C{git ls-tree} process.
+        """
+        if prefix is None:
+            prefix = ''
+        for (relative, level, isdir) in self._listing(
+            prefix=prefix,
+            depth=depth,
+            trees=False,
+            ):
+            yield self.join(relative)
+
+    def walk(self, topdown=True, prefix=None, depth=None):
+        """
+        Like C{os.walk}, yield C{(directory, subdirectories, files)}
+        for this directory and everything below it.
+
+        C{prefix} and C{depth} are as for C{walk_files}.
+
+        Walking bottom-up reads a single C{git ls-tree} stream, only
+        remembering the directories not yet finished. Walking
+        top-down has to list a directory before anything below it, so
+        it reads one tree at a time through the object cache instead;
+        like C{os.walk}, removing entries from C{subdirectories} stops
+        the walk from descending into them.
+        """
+        if prefix is None:
+            prefix = ''
+        top = self
+        if prefix:
+            top = self.join(prefix)
+        if topdown:
+            found = top._lookup()
+            if found is None or found[0] != _TREE_MODE:
+                yield (top, [], [])
+                return
+            for result in top._walk_trees(tree=found[1], depth=depth):
+                yield result
+            return
+
+        # directories not yet finished, innermost last, as (relative
+        # path, (directory, subdirectories, files))
+        stack = [(prefix, (top, [], []))]
+        for (relative, level, isdir) in self._listing(
+            prefix=prefix,
+            depth=depth,
+            trees=True,
+            ):
+            parent = os.path.dirname(relative)
+            while stack[-1][0] != parent:
+                yield stack.pop()[1]
+            child = self.join(relative)
+            if isdir:
+                stack[-1][1][1].append(child)
+                if depth is None or level < depth:
+                    stack.append((relative, (child, [], [])))
+            else:
+                stack[-1][1][2].append(child)
+        while stack:
+            yield stack.pop()[1]
+
+    def _walk_trees(self, tree, depth):
+        dirs = []
+        files = []
+        trees = {}
+        entries = cache.object_cache.tree(
+            repo=self.repo,
+            sha=tree,
+            )
+        for record in entries:
+            name = record.path
+            if name == '.gitfs-placeholder':
+                # hide the magic
+                continue
+            child = self.child(name)
+            if record.mode == _TREE_MODE:
+                dirs.append(child)
+                trees[name] = record.object
+            else:
+                files.append(child)
+        yield (self, dirs, files)
+        if depth is not None:
+            depth -= 1
+            if depth < 1:
+                return
+        for child in dirs:
+            sha = trees.get(child.name())
+            if sha is None:
+                # added by the caller
+                continue
+            for result in child._walk_trees(tree=sha, depth=depth):
+                yield result
 
     def parent(self):
         head, tail = os.path.split(self.path)
@@ -191,29 +404,14 @@ class ReadOnlyGitFS(WalkMixin):
         self.remove()
 
     def isdir(self):
-        for data in commands.ls_tree(
-            repo=self.repo,
-            path=self.path,
-            treeish=self.rev,
-            children=True,
-            ):
-            return True
-
-        # i have no children, therefore i am not a directory
-        return False
+        found = self._lookup()
+        return found is not None and found[0] == _TREE_MODE
 
     def exists(self):
         if self.path == '':
             # root directory always exists
             return True
-        for data in commands.ls_tree(
-            repo=self.repo,
-            path=self.path,
-            treeish=self.rev,
-            children=False,
-            ):
-            return True
-        return False
+        return self._lookup() is not None
 
     def rmdir(self):
         raise IOError(
@@ -225,16 +423,9 @@ class ReadOnlyGitFS(WalkMixin):
         if self.path == '':
             # root directory is never a link
             return False
-        for data in commands.ls_tree(
-            repo=self.repo,
-            path=self.path,
-            treeish=self.rev,
-            children=False,
-            ):
-            return data['mode'] == '120000'
-
+        found = self._lookup()
         # didn't match anything -> don't even exist
-        return False
+        return found is not None and found[0] == _SYMLINK_MODE
 
     def rename(self, new_path):
         raise IOError(
@@ -243,21 +434,13 @@ class ReadOnlyGitFS(WalkMixin):
             )
 
     def size(self):
-        if self.path == '':
-            object = commands.rev_parse(
-                repo=self.repo,
-                rev='%s^{tree}' % self.rev,
+        found = self._lookup()
+        if found is None:
+            raise OSError(
+                errno.ENOENT,
+                os.strerror(errno.ENOENT),
                 )
-        for data in commands.ls_tree(
-            repo=self.repo,
-            path=self.path,
-            treeish=self.rev,
-            children=False,
-            ):
-            object = data['object']
-            break
-
-        return commands.get_object_size(
+        return cache.object_cache.size(
             repo=self.repo,
-            object=object,
+            sha=found[1],
             )
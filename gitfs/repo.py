@@ -1,6 +1,14 @@
+from __future__ import with_statement
+
+import random
+import sys
+import threading
+import time
+
 from gitfs import commands
 from gitfs import indexfs
 from gitfs import readonly
+from gitfs import tree as tree_
 
 class TransactionRaceLostError(Exception):
     """Transaction lost the race to update the ref."""
@@ -11,8 +19,229 @@ class TransactionRaceLostError(Exception):
     def __str__(self):
         return self.__doc__
 
+class TransactionConflictError(TransactionRaceLostError):
+    """Transaction conflicts with a concurrent change to the ref."""
+
+    # retrying the whole transaction may still succeed, as with any
+    # lost race; paths holds the conflicting paths
+
+    def __init__(self, paths=None):
+        super(TransactionConflictError, self).__init__()
+        if paths is None:
+            paths = []
+        self.paths = paths
+
+
+class CommitFuture(object):
+    """
+    The eventual result of a group commit.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._event.isSet()
+
+    def result(self, timeout=None):
+        """
+        Wait for the commit and return its sha.
+
+        If nothing needed committing, returns the commit the ref
+        already pointed to (C{None} if it didn't exist); re-raises the
+        exception if the commit failed.
+        """
+        self._event.wait(timeout)
+        if not self._event.isSet():
+            raise RuntimeError('group commit timed out')
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def _set_result(self, result):
+        self._result = result
+        self._event.set()
+
+    def _set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._event.set()
+
+class GroupCommitter(object):
+    """
+    Coalesce edits from many writers into shared commits to one ref.
+
+    Writers C{submit} edits as C{{path: (mode, sha)}}, with C{None}
+    removing a path, and get a C{CommitFuture} back right away. A
+    background thread, started when edits arrive and nobody is
+    committing, waits up to C{window} seconds, or until C{max_batch}
+    edit sets are queued, then applies them in submission order on
+    top of the current value of the ref, and makes one commit and one
+    ref update for all of them. It goes on with the next batch until
+    nothing is queued.
+
+    If the ref moves under it, the batch is redone on top of the new
+    value, up to C{retries} times, sleeping a randomized, doubling
+    multiple of C{backoff} seconds in between, as C{Transaction}
+    does. Edits are applied blindly, later ones winning; there is no
+    conflict detection between writers.
+    """
+
+    def __init__(
+        self,
+        repo,
+        ref,
+        window=None,
+        max_batch=None,
+        retries=None,
+        backoff=None,
+        ):
+        self.repo = repo
+        self.ref = ref
+        if window is None:
+            window = 0.01
+        self.window = window
+        if max_batch is None:
+            max_batch = 100
+        self.max_batch = max_batch
+        if retries is None:
+            retries = 10
+        self.retries = retries
+        if backoff is None:
+            backoff = 0.01
+        self.backoff = backoff
+        self._cond = threading.Condition()
+        self._pending = []
+        self._leading = False
+
+    def __repr__(self):
+        return '%s(repo=%r, ref=%r)' % (
+            self.__class__.__name__,
+            self.repo,
+            self.ref,
+            )
+
+    def submit(self, changes):
+        """
+        Queue C{changes} for committing and return a C{CommitFuture}
+        for the commit, without waiting for it.
+        """
+        future = CommitFuture()
+        with self._cond:
+            self._pending.append((changes, future))
+            if self._leading:
+                # may fill the batch being waited for
+                self._cond.notifyAll()
+            else:
+                self._leading = True
+                t = threading.Thread(target=self._lead)
+                t.setDaemon(True)
+                t.start()
+        return future
+
+    def _lead(self):
+        """
+        Commit batches of the queued changes until none are left.
+        """
+        while True:
+            with self._cond:
+                if not self._pending:
+                    self._leading = False
+                    return
+                deadline = time.time() + self.window
+                while len(self._pending) < self.max_batch:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+            try:
+                commit = self._commit([changes for (changes, _) in batch])
+            except:
+                exc_info = sys.exc_info()
+                for (_, future) in batch:
+                    future._set_exc_info(exc_info)
+                del exc_info
+            else:
+                for (_, future) in batch:
+                    future._set_result(commit)
+
+    def _commit(self, batch):
+        attempt = 0
+        while True:
+            head = commands.rev_parse(
+                repo=self.repo.path,
+                rev=self.ref,
+                )
+            parents = []
+            base = None
+            if head is not None:
+                parents.append(head)
+                base = commands.get_object_info(
+                    repo=self.repo.path,
+                    object='%s^{tree}' % head,
+                    )['object']
+            builder = tree_.TreeBuilder(repo=self.repo.path, tree=base)
+            for changes in batch:
+                builder.update(changes)
+            tree = builder.write()
+            if not commands.is_commit_needed(
+                repo=self.repo.path,
+                tree=tree,
+                parents=parents,
+                ):
+                return head
+            commit = commands.commit_tree(
+                repo=self.repo.path,
+                tree=tree,
+                parents=parents,
+                message='pygitfs',
+                committer_name='pygitfs',
+                committer_email='pygitfs@invalid',
+                )
+            try:
+                commands.update_ref(
+                    repo=self.repo.path,
+                    ref=self.ref,
+                    newvalue=commit,
+                    oldvalue=head,
+                    reason='pygitfs group commit',
+                    )
+            except RuntimeError:
+                # somebody outside this group got there first; the
+                # edits are just data, so redo them on top
+                if attempt >= self.retries:
+                    raise TransactionRaceLostError()
+                time.sleep(
+                    self.backoff * (2 ** attempt) * random.uniform(1, 2))
+                attempt += 1
+            else:
+                return commit
 
 class Transaction(object):
+    """
+    Context manager committing changes made to an C{IndexFS} to a ref.
+
+    If someone else updates the ref first, C{TransactionRaceLostError}
+    is raised on exit. If C{retries} is set, the transaction instead
+    merges its changes on top of the new value of the ref and tries
+    again, up to C{retries} times, sleeping a randomized, doubling
+    multiple of C{backoff} seconds in between; only changes that
+    touch the same paths raise C{TransactionConflictError}.
+
+    If C{group} is true, the changes are instead handed to the
+    repository's C{GroupCommitter} for the ref, to be committed
+    together with those of other concurrent transactions; see there
+    for the semantics.
+
+    If C{pack} is true, the objects the transaction creates are
+    written to a single packfile, installed just before committing,
+    instead of as loose objects. C{write_behind} stores closed files
+    in that many background threads; see C{indexfs.WriteBehind}.
+    """
+
     def __init__(self, **kw):
         repo = kw.pop('repo', None)
         if repo is None:
@@ -22,10 +251,21 @@ class Transaction(object):
         if ref is None:
             ref = 'HEAD'
         self.ref = ref
+        retries = kw.pop('retries', None)
+        if retries is None:
+            retries = 0
+        self.retries = retries
+        backoff = kw.pop('backoff', None)
+        if backoff is None:
+            backoff = 0.01
+        self.backoff = backoff
+        self.group = kw.pop('group', None)
         index = kw.pop('index', None)
         self.indexfs = indexfs.TemporaryIndexFS(
             repo=self.repo.path,
             index=index,
+            pack=kw.pop('pack', None),
+            write_behind=kw.pop('write_behind', None),
             )
         super(Transaction, self).__init__(**kw)
 
@@ -50,6 +290,8 @@ class Transaction(object):
         assert not ret, \
             "TemporaryIndexFS must not eat the exception."
         tree = self.indexfs.tree
+        base = self.indexfs.base
+        changes = self.indexfs.entries.changes
         del self.indexfs
         if (type_ is None
             and value is None
@@ -57,6 +299,12 @@ class Transaction(object):
             # no exception -> commit transaction
             assert tree is not None, \
                 "TemporaryIndexFS must write the tree."
+            if (self.group
+                and base is not False):
+                if changes:
+                    committer = self.repo.group_committer(ref=self.ref)
+                    self.commit = committer.submit(changes).result()
+                return
             parents = []
             if self.original is not None:
                 parents.append(self.original)
@@ -66,32 +314,85 @@ class Transaction(object):
                 parents=parents,
                 ):
                 return
-            self.commit = commands.commit_tree(
-                repo=self.repo.path,
-                tree=tree,
-                parents=parents,
-                message='pygitfs',
-                committer_name='pygitfs',
-                committer_email='pygitfs@invalid',
-                )
-            try:
-                commands.update_ref(
+            attempt = 0
+            while True:
+                self.commit = commands.commit_tree(
                     repo=self.repo.path,
-                    ref=self.ref,
-                    newvalue=self.commit,
-                    oldvalue=self.original,
-                    reason='pygitfs transaction commit',
+                    tree=tree,
+                    parents=parents,
+                    message='pygitfs',
+                    committer_name='pygitfs',
+                    committer_email='pygitfs@invalid',
                     )
-            except RuntimeError:
-                # TODO this could be caused by pretty much anything
-                # from OOM to invalid input, but as there's no way to
-                # tell (with current git), we'll just assume it's
-                # always caused by race condition..
-                raise TransactionRaceLostError()
+                try:
+                    commands.update_ref(
+                        repo=self.repo.path,
+                        ref=self.ref,
+                        newvalue=self.commit,
+                        oldvalue=self.original,
+                        reason='pygitfs transaction commit',
+                        )
+                except RuntimeError:
+                    # TODO this could be caused by pretty much
+                    # anything from OOM to invalid input, but as
+                    # there's no way to tell (with current git),
+                    # we'll just assume it's always caused by race
+                    # condition..
+                    if (attempt >= self.retries
+                        or base is False):
+                        raise TransactionRaceLostError()
+                else:
+                    return
+
+                time.sleep(
+                    self.backoff * (2 ** attempt) * random.uniform(1, 2))
+                attempt += 1
+                head = commands.rev_parse(
+                    repo=self.repo.path,
+                    rev=self.ref,
+                    )
+                tree = self._merge(base=base, head=head, changes=changes)
+                self.original = head
+                parents = []
+                if head is not None:
+                    parents.append(head)
+                if not commands.is_commit_needed(
+                    repo=self.repo.path,
+                    tree=tree,
+                    parents=parents,
+                    ):
+                    # someone else already made our changes
+                    return
+
+    def _merge(self, base, head, changes):
+        """
+        Apply C{changes}, made on top of tree C{base}, to commit
+        C{head}; returns the new tree.
+        """
+        if head is None:
+            theirs = None
+        else:
+            theirs = commands.get_object_info(
+                repo=self.repo.path,
+                object='%s^{tree}' % head,
+                )['object']
+        conflicts = tree_.find_conflicts(
+            repo=self.repo.path,
+            base=base,
+            other=theirs,
+            changes=changes,
+            )
+        if conflicts:
+            raise TransactionConflictError(paths=conflicts)
+        builder = tree_.TreeBuilder(repo=self.repo.path, tree=theirs)
+        builder.update(changes)
+        return builder.write()
 
 class Repository(object):
     def __init__(self, path):
         self.path = path
+        self._committers = {}
+        self._committers_lock = threading.Lock()
 
     def __repr__(self):
         return '%s(path=%r)' % (
@@ -99,8 +400,48 @@ class Repository(object):
             self.path,
             )
 
-    def transaction(self, ref=None, index=None):
-        return Transaction(repo=self, ref=ref, index=index)
+    def transaction(
+        self,
+        ref=None,
+        index=None,
+        retries=None,
+        backoff=None,
+        group=None,
+        pack=None,
+        write_behind=None,
+        ):
+        return Transaction(
+            repo=self,
+            ref=ref,
+            index=index,
+            retries=retries,
+            backoff=backoff,
+            group=group,
+            pack=pack,
+            write_behind=write_behind,
+            )
+
+    def group_committer(self, ref=None):
+        """
+        Return the shared C{GroupCommitter} for C{ref}.
+        """
+        if ref is None:
+            ref = 'HEAD'
+        with self._committers_lock:
+            committer = self._committers.get(ref)
+            if committer is None:
+                committer = self._committers[ref] = GroupCommitter(
+                    repo=self,
+                    ref=ref,
+                    )
+            return committer
+
+    def group_commit(self, changes, ref=None):
+        """
+        Commit C{{path: (mode, sha)}} edits together with other
+        concurrent writers; returns a C{CommitFuture} right away.
+        """
+        return self.group_committer(ref=ref).submit(changes)
 
     def readonly(self, ref=None):
         return readonly.ReadOnlyGitFS(repo=self.path, rev=ref)
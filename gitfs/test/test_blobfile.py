@@ -0,0 +1,82 @@
+from __future__ import with_statement
+
+from nose.tools import eq_ as eq
+
+from gitfs.test.util import (
+    maketemp,
+    )
+
+from gitfs import blobfile
+from gitfs import commands
+
+CONTENT = ''.join('line %d\n' % i for i in xrange(100))
+
+def open_blob(backend):
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    sha = commands.write_object(repo=tmp, content=CONTENT)
+    f = blobfile.BlobFile(
+        repo=tmp,
+        object=sha,
+        size=len(CONTENT),
+        backend=backend,
+        )
+    # make sure we cross chunk boundaries
+    f.chunk_size = 7
+    return f
+
+def check_read(backend):
+    with open_blob(backend) as f:
+        eq(f.read(3), CONTENT[:3])
+        eq(f.read(20), CONTENT[3:23])
+        eq(f.read(), CONTENT[23:])
+        eq(f.read(), '')
+        eq(f.tell(), len(CONTENT))
+
+def test_read_git():
+    check_read('git')
+
+def test_read_python():
+    check_read('python')
+
+def check_lines(backend):
+    with open_blob(backend) as f:
+        eq(f.readline(), 'line 0\n')
+        eq(f.readline(3), 'lin')
+        eq(f.readline(), 'e 1\n')
+        eq(list(f), CONTENT.splitlines(True)[2:])
+
+def test_lines_git():
+    check_lines('git')
+
+def test_lines_python():
+    check_lines('python')
+
+def check_seek(backend):
+    with open_blob(backend) as f:
+        f.seek(50)
+        eq(f.read(10), CONTENT[50:60])
+        f.seek(-10, 1)
+        eq(f.read(10), CONTENT[50:60])
+        f.seek(5)
+        eq(f.read(10), CONTENT[5:15])
+        f.seek(-4, 2)
+        eq(f.read(), CONTENT[-4:])
+
+def test_seek_git():
+    check_seek('git')
+
+def test_seek_python():
+    check_seek('python')
+
+def test_close():
+    f = open_blob('git')
+    eq(f.read(1), 'l')
+    f.close()
+    assert f.closed
+    e = None
+    try:
+        f.read()
+    except ValueError, e:
+        pass
+    assert e is not None
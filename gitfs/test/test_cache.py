@@ -0,0 +1,146 @@
+from nose.tools import eq_ as eq
+
+from gitfs.test.util import (
+    maketemp,
+    )
+
+import os
+
+from gitfs import cache
+from gitfs import commands
+from gitfs import readonly
+
+def make_repo(repo):
+    commands.init_bare(repo)
+    commands.fast_import(
+        repo=repo,
+        commits=[
+            dict(
+                message='one',
+                committer='John Doe <jdoe@example.com>',
+                commit_time='1216235872 +0300',
+                files=[
+                    dict(
+                        path='quux/foo',
+                        content='FOO',
+                        ),
+                    dict(
+                        path='big',
+                        content='x' * 100,
+                        ),
+                    ],
+                ),
+            ],
+        )
+
+def test_blob():
+    tmp = maketemp()
+    repo = os.path.join(tmp, 'repo')
+    make_repo(repo)
+    sha = commands.rev_parse(repo=repo, rev='HEAD:quux/foo')
+    c = cache.ObjectCache()
+    eq(c.blob(repo=repo, sha=sha), 'FOO')
+    eq(c.blob(repo=repo, sha=sha), 'FOO')
+    stats = c.stats()
+    eq(stats['hits'], 1)
+    eq(stats['misses'], 1)
+    # the size came along for free
+    eq(c.size(repo=repo, sha=sha), 3)
+    eq(c.stats()['hits'], 2)
+
+def test_tree():
+    tmp = maketemp()
+    repo = os.path.join(tmp, 'repo')
+    make_repo(repo)
+    sha = commands.rev_parse(repo=repo, rev='HEAD^{tree}')
+    c = cache.ObjectCache()
+    got = c.tree(repo=repo, sha=sha)
+    eq(got.paths, ['big', 'quux'])
+    eq(got.get('quux').mode, 040000)
+    eq(
+        got.get('big').object,
+        commands.rev_parse(repo=repo, rev='HEAD:big'),
+        )
+    assert c.tree(repo=repo, sha=sha) is got
+    eq(c.stats()['hits'], 1)
+
+def test_sizes():
+    tmp = maketemp()
+    repo = os.path.join(tmp, 'repo')
+    make_repo(repo)
+    foo = commands.rev_parse(repo=repo, rev='HEAD:quux/foo')
+    big = commands.rev_parse(repo=repo, rev='HEAD:big')
+    c = cache.ObjectCache()
+    c.blob(repo=repo, sha=foo)
+    got = c.sizes(repo=repo, shas=[foo, big, 'deadbeef'*5])
+    eq(got, {foo: 3, big: 100})
+    eq(c.size(repo=repo, sha=big), 100)
+    eq(c.stats()['hits'], 2)
+
+def test_too_big():
+    tmp = maketemp()
+    repo = os.path.join(tmp, 'repo')
+    make_repo(repo)
+    sha = commands.rev_parse(repo=repo, rev='HEAD:big')
+    c = cache.ObjectCache(max_object_size=50)
+    eq(c.blob(repo=repo, sha=sha), 'x' * 100)
+    eq(c.blob(repo=repo, sha=sha), 'x' * 100)
+    eq(c.stats()['hits'], 0)
+    eq(c.stats()['misses'], 2)
+
+def test_evict():
+    tmp = maketemp()
+    repo = os.path.join(tmp, 'repo')
+    make_repo(repo)
+    foo = commands.rev_parse(repo=repo, rev='HEAD:quux/foo')
+    big = commands.rev_parse(repo=repo, rev='HEAD:big')
+    c = cache.ObjectCache(max_bytes=180)
+    c.blob(repo=repo, sha=big)
+    c.blob(repo=repo, sha=foo)
+    # big was used least recently and had to go
+    c.blob(repo=repo, sha=big)
+    eq(c.stats()['hits'], 0)
+    assert c.used <= 180
+    c.blob(repo=repo, sha=big)
+    eq(c.stats()['hits'], 1)
+
+def test_readonly_shares():
+    tmp = maketemp()
+    repo = os.path.join(tmp, 'repo')
+    make_repo(repo)
+    cache.object_cache.clear()
+    ro = readonly.ReadOnlyGitFS(repo=repo)
+    with ro as snap:
+        with snap.child('quux', 'foo').open() as f:
+            eq(f.read(), 'FOO')
+    misses = cache.object_cache.stats()['misses']
+    with ro as snap:
+        for i in range(3):
+            with snap.child('quux', 'foo').open() as f:
+                eq(f.read(), 'FOO')
+    eq(cache.object_cache.stats()['misses'], misses)
+
+def test_lookup():
+    tmp = maketemp()
+    repo = os.path.join(tmp, 'repo')
+    make_repo(repo)
+    tree = commands.rev_parse(repo=repo, rev='HEAD^{tree}')
+    foo = commands.rev_parse(repo=repo, rev='HEAD:quux/foo')
+    c = cache.ObjectCache()
+    eq(c.lookup(repo=repo, tree=tree, path='quux/foo'), (0100644, foo))
+    eq(c.lookup(repo=repo, tree=tree, path=''), (040000, tree))
+    eq(c.lookup(repo=repo, tree=tree, path='quux/nonexistent'), None)
+    eq(c.lookup(repo=repo, tree=tree, path='quux/foo/bar'), None)
+
+def test_root():
+    tmp = maketemp()
+    repo = os.path.join(tmp, 'repo')
+    make_repo(repo)
+    head = commands.rev_parse(repo=repo, rev='HEAD')
+    tree = commands.rev_parse(repo=repo, rev='HEAD^{tree}')
+    c = cache.ObjectCache()
+    eq(c.root(repo=repo, rev='HEAD'), tree)
+    eq(c.root(repo=repo, rev=head), tree)
+    eq(c.root(repo=repo, rev=head), tree)
+    eq(c.stats()['hits'], 1)
+    eq(c.root(repo=repo, rev='refs/heads/nonexistent'), None)
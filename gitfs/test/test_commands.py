@@ -8,6 +8,7 @@ from gitfs.test.util import (
     )
 
 import os
+from cStringIO import StringIO
 
 from gitfs import commands
 
@@ -266,6 +267,132 @@ def test_ls_tree_recursive():
         )
     assert_raises(StopIteration, g.next)
 
+def test_ls_tree_recursive_trees():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    commands.fast_import(
+        repo=tmp,
+        commits=[
+            dict(
+                message='one',
+                committer='John Doe <jdoe@example.com>',
+                commit_time='1216235872 +0300',
+                files=[
+                    dict(
+                        path='quux/thud/foo',
+                        content='FOO',
+                        ),
+                    dict(
+                        path='bar',
+                        content='BAR',
+                        ),
+                    ],
+                ),
+            ],
+        )
+    for backend in ['git', 'python']:
+        got = commands.ls_tree(
+            repo=tmp,
+            recursive=True,
+            trees=True,
+            backend=backend,
+            )
+        eq(
+            [(data['type'], data['path']) for data in got],
+            [
+                ('blob', 'bar'),
+                ('tree', 'quux'),
+                ('tree', 'quux/thud'),
+                ('blob', 'quux/thud/foo'),
+                ],
+            )
+        got = commands.ls_tree(
+            repo=tmp,
+            path='quux/thud',
+            children=True,
+            recursive=True,
+            trees=True,
+            backend=backend,
+            )
+        eq(
+            [(data['type'], data['path']) for data in got],
+            [
+                ('tree', 'quux'),
+                ('tree', 'quux/thud'),
+                ('blob', 'quux/thud/foo'),
+                ],
+            )
+
+def test_ls_tree_records():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    commands.fast_import(
+        repo=tmp,
+        commits=[
+            dict(
+                message='one',
+                committer='John Doe <jdoe@example.com>',
+                commit_time='1216235872 +0300',
+                files=[
+                    dict(
+                        path='quux/foo',
+                        content='FOO',
+                        ),
+                    ],
+                ),
+            ],
+        )
+    for backend in ['git', 'python']:
+        got = list(commands.ls_tree(
+                repo=tmp,
+                recursive=True,
+                records=True,
+                backend=backend,
+                ))
+        eq(
+            got,
+            [commands.TreeRecord.from_hex(
+                    '100644',
+                    'd96c7efbfec2814ae0301ad054dc8d9fc416c9b5',
+                    'quux/foo',
+                    )],
+            )
+        eq(got[0].mode, 0100644)
+        eq(got[0].type, 'blob')
+        eq(got[0].path, 'quux/foo')
+
+class ChunkedFile(object):
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+
+    def read(self, size):
+        size = min(size, self.size)
+        (data, self.data) = (self.data[:size], self.data[size:])
+        return data
+
+def test_read_records():
+    data = '100644 blob %s\tsome/path\x00040000 tree %s\twith \ttab\x00' % (
+        'a'*40,
+        'b'*40,
+        )
+    for size in [1, 7, len(data)]:
+        eq(
+            list(commands._read_records(ChunkedFile(data, size), 'ls-tree')),
+            [
+                ('100644', 'blob', 'a'*40, 'some/path'),
+                ('040000', 'tree', 'b'*40, 'with \ttab'),
+                ],
+            )
+
+def test_read_records_no_nul():
+    g = commands._read_records(
+        ChunkedFile('100644 blob %s\tfoo' % ('a'*40), 8),
+        'ls-tree',
+        )
+    e = assert_raises(RuntimeError, list, g)
+    eq(str(e), 'git ls-tree output did not end in NUL')
+
 def test_cat_file():
     tmp = maketemp()
     commands.init_bare(tmp)
@@ -330,6 +457,183 @@ def test_batch_cat_file_bad_notfound():
 
     g.close()
 
+def test_batch_cat_file_check():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    one = commands.write_object(repo=tmp, content='FOO')
+    g = commands.batch_cat_file(repo=tmp, check=True)
+
+    got = g.send(one)
+    eq(got, dict(object=one, type='blob', size=3))
+
+    got = g.send('HEAD:no such file')
+    eq(got, dict(object='HEAD:no such file', type='missing'))
+
+    g.close()
+
+def test_cat_file_many():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    one = commands.write_object(repo=tmp, content='FOO')
+    two = commands.write_object(repo=tmp, content='BAR')
+    got = []
+    for (key, answer) in commands.cat_file_many(
+        repo=tmp,
+        requests=[
+            (1, one),
+            (2, 'deadbeefdeadbeefdeadbeefdeadbeefdeadbeef'),
+            (3, 'weird\nname'),
+            (4, two),
+            (5, one),
+            ],
+        ):
+        if answer['type'] == 'blob':
+            if key != 5:
+                # leaving some unread must not confuse the next one
+                answer['contents'] = answer['contents'].read()
+            else:
+                del answer['contents']
+        got.append((key, answer))
+    eq(
+        got,
+        [
+            (1, dict(object=one, type='blob', size=3, contents='FOO')),
+            (2, dict(
+                    object='deadbeefdeadbeefdeadbeefdeadbeefdeadbeef',
+                    type='missing',
+                    )),
+            (3, dict(object='weird\nname', type='missing')),
+            (4, dict(object=two, type='blob', size=3, contents='BAR')),
+            (5, dict(object=one, type='blob', size=3)),
+            ],
+        )
+
+def test_cat_file_many_check():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    one = commands.write_object(repo=tmp, content='FOO')
+    got = list(commands.cat_file_many(
+            repo=tmp,
+            requests=[(i, one) for i in xrange(1000)],
+            check=True,
+            ))
+    eq(got, [(i, dict(object=one, type='blob', size=3)) for i in xrange(1000)])
+
+def test_cat_file_many_stop_early():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    one = commands.write_object(repo=tmp, content='FOO' * 10000)
+    g = commands.cat_file_many(
+        repo=tmp,
+        requests=((i, one) for i in xrange(1000)),
+        )
+    (key, answer) = g.next()
+    eq(answer['contents'].read(3), 'FOO')
+    g.close()
+
+def test_batch_cat_file_list():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    one = commands.write_object(repo=tmp, content='FOO')
+    two = commands.write_object(repo=tmp, content='BAR')
+    g = commands.batch_cat_file(repo=tmp)
+    got = g.send([one, 'nonexistent', two])
+    eq(len(got), 3)
+    eq(got[0]['contents'].read(), 'FOO')
+    eq(got[1], dict(object='nonexistent', type='missing'))
+    eq(got[2]['contents'].read(), 'BAR')
+    g.close()
+
+def test_batch_check():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    one = commands.write_object(repo=tmp, content='FOO')
+    for backend in ['git', 'python']:
+        got = commands.batch_check(
+            repo=tmp,
+            objects=[one, 'weird\nname', 'deadbeef'*5] * 600,
+            backend=backend,
+            )
+        eq(
+            got,
+            [
+                dict(object=one, type='blob', size=3),
+                dict(object='weird\nname', type='missing'),
+                dict(object='deadbeef'*5, type='missing'),
+                ] * 600,
+            )
+
+def test_batch_check_long_names():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    one = commands.write_object(repo=tmp, content='FOO')
+    # each name is echoed back, so this is far more than a pipe
+    # buffer in both directions
+    names = ['HEAD:%s/%d' % ('x' * 300, i) for i in xrange(1000)]
+    got = commands.batch_check(
+        repo=tmp,
+        objects=names + [one],
+        backend='git',
+        )
+    eq(got[:-1], [dict(object=name, type='missing') for name in names])
+    eq(got[-1], dict(object=one, type='blob', size=3))
+
+def test_cat_file_pool_reuse():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    one = commands.write_object(repo=tmp, content='FOO')
+    two = commands.write_object(repo=tmp, content='BAR')
+    pool = commands.BatchCatFilePool()
+    got = pool.request(repo=tmp, object=one)
+    eq(got['contents'].read(), 'FOO')
+    eq(len(pool._idle), 1)
+    g = pool._idle[0][3]
+    got = pool.request(repo=tmp, object=two)
+    eq(got['contents'].read(), 'BAR')
+    eq(len(pool._idle), 1)
+    assert pool._idle[0][3] is g
+    pool.close()
+    eq(pool._idle, [])
+
+def test_cat_file_pool_restart():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    one = commands.write_object(repo=tmp, content='FOO')
+    pool = commands.BatchCatFilePool()
+    pool.request(repo=tmp, object=one)
+    # simulate the process dying behind our back
+    pool._idle[0][3].close()
+    got = pool.request(repo=tmp, object=one)
+    eq(got['contents'].read(), 'FOO')
+    eq(len(pool._idle), 1)
+    pool.close()
+
+def test_cat_file_pool_bounded():
+    tmp = maketemp()
+    one = os.path.join(tmp, 'one')
+    two = os.path.join(tmp, 'two')
+    commands.init_bare(one)
+    commands.init_bare(two)
+    sha = commands.write_object(repo=one, content='FOO')
+    commands.write_object(repo=two, content='FOO')
+    pool = commands.BatchCatFilePool(max_processes=1)
+    pool.request(repo=one, object=sha)
+    pool.request(repo=two, object=sha)
+    eq([repo for (_, repo, _, _) in pool._idle], [two])
+    pool.close()
+
+def test_cat_file_pool_idle_timeout():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    sha = commands.write_object(repo=tmp, content='FOO')
+    pool = commands.BatchCatFilePool(idle_timeout=-1)
+    pool.request(repo=tmp, object=sha)
+    g = pool._idle[0][3]
+    pool.request(repo=tmp, object=sha)
+    eq(len(pool._idle), 1)
+    assert pool._idle[0][3] is not g
+    pool.close()
+
 def test_get_object_size():
     tmp = maketemp()
     commands.init_bare(tmp)
@@ -356,6 +660,58 @@ def test_write_object():
     got = commands.write_object(repo=tmp, content='FOO')
     eq(got, 'd96c7efbfec2814ae0301ad054dc8d9fc416c9b5')
 
+def test_write_object_file():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    got = commands.write_object(repo=tmp, content=StringIO('FOO'))
+    eq(got, 'd96c7efbfec2814ae0301ad054dc8d9fc416c9b5')
+
+def test_write_object_path():
+    tmp = maketemp()
+    repo = os.path.join(tmp, 'repo')
+    commands.init_bare(repo)
+    path = os.path.join(tmp, 'foo')
+    f = file(path, 'wb')
+    f.write('FOO')
+    f.close()
+    got = commands.write_object(repo=repo, path=path)
+    eq(got, 'd96c7efbfec2814ae0301ad054dc8d9fc416c9b5')
+    got = commands.cat_file(repo=repo, object=got)
+    eq(got, 'FOO')
+
+def test_write_blobs():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    got = commands.write_blobs(
+        repo=tmp,
+        contents=iter(['FOO', '', 'FOO', 'x' * 100000]),
+        )
+    eq(
+        got[:3],
+        [
+            'd96c7efbfec2814ae0301ad054dc8d9fc416c9b5',
+            'e69de29bb2d1d6434b8b29ae775ad8c2e48c5391',
+            'd96c7efbfec2814ae0301ad054dc8d9fc416c9b5',
+            ],
+        )
+    eq(commands.cat_file(repo=tmp, object=got[0]), 'FOO')
+    eq(commands.cat_file(repo=tmp, object=got[1]), '')
+    eq(commands.cat_file(repo=tmp, object=got[3]), 'x' * 100000)
+
+def test_write_blobs_error():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    def contents():
+        yield 'FOO'
+        raise ValueError('oops')
+    e = assert_raises(
+        ValueError,
+        commands.write_blobs,
+        repo=tmp,
+        contents=contents(),
+        )
+    eq(str(e), 'oops')
+
 def test_read_tree():
     tmp = maketemp()
     repo = os.path.join(tmp, 'repo')
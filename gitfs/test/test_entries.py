@@ -0,0 +1,75 @@
+from nose.tools import eq_ as eq
+
+from gitfs.test.util import (
+    assert_raises,
+    )
+
+from gitfs import entries
+
+def test_record():
+    r = entries.TreeRecord.from_hex(
+        '040000',
+        'd96c7efbfec2814ae0301ad054dc8d9fc416c9b5',
+        'quux',
+        )
+    eq(r.mode, 040000)
+    eq(r.binsha, 'd96c7efbfec2814ae0301ad054dc8d9fc416c9b5'.decode('hex'))
+    eq(r.object, 'd96c7efbfec2814ae0301ad054dc8d9fc416c9b5')
+    eq(r.type, 'tree')
+    eq(
+        r.as_dict(),
+        dict(
+            mode='040000',
+            type='tree',
+            object='d96c7efbfec2814ae0301ad054dc8d9fc416c9b5',
+            path='quux',
+            ),
+        )
+    # no per-instance dict
+    assert_raises(AttributeError, setattr, r, 'other', 1)
+
+def test_index_record():
+    r = entries.IndexRecord.from_hex(
+        '100755',
+        'd96c7efbfec2814ae0301ad054dc8d9fc416c9b5',
+        'bar',
+        )
+    eq(r.type, 'blob')
+    eq(
+        r.as_dict(),
+        dict(
+            mode='100755',
+            object='d96c7efbfec2814ae0301ad054dc8d9fc416c9b5',
+            path='bar',
+            ),
+        )
+
+def test_record_hash():
+    a = entries.TreeRecord.from_hex('100644', '%040x' % 1, 'foo')
+    b = entries.TreeRecord.from_hex('100644', '%040x' % 1, 'foo')
+    c = entries.TreeRecord.from_hex('100644', '%040x' % 2, 'foo')
+    eq(a != b, False)
+    eq(a != c, True)
+    eq(len(set([a, b, c])), 2)
+
+def test_listing():
+    records = [
+        entries.TreeRecord.from_hex('100644', '%040x' % i, 'file%d' % i)
+        for i in xrange(5)
+        ]
+    listing = entries.Listing(records)
+    eq(len(listing), 5)
+    eq(list(listing), records)
+    eq(listing[-1], records[-1])
+    eq(listing[2].object, '%040x' % 2)
+    eq(list(listing.dicts()), [r.as_dict() for r in records])
+    assert_raises(IndexError, listing.__getitem__, 5)
+    eq(listing.get('file3'), records[3])
+    eq(listing.get('nope'), None)
+    listing.add(0100755, records[0].binsha, 'late')
+    eq(listing.get('late'), entries.TreeRecord(
+            0100755,
+            records[0].binsha,
+            'late',
+            ))
+    eq(listing.paths[-1], 'late')
@@ -0,0 +1,226 @@
+from nose.tools import eq_ as eq
+
+from gitfs.test.util import (
+    maketemp,
+    assert_raises,
+    )
+
+import os
+
+from gitfs import commands
+from gitfs import entries
+from gitfs import index
+
+def make_repo(tmp):
+    repo = os.path.join(tmp, 'repo')
+    commands.init_bare(repo)
+    commands.fast_import(
+        repo=repo,
+        commits=[
+            dict(
+                message='one',
+                committer='John Doe <jdoe@example.com>',
+                commit_time='1216235872 +0300',
+                files=[
+                    dict(
+                        path='quux/foo',
+                        content='FOO',
+                        ),
+                    dict(
+                        path='quux.txt',
+                        content='QUUX',
+                        ),
+                    dict(
+                        path='bar',
+                        content='BAR',
+                        mode='100755',
+                        ),
+                    ],
+                ),
+            ],
+        )
+    return repo
+
+def test_read():
+    tmp = maketemp()
+    repo = make_repo(tmp)
+    path = os.path.join(tmp, 'index')
+    commands.read_tree(repo=repo, treeish='HEAD', index=path)
+    i = index.Index(path)
+    eq(len(i), 3)
+    eq([e.path for e in i], ['bar', 'quux.txt', 'quux/foo'])
+    eq(i.get('bar').mode, 0100755)
+    eq(
+        i.get('quux/foo').object,
+        commands.rev_parse(repo=repo, rev='HEAD:quux/foo'),
+        )
+    eq(i.get('quux'), None)
+    eq([e.path for e in i.children('quux')], ['quux/foo'])
+    assert i.isdir('quux')
+    assert not i.isdir('quux.txt')
+    eq(i.listdir(''), ['bar', 'quux.txt', 'quux'])
+    eq(i.listdir('quux'), ['foo'])
+    eq(i.listdir('bar'), None)
+    eq(i.listdir('nonexistent'), None)
+
+def test_read_missing():
+    tmp = maketemp()
+    i = index.Index(os.path.join(tmp, 'index'))
+    eq(len(i), 0)
+    eq(list(i.children('')), [])
+
+def test_roundtrip():
+    tmp = maketemp()
+    repo = make_repo(tmp)
+    path = os.path.join(tmp, 'index')
+    commands.read_tree(repo=repo, treeish='HEAD', index=path)
+    i = index.Index(path)
+    i.write()
+    eq(
+        commands.write_tree(repo=repo, index=path),
+        commands.rev_parse(repo=repo, rev='HEAD^{tree}'),
+        )
+    eq(list(index.Index(path)), list(i))
+
+def test_edit():
+    tmp = maketemp()
+    repo = make_repo(tmp)
+    path = os.path.join(tmp, 'index')
+    commands.read_tree(repo=repo, treeish='HEAD', index=path)
+    i = index.Index(path, autoflush=False)
+    sha = commands.write_object(repo=repo, content='THUD')
+    i.set(path='quux/thud', mode=0100644, object=sha)
+    i.remove('bar')
+    i.remove('nonexistent')
+    assert i.dirty
+    i.sync()
+    assert i.dirty
+    i.flush()
+    assert not i.dirty
+    eq(
+        [(d['path'], d['object']) for d in commands.ls_files(
+                    repo=repo,
+                    index=path,
+                    path='quux',
+                    )],
+        [
+            ('quux/foo',
+             commands.rev_parse(repo=repo, rev='HEAD:quux/foo')),
+            ('quux/thud', sha),
+            ],
+        )
+    eq([e.path for e in index.Index(path)],
+       ['quux.txt', 'quux/foo', 'quux/thud'])
+    assert not os.path.exists(path + '.lock')
+
+def test_set_replaces_in_the_way():
+    tmp = maketemp()
+    repo = make_repo(tmp)
+    path = os.path.join(tmp, 'index')
+    commands.read_tree(repo=repo, treeish='HEAD', index=path)
+    i = index.Index(path, autoflush=False)
+    sha = commands.write_object(repo=repo, content='THUD')
+    # a file where a directory was
+    i.set(path='quux', mode=0100644, object=sha)
+    eq(i.get('quux/foo'), None)
+    assert not i.isdir('quux')
+    # and the other way around
+    i.set(path='quux.txt/thud', mode=0100644, object=sha)
+    eq(i.get('quux.txt'), None)
+    eq(i.listdir('quux.txt'), ['thud'])
+    eq(i.changes, {
+            'quux': (0100644, sha),
+            'quux.txt': None,
+            'quux.txt/thud': (0100644, sha),
+            })
+    i.write()
+    # git takes it
+    tree = commands.write_tree(repo=repo, index=path)
+    eq(
+        sorted(
+            entry['path'] for entry in commands.ls_tree(
+                repo=repo,
+                treeish=tree,
+                recursive=True,
+                )),
+        ['bar', 'quux', 'quux.txt/thud'],
+        )
+
+def test_dirs_follow_edits():
+    tmp = maketemp()
+    i = index.Index(os.path.join(tmp, 'index'))
+    sha = 'deadbeefdeadbeefdeadbeefdeadbeefdeadbeef'
+    i.set(path='a/b/c', mode=0100644, object=sha)
+    i.set(path='a/b/d', mode=0100644, object=sha)
+    i.set(path='a/e', mode=0100644, object=sha)
+    eq(i.listdir(''), ['a'])
+    eq(i.listdir('a'), ['b', 'e'])
+    eq(i.listdir('a/b'), ['c', 'd'])
+    i.remove('a/b/c')
+    eq(i.listdir('a/b'), ['d'])
+    i.remove('a/b/d')
+    eq(i.listdir('a/b'), None)
+    assert not i.isdir('a/b')
+    eq(i.listdir('a'), ['e'])
+    i.remove('a/e')
+    assert not i.isdir('a')
+    eq(i.listdir(''), [])
+
+def test_expand():
+    tmp = maketemp()
+    i = index.Index(os.path.join(tmp, 'index'), autoflush=False)
+    blob = 'deadbeefdeadbeefdeadbeefdeadbeefdeadbeef'
+    tree = 'feedfacefeedfacefeedfacefeedfacefeedface'
+    i.expand('', entries.Listing([
+                entries.TreeRecord.from_hex('040000', tree, 'a'),
+                entries.TreeRecord.from_hex('100644', blob, 'a.txt'),
+                ]))
+    eq(i.changes, {})
+    # sorted like git does, with the subtree as a directory
+    eq(i.listdir(''), ['a.txt', 'a'])
+    assert not i.isdir('a')
+    i.expand('a', [
+            entries.TreeRecord.from_hex('040000', tree, 'b'),
+            entries.TreeRecord.from_hex('100644', blob, 'c'),
+            ])
+    eq(i.changes, {})
+    eq(i.get('a'), None)
+    eq(i.listdir('a'), ['b', 'c'])
+    eq(i.get('a/b').object, tree)
+    eq([e.path for e in i], ['a.txt', 'a/b', 'a/c'])
+
+def test_set_tree_drops_changes_below():
+    tmp = maketemp()
+    i = index.Index(os.path.join(tmp, 'index'), autoflush=False)
+    blob = 'deadbeefdeadbeefdeadbeefdeadbeefdeadbeef'
+    tree = 'feedfacefeedfacefeedfacefeedfacefeedface'
+    i.set(path='a/b', mode=0100644, object=blob)
+    i.set(path='ab', mode=0100644, object=blob)
+    i.remove('a/b')
+    i.set(path='a/c', mode=0100644, object=blob)
+    i.set(path='a', mode=040000, object=tree)
+    eq(i.changes, {
+            'a': (040000, tree),
+            'ab': (0100644, blob),
+            })
+    # and the entries
+    eq([e.path for e in i], ['a', 'ab'])
+    eq(i.get('a/c'), None)
+    eq(i.listdir('a'), None)
+
+def test_set_inside_tree():
+    tmp = maketemp()
+    i = index.Index(os.path.join(tmp, 'index'), autoflush=False)
+    blob = 'deadbeefdeadbeefdeadbeefdeadbeefdeadbeef'
+    tree = 'feedfacefeedfacefeedfacefeedfacefeedface'
+    i.set(path='a', mode=040000, object=tree)
+    e = assert_raises(
+        RuntimeError,
+        i.set,
+        path='a/b/c',
+        mode=0100644,
+        object=blob,
+        )
+    eq(str(e), 'path is inside an unexpanded tree: a/b/c')
+    eq(i.get('a/b/c'), None)
+    i.set(path='ab/c', mode=0100644, object=blob)
@@ -9,6 +9,9 @@ from gitfs.test.util import (
 
 import errno
 import os
+import stat
+import threading
+import time
 
 from gitfs import indexfs
 from gitfs import commands
@@ -142,6 +145,62 @@ def test_set_sha1_mass():
         got = f.read()
     eq(got, 'one')
 
+def test_write_many():
+    tmp = maketemp()
+    repo = os.path.join(tmp, 'repo')
+    index = os.path.join(tmp, 'index')
+    commands.init_bare(repo)
+    root = indexfs.IndexFS(
+        repo=repo,
+        index=index,
+        )
+    with root.child('bar').open('w') as f:
+        f.write('old')
+    root.child('quux').write_many({
+            'foo': 'FOO',
+            'thud/baz': 'BAZ',
+            })
+    root.write_many([('bar', 'BAR')])
+    eq(
+        sorted(root.child('quux')),
+        [root.join('quux/foo'), root.join('quux/thud')],
+        )
+    with root.join('quux/thud/baz').open() as f:
+        eq(f.read(), 'BAZ')
+    with root.child('bar').open() as f:
+        eq(f.read(), 'BAR')
+    eq(
+        root.join('quux/foo').git_get_sha1(),
+        'd96c7efbfec2814ae0301ad054dc8d9fc416c9b5',
+        )
+
+def test_stat_children():
+    tmp = maketemp()
+    repo = os.path.join(tmp, 'repo')
+    index = os.path.join(tmp, 'index')
+    commands.init_bare(repo)
+    root = indexfs.IndexFS(
+        repo=repo,
+        index=index,
+        )
+    root.write_many({
+            'foo': 'FOO',
+            'quux/bar': 'BAR',
+            'thud': 'x' * 42,
+            })
+    got = [
+        (child.path, st.st_mode, st.st_size)
+        for (child, st) in root.stat_children()
+        ]
+    eq(
+        got,
+        [
+            ('foo', 0100644, 3),
+            ('quux', 040777, 0),
+            ('thud', 0100644, 42),
+            ],
+        )
+
 def test_open_readonly():
     tmp = maketemp()
     repo = os.path.join(tmp, 'repo')
@@ -244,3 +303,460 @@ def test_TemporaryIndexFS_rev():
     eq(t.rev, prev)
     tree = commands.rev_parse(repo=tmp, rev='HEAD~1^{tree}')
     eq(t.tree, tree)
+
+def test_open_small_in_memory():
+    tmp = maketemp()
+    repo = os.path.join(tmp, 'repo')
+    index = os.path.join(tmp, 'index')
+    commands.init_bare(repo)
+    root = indexfs.IndexFS(
+        repo=repo,
+        index=index,
+        )
+    with root.child('foo').open('w') as f:
+        f.write('FOO')
+        eq(os.listdir(tmp), ['repo'])
+    with root.child('foo').open('a') as f:
+        f.write('BAR')
+    with root.child('foo').open() as f:
+        eq(f.read(), 'FOOBAR')
+    eq(root.child('foo').open_files, {})
+    eq(sorted(os.listdir(tmp)), ['index', 'repo'])
+
+def test_open_spill():
+    tmp = maketemp()
+    repo = os.path.join(tmp, 'repo')
+    index = os.path.join(tmp, 'index')
+    commands.init_bare(repo)
+    root = indexfs.IndexFS(
+        repo=repo,
+        index=index,
+        spool_threshold=10,
+        )
+    foo = root.child('foo')
+    eq(foo.spool_threshold, 10)
+    with foo.open('w') as f:
+        f.write('x' * 100)
+        eq(len(os.listdir(tmp)), 2)
+    eq(sorted(os.listdir(tmp)), ['index', 'repo'])
+    with foo.open() as f:
+        eq(f.read(), 'x' * 100)
+    eq(sorted(os.listdir(tmp)), ['index', 'repo'])
+    eq(foo.size(), 100)
+
+def test_open_read_no_writers():
+    tmp = maketemp()
+    repo = os.path.join(tmp, 'repo')
+    index = os.path.join(tmp, 'index')
+    commands.init_bare(repo)
+    root = indexfs.IndexFS(
+        repo=repo,
+        index=index,
+        )
+    foo = root.child('foo')
+    with foo.open('w') as f:
+        f.write('FOO')
+    with foo.open() as f:
+        eq(f.name, foo.git_get_sha1())
+        eq(foo.open_files, {})
+        with foo.open('a') as g:
+            g.write('BAR')
+            with foo.open() as h:
+                # shares the contents being written
+                eq(h.read(), 'FOOBAR')
+        # a snapshot
+        eq(f.read(), 'FOO')
+    with foo.open() as f:
+        eq(f.read(), 'FOOBAR')
+
+def test_write_behind():
+    tmp = maketemp()
+    repo = os.path.join(tmp, 'repo')
+    index = os.path.join(tmp, 'index')
+    commands.init_bare(repo)
+    root = indexfs.IndexFS(
+        repo=repo,
+        index=index,
+        write_behind=2,
+        )
+    for i in xrange(20):
+        with root.child('f%d' % i).open('w') as f:
+            f.write('data %d' % i)
+    with root.child('f3').open('w') as f:
+        f.write('again')
+    # looking at the index waits for the stores
+    with root.child('f3').open() as f:
+        eq(f.read(), 'again')
+    eq(len(list(root)), 20)
+    eq(
+        root.child('f7').git_get_sha1(),
+        commands.write_object(repo=repo, content='data 7'),
+        )
+    root.writer.close()
+
+def test_write_behind_error():
+    tmp = maketemp()
+    index = os.path.join(tmp, 'index')
+    root = indexfs.IndexFS(
+        repo=os.path.join(tmp, 'repo'),
+        index=index,
+        )
+    writer = indexfs.WriteBehind(
+        entries=root.entries,
+        workers=2,
+        max_pending=1,
+        )
+    def fail():
+        raise RuntimeError('bad store')
+    writer.submit(path='one', store=lambda: '1'*40)
+    writer.submit(path='two', store=fail)
+    writer.submit(path='three', store=lambda: '3'*40)
+    e = assert_raises(RuntimeError, writer.flush)
+    eq(str(e), 'bad store')
+    eq(root.entries.get('one').object, '1'*40)
+    eq(root.entries.get('two'), None)
+    eq(root.entries.get('three').object, '3'*40)
+    # reported once
+    writer.flush()
+    writer.close()
+
+def test_write_behind_overlaps():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    delay = 0.2
+    store = indexfs.IndexFS._store
+    def slow_store(self, content=None, path=None):
+        time.sleep(delay)
+        return store(self, content=content, path=path)
+    indexfs.IndexFS._store = slow_store
+    try:
+        t = indexfs.TemporaryIndexFS(repo=tmp, write_behind=4)
+        start = time.time()
+        with t as root:
+            for i in xrange(5):
+                with root.child('f%d' % i).open('w') as f:
+                    f.write('data %d' % i)
+            # none of the closes, or opens, waited for a store
+            assert time.time() - start < delay
+        # and the stores ran side by side
+        assert time.time() - start < 5 * delay
+    finally:
+        indexfs.IndexFS._store = store
+    eq(commands.cat_file(repo=tmp, object='%s:f4' % t.tree), 'data 4')
+
+def test_write_behind_backpressure():
+    tmp = maketemp()
+    root = indexfs.IndexFS(
+        repo=os.path.join(tmp, 'repo'),
+        index=os.path.join(tmp, 'index'),
+        )
+    writer = indexfs.WriteBehind(
+        entries=root.entries,
+        workers=1,
+        max_pending=1,
+        )
+    started = threading.Event()
+    release = threading.Event()
+    def store():
+        started.set()
+        release.wait()
+        return '1'*40
+    writer.submit(path='one', store=store)
+    started.wait()
+    # waits for the one worker
+    writer.submit(path='two', store=lambda: '2'*40)
+    t = threading.Thread(
+        target=writer.submit,
+        kwargs=dict(path='three', store=lambda: '3'*40),
+        )
+    t.start()
+    t.join(0.2)
+    # blocked, the queue is full
+    eq(t.isAlive(), True)
+    release.set()
+    t.join()
+    writer.flush()
+    eq(root.entries.get('three').object, '3'*40)
+    writer.close()
+
+def test_write_behind_open_other():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    gate = threading.Event()
+    store = indexfs.IndexFS._store
+    def slow_store(self, content=None, path=None):
+        if content == 'ONE':
+            gate.wait()
+        return store(self, content=content, path=path)
+    indexfs.IndexFS._store = slow_store
+    # let a broken open go on eventually, and fail below
+    timer = threading.Timer(5, gate.set)
+    timer.start()
+    try:
+        t = indexfs.TemporaryIndexFS(repo=tmp, write_behind=2)
+        with t as root:
+            with root.child('one').open('w') as f:
+                f.write('ONE')
+            # none of this waits for storing one
+            with root.child('two').open('w') as f:
+                f.write('TWO')
+            with root.child('two').open() as f:
+                eq(f.read(), 'TWO')
+            with root.child('two').open('a') as f:
+                f.write('!')
+            eq(root.child('two').size(), 4)
+            eq(gate.isSet(), False)
+            gate.set()
+            with root.child('one').open() as f:
+                eq(f.read(), 'ONE')
+    finally:
+        indexfs.IndexFS._store = store
+        timer.cancel()
+        gate.set()
+    eq(commands.cat_file(repo=tmp, object='%s:two' % t.tree), 'TWO!')
+
+def test_temporary_write_behind():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    t = indexfs.TemporaryIndexFS(repo=tmp, write_behind=3)
+    with t as root:
+        for i in xrange(10):
+            with root.child('f%d' % i).open('w') as f:
+                f.write('data %d' % i)
+    eq(t.writer._threads, [])
+    got = dict(
+        (entry['path'], entry['object'])
+        for entry in commands.ls_tree(repo=tmp, treeish=t.tree)
+        )
+    eq(len(got), 10)
+    eq(got['f4'], commands.write_object(repo=tmp, content='data 4'))
+
+def test_no_autoflush():
+    tmp = maketemp()
+    repo = os.path.join(tmp, 'repo')
+    index = os.path.join(tmp, 'index')
+    commands.init_bare(repo)
+    root = indexfs.IndexFS(
+        repo=repo,
+        index=index,
+        autoflush=False,
+        )
+    root.write_many(dict(('f%d' % i, 'data %d' % i) for i in xrange(100)))
+    root.child('d').mkdir()
+    root.child('f1').remove()
+    root.child('f2').rename(root.child('d').child('f2'))
+    eq(os.path.exists(index), False)
+    root.flush()
+    got = [
+        entry['path']
+        for entry in commands.ls_files(repo=repo, index=index)
+        ]
+    eq(len(got), 100)
+    assert 'd/f2' in got
+    assert 'f1' not in got
+
+def test_temporary_no_index_writes():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    t = indexfs.TemporaryIndexFS(repo=tmp)
+    with t as root:
+        for i in xrange(50):
+            with root.child('f%d' % i).open('w') as f:
+                f.write('data %d' % i)
+        root.child('f0').remove()
+        # all the edits are only in memory
+        eq(os.path.exists(t.index), False)
+        eq(len(t.entries.changes), 50)
+    eq(len(list(commands.ls_tree(repo=tmp, treeish=t.tree))), 49)
+
+def make_big(repo):
+    commands.init_bare(repo)
+    files = [
+        dict(
+            path='big/sub%d/file%d' % (i % 5, i),
+            content='data %d' % i,
+            )
+        for i in xrange(100)
+        ]
+    files.append(dict(path='top', content='TOP'))
+    commands.fast_import(
+        repo=repo,
+        commits=[
+            dict(
+                message='one',
+                committer='John Doe <jdoe@example.com>',
+                commit_time='1216235872 +0300',
+                files=files,
+                ),
+            ],
+        )
+
+def test_graft_rename():
+    tmp = maketemp()
+    make_big(tmp)
+    big = commands.rev_parse(repo=tmp, rev='HEAD:big')
+    t = indexfs.TemporaryIndexFS(repo=tmp, rev='HEAD')
+    with t as root:
+        eq(len(t.entries), 2)
+        assert root.child('big').isdir()
+        eq(stat.S_ISDIR(root.child('big').stat().st_mode), True)
+        root.child('big').rename(root.child('moved'))
+        eq(list(root), [root.child('moved'), root.child('top')])
+        # still not expanded
+        eq(len(t.entries), 2)
+        eq(t.entries.changes, {
+                'big': None,
+                'moved': (040000, big),
+                })
+    eq(commands.rev_parse(repo=tmp, rev='%s:moved' % t.tree), big)
+
+def test_graft_copytree_edit():
+    tmp = maketemp()
+    make_big(tmp)
+    big = commands.rev_parse(repo=tmp, rev='HEAD:big')
+    t = indexfs.TemporaryIndexFS(repo=tmp, rev='HEAD')
+    with t as root:
+        root.child('big').copytree(root.child('copy'))
+        with root.join('copy/sub3/file8').open('w') as f:
+            f.write('changed')
+        root.join('copy/sub0/file0').remove()
+        # only the levels leading to the edits were expanded
+        eq(len(t.entries), 2 + 4 + 19 + 19)
+        with root.join('copy/sub1/file1').open() as f:
+            eq(f.read(), 'data 1')
+        eq(root.join('copy/sub2').isdir(), True)
+    eq(commands.rev_parse(repo=tmp, rev='%s:big' % t.tree), big)
+    eq(
+        commands.rev_parse(repo=tmp, rev='%s:copy/sub1' % t.tree),
+        commands.rev_parse(repo=tmp, rev='HEAD:big/sub1'),
+        )
+    eq(commands.cat_file(repo=tmp, object='%s:copy/sub3/file8' % t.tree),
+       'changed')
+    eq(commands.rev_parse(repo=tmp, rev='%s:copy/sub0/file0' % t.tree), None)
+    eq(commands.cat_file(repo=tmp, object='%s:big/sub0/file0' % t.tree),
+       'data 0')
+
+def test_graft_rename_merge():
+    tmp = maketemp()
+    make_big(tmp)
+    t = indexfs.TemporaryIndexFS(repo=tmp, rev='HEAD')
+    with t as root:
+        root.child('other').mkdir()
+        with root.join('other/file').open('w') as f:
+            f.write('OTHER')
+        root.join('big/sub4').rename(root.child('other'))
+        eq(
+            sorted(child.name() for child in root.child('other')),
+            ['file'] + sorted('file%d' % i for i in xrange(4, 100, 5)),
+            )
+    eq(commands.cat_file(repo=tmp, object='%s:other/file' % t.tree),
+       'OTHER')
+    eq(commands.cat_file(repo=tmp, object='%s:other/file9' % t.tree),
+       'data 9')
+    eq(commands.rev_parse(repo=tmp, rev='%s:big/sub4' % t.tree), None)
+
+def test_graft_rename_onto_graft():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    commands.fast_import(
+        repo=tmp,
+        commits=[
+            dict(
+                message='one',
+                committer='John Doe <jdoe@example.com>',
+                commit_time='1216235872 +0300',
+                files=[
+                    dict(
+                        path='a/x',
+                        content='new-x',
+                        ),
+                    dict(
+                        path='b/x',
+                        content='old-x',
+                        ),
+                    dict(
+                        path='b/y',
+                        content='old-y',
+                        ),
+                    ],
+                ),
+            ],
+        )
+    t = indexfs.TemporaryIndexFS(repo=tmp, rev='HEAD')
+    with t as root:
+        root.child('a').rename(root.child('b'))
+        with root.join('b/x').open() as f:
+            eq(f.read(), 'new-x')
+        with root.join('b/y').open() as f:
+            eq(f.read(), 'old-y')
+        eq(root.child('a').exists(), False)
+    eq(commands.cat_file(repo=tmp, object='%s:b/x' % t.tree), 'new-x')
+    eq(commands.cat_file(repo=tmp, object='%s:b/y' % t.tree), 'old-y')
+    eq(commands.rev_parse(repo=tmp, rev='%s:a' % t.tree), None)
+
+def test_graft_rename_nested_merge():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    commands.fast_import(
+        repo=tmp,
+        commits=[
+            dict(
+                message='one',
+                committer='John Doe <jdoe@example.com>',
+                commit_time='1216235872 +0300',
+                files=[
+                    dict(
+                        path='a/sub/deeper/y',
+                        content='y',
+                        ),
+                    dict(
+                        path='a/same/w',
+                        content='w',
+                        ),
+                    dict(
+                        path='b/sub/x',
+                        content='x',
+                        ),
+                    dict(
+                        path='b/sub/deeper/v',
+                        content='v',
+                        ),
+                    dict(
+                        path='b/same/w',
+                        content='w',
+                        ),
+                    dict(
+                        path='b/z',
+                        content='z',
+                        ),
+                    ],
+                ),
+            ],
+        )
+    want = [
+        'b/same/w',
+        'b/sub/deeper/v',
+        'b/sub/deeper/y',
+        'b/sub/x',
+        'b/z',
+        ]
+    t = indexfs.TemporaryIndexFS(repo=tmp, rev='HEAD')
+    with t as root:
+        root.child('a').rename(root.child('b'))
+        eq(root.child('a').exists(), False)
+        for path in want:
+            with root.join(path).open() as f:
+                eq(f.read(), path[-1])
+        eq(
+            [child.path for child in root.join('b/sub')],
+            ['b/sub/deeper', 'b/sub/x'],
+            )
+    got = sorted(
+        entry['path']
+        for entry in commands.ls_tree(
+            repo=tmp,
+            treeish=t.tree,
+            recursive=True,
+            )
+        )
+    eq(got, want)
@@ -0,0 +1,442 @@
+from __future__ import with_statement
+
+from nose.tools import eq_ as eq
+
+from gitfs.test.util import (
+    maketemp,
+    assert_raises,
+    )
+
+import os
+import random
+import subprocess
+
+from gitfs import commands
+from gitfs import objects
+
+def make_history(repo):
+    commands.init_bare(repo)
+    content = ''.join('line %d\n' % i for i in xrange(1000))
+    commands.fast_import(
+        repo=repo,
+        commits=[
+            dict(
+                message='one',
+                committer='John Doe <jdoe@example.com>',
+                commit_time='1216235872 +0300',
+                files=[
+                    dict(
+                        path='quux/foo',
+                        content=content,
+                        ),
+                    dict(
+                        path='bar',
+                        content='BAR',
+                        mode='100755',
+                        ),
+                    ],
+                ),
+            dict(
+                message='two',
+                committer='John Doe <jdoe@example.com>',
+                commit_time='1216235934 +0300',
+                files=[
+                    dict(
+                        path='quux/foo',
+                        content=content + 'more\n',
+                        ),
+                    dict(
+                        path='quux/thud/baz',
+                        content='BAZ',
+                        ),
+                    ],
+                ),
+            ],
+        )
+
+def repack(repo):
+    returncode = subprocess.call(
+        args=[
+            'git',
+            '--git-dir=%s' % repo,
+            'repack',
+            '-a',
+            '-d',
+            '-f',
+            '-q',
+            ],
+        close_fds=True,
+        )
+    assert returncode == 0
+
+def check_same_as_git(repo):
+    db = objects.ObjectDatabase(repo)
+    for rev in [
+        'HEAD',
+        'master',
+        'refs/heads/master',
+        'HEAD^{tree}',
+        'HEAD:quux',
+        'HEAD:quux/foo',
+        'HEAD:quux/thud/baz',
+        ]:
+        sha = db.resolve(rev)
+        eq(sha, commands.rev_parse(repo=repo, rev=rev))
+        type_, data = db.read(sha)
+        eq(data, commands.cat_file(
+                repo=repo,
+                object=sha,
+                type_=type_,
+                backend='git',
+                ))
+        eq(db.info(sha), (type_, len(data)))
+
+def test_loose():
+    tmp = maketemp()
+    make_history(tmp)
+    check_same_as_git(tmp)
+
+def test_packed():
+    tmp = maketemp()
+    make_history(tmp)
+    repack(tmp)
+    check_same_as_git(tmp)
+
+def test_packed_deep_deltas():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    rng = random.Random(42)
+    words = ['w%d' % i for i in xrange(3000)]
+    def line():
+        return ' '.join(rng.choice(words) for i in xrange(8)) + '\n'
+    lines = [line() for i in xrange(2000)]
+    commits = []
+    for n in xrange(30):
+        for i in xrange(40):
+            lines[rng.randrange(len(lines))] = line()
+        commits.append(
+            dict(
+                message='commit %d' % n,
+                committer='John Doe <jdoe@example.com>',
+                commit_time='%d +0300' % (1216235872 + n),
+                files=[
+                    dict(
+                        path='foo',
+                        content=''.join(lines),
+                        ),
+                    ],
+                ),
+            )
+    commands.fast_import(repo=tmp, commits=commits)
+    subprocess.check_call(
+        args=[
+            'git',
+            '--git-dir=%s' % tmp,
+            'repack',
+            '-a',
+            '-d',
+            '-f',
+            '-q',
+            '--depth=50',
+            '--window=50',
+            ],
+        )
+    process = subprocess.Popen(
+        args=[
+            'git',
+            '--git-dir=%s' % tmp,
+            'cat-file',
+            '--batch-check',
+            '--batch-all-objects',
+            ],
+        stdout=subprocess.PIPE,
+        )
+    (out, _) = process.communicate()
+    eq(process.returncode, 0)
+    db = objects.ObjectDatabase(tmp)
+    got = []
+    want = []
+    for line in out.splitlines():
+        (sha, type_, size) = line.split()
+        want.append((sha, type_, int(size)))
+        got.append((sha,) + db.info(sha))
+    eq(len(want), 90)
+    eq(got, want)
+
+def test_resolve_unsupported():
+    tmp = maketemp()
+    make_history(tmp)
+    db = objects.ObjectDatabase(tmp)
+    eq(db.resolve('HEAD~1'), None)
+    eq(db.resolve('HEAD:nonexistent'), None)
+    eq(db.resolve('refs/heads/nonexistent'), None)
+
+def test_ls_tree():
+    tmp = maketemp()
+    make_history(tmp)
+    repack(tmp)
+    for kw in [
+        dict(path='quux'),
+        dict(path='quux', children=True),
+        dict(path='quux', recursive=True),
+        dict(path='quux/thud/baz'),
+        dict(path='bar', children=True),
+        dict(path='nonexistent'),
+        dict(path='quux/thud', treeish='HEAD~1'),
+        ]:
+        eq(
+            list(commands.ls_tree(repo=tmp, backend='python', **kw)),
+            list(commands.ls_tree(repo=tmp, backend='git', **kw)),
+            )
+
+def test_commands_backend():
+    tmp = maketemp()
+    make_history(tmp)
+    got = commands.cat_file(
+        repo=tmp,
+        object='HEAD:bar',
+        backend='python',
+        )
+    eq(got, 'BAR')
+    got = commands.get_object_size(
+        repo=tmp,
+        object='HEAD:bar',
+        backend='python',
+        )
+    eq(got, 3)
+
+def check_stream(repo):
+    db = objects.ObjectDatabase(repo)
+    for rev in ['HEAD:quux/foo', 'HEAD~1:quux/foo', 'HEAD:bar']:
+        sha = commands.rev_parse(repo=repo, rev=rev)
+        type_, size, f = db.stream(sha)
+        eq(type_, 'blob')
+        want = commands.cat_file(repo=repo, object=sha, backend='git')
+        eq(size, len(want))
+        got = []
+        while True:
+            data = f.read(100)
+            if not data:
+                break
+            got.append(data)
+        f.close()
+        eq(''.join(got), want)
+
+def test_stream_loose():
+    tmp = maketemp()
+    make_history(tmp)
+    check_stream(tmp)
+
+def test_stream_packed():
+    tmp = maketemp()
+    make_history(tmp)
+    repack(tmp)
+    check_stream(tmp)
+
+def test_write():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    db = objects.ObjectDatabase(tmp)
+    for content in ['', 'FOO', 'x' * 200000]:
+        for fsync in ['never', 'file', 'dir']:
+            sha = db.write(type_='blob', content=content, fsync=fsync)
+            eq(sha, commands.write_object(
+                    repo=tmp,
+                    content=content,
+                    backend='git',
+                    ))
+            eq(commands.cat_file(repo=tmp, object=sha, backend='git'), content)
+    eq(
+        sorted(name for name in os.listdir(os.path.join(tmp, 'objects'))
+               if name.startswith('tmp_')),
+        [],
+        )
+    subprocess.check_call(
+        args=['git', '--git-dir=%s' % tmp, 'fsck', '--strict', '--no-dangling'],
+        )
+
+def test_write_path():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    path = os.path.join(tmp, 'data')
+    with file(path, 'wb') as f:
+        f.write('line\n' * 50000)
+    db = objects.ObjectDatabase(tmp)
+    sha = db.write(type_='blob', path=path)
+    eq(sha, commands.rev_parse(repo=tmp, rev=sha))
+    eq(commands.cat_file(repo=tmp, object=sha), 'line\n' * 50000)
+
+def test_write_exists():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    db = objects.ObjectDatabase(tmp)
+    sha = db.write(type_='blob', content='FOO')
+    loose = os.path.join(tmp, 'objects', sha[:2], sha[2:])
+    os.chmod(loose, 0644)
+    with file(loose, 'ab') as f:
+        f.write('marker')
+    eq(db.write(type_='blob', content='FOO'), sha)
+    # untouched
+    with file(loose, 'rb') as f:
+        assert f.read().endswith('marker')
+
+def test_write_bad_fsync():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    db = objects.ObjectDatabase(tmp)
+    e = assert_raises(
+        RuntimeError,
+        db.write,
+        type_='blob',
+        content='FOO',
+        fsync='sometimes',
+        )
+    eq(str(e), "unknown fsync policy: 'sometimes'")
+
+def test_write_object_backend():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    sha = commands.write_object(
+        repo=tmp,
+        content='FOO',
+        backend='python',
+        )
+    eq(sha, 'd96c7efbfec2814ae0301ad054dc8d9fc416c9b5')
+    eq(commands.cat_file(repo=tmp, object=sha, backend='git'), 'FOO')
+
+def test_pack_writer():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    existing = commands.write_object(repo=tmp, content='OLD', backend='git')
+    path = os.path.join(tmp, 'data')
+    with file(path, 'wb') as f:
+        f.write('line\n' * 50000)
+    packer = objects.PackWriter(tmp)
+    shas = [
+        packer.add(type_='blob', content=''),
+        packer.add(type_='blob', content='FOO'),
+        packer.add(type_='blob', path=path),
+        packer.add(type_='blob', content='FOO'),
+        packer.add(type_='blob', content='OLD'),
+        ]
+    eq(shas[1], shas[3])
+    eq(shas[4], existing)
+    eq(len(packer), 3)
+    eq(packer.info(shas[1]), ('blob', 3))
+    eq(packer.read(shas[2]), ('blob', 'line\n' * 50000))
+    eq(packer.read(existing), None)
+    base = packer.finish()
+    eq(
+        sorted(os.listdir(os.path.join(tmp, 'objects', 'pack'))),
+        sorted([
+                os.path.basename(base) + '.pack',
+                os.path.basename(base) + '.idx',
+                ]),
+        )
+    subprocess.check_call(
+        args=['git', '--git-dir=%s' % tmp, 'verify-pack', base + '.idx'],
+        )
+    subprocess.check_call(
+        args=['git', '--git-dir=%s' % tmp, 'fsck', '--strict', '--no-dangling'],
+        )
+    eq(commands.cat_file(repo=tmp, object=shas[1], backend='git'), 'FOO')
+    db = objects.ObjectDatabase(tmp)
+    eq(db.read(shas[2]), ('blob', 'line\n' * 50000))
+
+def test_pack_writer_empty():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    packer = objects.PackWriter(tmp)
+    eq(packer.finish(), None)
+    eq(os.listdir(os.path.join(tmp, 'objects', 'pack')), [])
+
+def test_pack_writer_only_existing():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    existing = commands.write_object(repo=tmp, content='OLD', backend='git')
+    path = os.path.join(tmp, 'data')
+    with file(path, 'wb') as f:
+        f.write('OLD')
+    packer = objects.PackWriter(tmp)
+    eq(packer.add(type_='blob', content='OLD'), existing)
+    eq(packer.add(type_='blob', path=path), existing)
+    eq(packer.finish(), None)
+    eq(os.listdir(os.path.join(tmp, 'objects', 'pack')), [])
+
+def test_pack_writer_deflate_unlocked():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    path = os.path.join(tmp, 'data')
+    with file(path, 'wb') as f:
+        f.write('line\n' * 50000)
+    packer = objects.PackWriter(tmp)
+    locked = []
+    deflate = packer._deflate
+    def check(*a, **kw):
+        locked.append(packer._lock.locked())
+        return deflate(*a, **kw)
+    packer._deflate = check
+    foo = packer.add(type_='blob', content='FOO')
+    lines = packer.add(type_='blob', path=path)
+    eq(locked, [False, False])
+    eq(packer.read(foo), ('blob', 'FOO'))
+    eq(packer.read(lines), ('blob', 'line\n' * 50000))
+    base = packer.finish()
+    subprocess.check_call(
+        args=['git', '--git-dir=%s' % tmp, 'verify-pack', base + '.idx'],
+        )
+
+def test_pack_writer_abort():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    packer = objects.PackWriter(tmp)
+    sha = packer.add(type_='blob', content='FOO')
+    packer.abort()
+    eq(os.listdir(os.path.join(tmp, 'objects', 'pack')), [])
+    eq(objects.ObjectDatabase(tmp).has(sha), False)
+
+def test_pack_writer_path_exists():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    existing = commands.write_object(repo=tmp, content='OLD', backend='git')
+    path = os.path.join(tmp, 'data')
+    packer = objects.PackWriter(tmp)
+    shas = []
+    for content in ['FOO', 'FOO', 'OLD', 'BAR']:
+        with file(path, 'wb') as f:
+            f.write(content)
+        shas.append(packer.add(type_='blob', path=path))
+    eq(shas[0], shas[1])
+    eq(shas[2], existing)
+    eq(len(packer), 2)
+    eq(packer.read(existing), None)
+    # what a duplicate writes is taken back out again
+    packer._file.flush()
+    size = os.path.getsize(packer._tmp)
+    eq(packer.add(type_='blob', path=path), shas[3])
+    packer._file.flush()
+    eq(os.path.getsize(packer._tmp), size)
+    base = packer.finish()
+    subprocess.check_call(
+        args=['git', '--git-dir=%s' % tmp, 'verify-pack', base + '.idx'],
+        )
+    eq(commands.cat_file(repo=tmp, object=shas[0], backend='git'), 'FOO')
+    eq(commands.cat_file(repo=tmp, object=shas[3], backend='git'), 'BAR')
+
+def test_write_path_exists():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    path = os.path.join(tmp, 'data')
+    with file(path, 'wb') as f:
+        f.write('FOO')
+    db = objects.ObjectDatabase(tmp)
+    sha = db.write(type_='blob', content='FOO')
+    loose = os.path.join(tmp, 'objects', sha[:2], sha[2:])
+    mtime = os.stat(loose).st_mtime
+    eq(db.write(type_='blob', path=path), sha)
+    eq(os.stat(loose).st_mtime, mtime)
+    eq(
+        [name for name in os.listdir(os.path.join(tmp, 'objects'))
+         if name.startswith('tmp_')],
+        [],
+        )
@@ -105,3 +105,205 @@ def test_enter_no_initial_commit():
         eq(sorted(root), [])
         # well-known empty tree sha
         eq(root.rev, '4b825dc642cb6eb9a060e54bf8d69288fbee4904')
+
+def test_exists_isdir_islink():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    r = repo.Repository(tmp)
+    with r.transaction() as root:
+        with root.child('foo').open('w') as f:
+            f.write('FOO')
+        with root.child('bar').child('baz').open('w') as f:
+            f.write('BAZ')
+    with readonly.ReadOnlyGitFS(
+        repo=tmp,
+        rev='HEAD',
+        ) as root:
+        eq(root.exists(), True)
+        eq(root.isdir(), True)
+        eq(root.child('foo').exists(), True)
+        eq(root.child('foo').isdir(), False)
+        eq(root.child('foo').islink(), False)
+        eq(root.child('bar').isdir(), True)
+        eq(root.child('bar').child('baz').exists(), True)
+        eq(root.child('bar').child('nonexistent').exists(), False)
+        eq(root.child('foo').child('bar').exists(), False)
+        eq(root.child('nonexistent').isdir(), False)
+        eq(root.child('nonexistent').islink(), False)
+
+def test_size():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    r = repo.Repository(tmp)
+    with r.transaction() as root:
+        with root.child('foo').open('w') as f:
+            f.write('FOO')
+    with readonly.ReadOnlyGitFS(
+        repo=tmp,
+        rev='HEAD',
+        ) as root:
+        eq(root.child('foo').size(), 3)
+        e = assert_raises(
+            OSError,
+            root.child('nonexistent').size,
+            )
+        eq(e.errno, errno.ENOENT)
+
+def make_walk_repo(tmp):
+    commands.init_bare(tmp)
+    r = repo.Repository(tmp)
+    with r.transaction() as root:
+        for path in ['foo', 'bar/baz', 'bar/quux/thud', 'bar/quux/xyzzy']:
+            with root.join(path).open('w') as f:
+                f.write(path)
+        root.child('empty').mkdir()
+
+def show_walk(walk):
+    return [
+        (d.path, [x.path for x in dirs], [x.path for x in files])
+        for (d, dirs, files) in walk
+        ]
+
+def test_walk():
+    tmp = maketemp()
+    make_walk_repo(tmp)
+    with readonly.ReadOnlyGitFS(
+        repo=tmp,
+        rev='HEAD',
+        ) as root:
+        eq(
+            show_walk(root.walk()),
+            [
+                ('', ['bar', 'empty'], ['foo']),
+                ('bar', ['bar/quux'], ['bar/baz']),
+                ('bar/quux', [], ['bar/quux/thud', 'bar/quux/xyzzy']),
+                ('empty', [], []),
+                ],
+            )
+
+def test_walk_bottomup():
+    tmp = maketemp()
+    make_walk_repo(tmp)
+    with readonly.ReadOnlyGitFS(
+        repo=tmp,
+        rev='HEAD',
+        ) as root:
+        eq(
+            show_walk(root.walk(topdown=False)),
+            [
+                ('bar/quux', [], ['bar/quux/thud', 'bar/quux/xyzzy']),
+                ('bar', ['bar/quux'], ['bar/baz']),
+                ('empty', [], []),
+                ('', ['bar', 'empty'], ['foo']),
+                ],
+            )
+
+def test_walk_prune():
+    tmp = maketemp()
+    make_walk_repo(tmp)
+    with readonly.ReadOnlyGitFS(
+        repo=tmp,
+        rev='HEAD',
+        ) as root:
+        got = []
+        for (d, dirs, files) in root.walk():
+            got.append(d.path)
+            dirs[:] = [x for x in dirs if x.name() != 'bar']
+        eq(got, ['', 'empty'])
+
+def test_walk_prefix_depth():
+    tmp = maketemp()
+    make_walk_repo(tmp)
+    with readonly.ReadOnlyGitFS(
+        repo=tmp,
+        rev='HEAD',
+        ) as root:
+        for topdown in [True, False]:
+            eq(
+                show_walk(root.walk(topdown=topdown, prefix='bar', depth=1)),
+                [('bar', ['bar/quux'], ['bar/baz'])],
+                )
+            eq(
+                show_walk(root.child('bar').walk(
+                        topdown=topdown,
+                        prefix='quux',
+                        )),
+                [('bar/quux', [], ['bar/quux/thud', 'bar/quux/xyzzy'])],
+                )
+            eq(
+                show_walk(root.child('nonexistent').walk(topdown=topdown)),
+                [('nonexistent', [], [])],
+                )
+
+def test_walk_files():
+    tmp = maketemp()
+    make_walk_repo(tmp)
+    with readonly.ReadOnlyGitFS(
+        repo=tmp,
+        rev='HEAD',
+        ) as root:
+        eq(
+            [p.path for p in root.walk_files()],
+            ['bar/baz', 'bar/quux/thud', 'bar/quux/xyzzy', 'foo'],
+            )
+        eq(
+            [p.path for p in root.walk_files(depth=2)],
+            ['bar/baz', 'foo'],
+            )
+        eq(
+            [p.path for p in root.child('bar').walk_files(prefix='quux')],
+            ['bar/quux/thud', 'bar/quux/xyzzy'],
+            )
+        with root.child('bar').walk_files().next().open() as f:
+            eq(f.read(), 'bar/baz')
+
+def test_read_many():
+    tmp = maketemp()
+    make_walk_repo(tmp)
+    with readonly.ReadOnlyGitFS(
+        repo=tmp,
+        rev='HEAD',
+        ) as root:
+        bar = root.child('bar')
+        got = list(bar.read_many([
+                    'baz',
+                    root.join('bar/quux/thud'),
+                    'nonexistent',
+                    'quux',
+                    u'quux/xyzzy',
+                    ]))
+        eq(
+            got,
+            [
+                ('baz', 'bar/baz'),
+                (root.join('bar/quux/thud'), 'bar/quux/thud'),
+                ('nonexistent', None),
+                ('quux', None),
+                (u'quux/xyzzy', 'bar/quux/xyzzy'),
+                ],
+            )
+
+def test_read_many_stream():
+    tmp = maketemp()
+    make_walk_repo(tmp)
+    with readonly.ReadOnlyGitFS(
+        repo=tmp,
+        rev='HEAD',
+        ) as root:
+        for (path, data) in root.read_many(
+            ['foo', 'bar/baz'],
+            stream_threshold=3,
+            ):
+            if path == 'foo':
+                eq(data, 'foo')
+            else:
+                eq(data.read(), 'bar/baz')
+
+def test_read_many_no_initial_commit():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    with readonly.ReadOnlyGitFS(
+        repo=tmp,
+        rev='HEAD',
+        ) as root:
+        eq(list(root.read_many(['foo'])), [('foo', None)])
@@ -9,6 +9,8 @@ from gitfs.test.util import (
     )
 
 import os
+import threading
+import time
 
 from gitfs import indexfs
 from gitfs import repo
@@ -247,3 +249,247 @@ def test_no_empty_commits_initial():
         rev='HEAD',
         )
     eq(got, None)
+
+def test_commit_race_merge():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    commands.fast_import(
+        repo=tmp,
+        commits=[
+            dict(
+                message='one',
+                committer='John Doe <jdoe@example.com>',
+                commit_time='1216235872 +0300',
+                files=[
+                    dict(
+                        path='quux/foo',
+                        content='FOO',
+                        ),
+                    dict(
+                        path='bar',
+                        content='BAR',
+                        ),
+                    ],
+                ),
+            ],
+        )
+
+    r = repo.Repository(path=tmp)
+    with r.transaction(retries=1, backoff=0) as p:
+        with r.transaction() as p2:
+            with p2.child('quux').child('foo').open('w') as f:
+                f.write('racer')
+        racer = commands.rev_parse(repo=tmp, rev='HEAD')
+        with p.child('bar').open('w') as f:
+            f.write('winner')
+
+    eq(commands.rev_parse(repo=tmp, rev='HEAD^'), racer)
+    got = commands.cat_file(repo=tmp, object='HEAD:quux/foo')
+    eq(got, 'racer')
+    got = commands.cat_file(repo=tmp, object='HEAD:bar')
+    eq(got, 'winner')
+
+def test_commit_race_conflict():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    commands.fast_import(
+        repo=tmp,
+        commits=[
+            dict(
+                message='one',
+                committer='John Doe <jdoe@example.com>',
+                commit_time='1216235872 +0300',
+                files=[
+                    dict(
+                        path='bar',
+                        content='BAR',
+                        ),
+                    ],
+                ),
+            ],
+        )
+
+    r = repo.Repository(path=tmp)
+    try:
+        with r.transaction(retries=3, backoff=0) as p:
+            with r.transaction() as p2:
+                with p2.child('bar').open('w') as f:
+                    f.write('racer')
+            with p.child('bar').open('w') as f:
+                f.write('loser')
+    except repo.TransactionConflictError, e:
+        eq(e.paths, ['bar'])
+        assert isinstance(e, repo.TransactionRaceLostError)
+    else:
+        raise AssertionError('expected a conflict')
+
+    got = commands.cat_file(repo=tmp, object='HEAD:bar')
+    eq(got, 'racer')
+
+def test_group_commit():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    r = repo.Repository(path=tmp)
+    committer = r.group_committer()
+    committer.window = 0.5
+    shas = [
+        commands.write_object(repo=tmp, content='%d' % i)
+        for i in xrange(10)
+        ]
+    futures = []
+    def writer(i):
+        futures.append(r.group_commit(
+                changes={'file%d' % i: (0100644, shas[i])},
+                ))
+    threads = [
+        threading.Thread(target=writer, args=(i,))
+        for i in xrange(10)
+        ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    commits = set(future.result() for future in futures)
+    head = commands.rev_parse(repo=tmp, rev='HEAD')
+    assert head in commits
+    assert len(commits) < 10
+    eq(len(list(commands.rev_list(repo=tmp))), len(commits))
+    for i in xrange(10):
+        got = commands.cat_file(repo=tmp, object='HEAD:file%d' % i)
+        eq(got, '%d' % i)
+
+def test_group_commit_async():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    r = repo.Repository(path=tmp)
+    committer = repo.GroupCommitter(
+        repo=r,
+        ref='HEAD',
+        window=0,
+        max_batch=1,
+        )
+    release = threading.Event()
+    calls = []
+    def commit(batch):
+        release.wait()
+        calls.append(batch)
+        return 'commit%d' % len(calls)
+    committer._commit = commit
+    one = committer.submit({'one': None})
+    two = committer.submit({'two': None})
+    # submitting didn't wait for the commits
+    eq(one.done(), False)
+    eq(two.done(), False)
+    release.set()
+    eq(one.result(), 'commit1')
+    eq(two.result(), 'commit2')
+    eq(calls, [[{'one': None}], [{'two': None}]])
+    # the background leader is gone, and comes back for more
+    while committer._leading:
+        time.sleep(0.01)
+    eq(committer.submit({'three': None}).result(), 'commit3')
+
+def test_group_commit_backoff():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    r = repo.Repository(path=tmp)
+    committer = repo.GroupCommitter(
+        repo=r,
+        ref='HEAD',
+        window=0,
+        retries=2,
+        backoff=0.05,
+        )
+    sha = commands.write_object(repo=tmp, content='FOO')
+    update_ref = commands.update_ref
+    attempts = []
+    def lose(**kw):
+        attempts.append(time.time())
+        if len(attempts) <= 2:
+            raise RuntimeError('git update-ref failed')
+        return update_ref(**kw)
+    commands.update_ref = lose
+    try:
+        commit = committer.submit({'foo': (0100644, sha)}).result()
+    finally:
+        commands.update_ref = update_ref
+    eq(len(attempts), 3)
+    # slept a randomized, doubling backoff in between
+    assert attempts[1] - attempts[0] >= 0.05
+    assert attempts[2] - attempts[1] >= 0.1
+    eq(commands.rev_parse(repo=tmp, rev='HEAD'), commit)
+    eq(commands.cat_file(repo=tmp, object='HEAD:foo'), 'FOO')
+
+def test_group_transaction():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    r = repo.Repository(path=tmp)
+    with r.transaction(group=True) as p:
+        with p.child('bar').open('w') as f:
+            f.write('BAR')
+    got = commands.cat_file(repo=tmp, object='HEAD:bar')
+    eq(got, 'BAR')
+    head = commands.rev_parse(repo=tmp, rev='HEAD')
+    with r.transaction(group=True) as p:
+        pass
+    eq(commands.rev_parse(repo=tmp, rev='HEAD'), head)
+
+def _loose(path):
+    objects = os.path.join(path, 'objects')
+    return sorted(
+        name for name in os.listdir(objects)
+        if len(name) == 2
+        )
+
+def test_transaction_pack():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    r = repo.Repository(path=tmp)
+    with r.transaction(pack=True) as p:
+        with p.child('foo').open('w') as f:
+            f.write('FOO')
+        p.child('quux').mkdir()
+        with p.child('quux').child('bar').open('w') as f:
+            f.write('BAR')
+        # readable before the pack is installed
+        with p.child('foo').open() as f:
+            eq(f.read(), 'FOO')
+        eq(p.child('quux').child('bar').size(), 3)
+        eq(
+            [name for name in os.listdir(os.path.join(tmp, 'objects', 'pack'))
+             if name.startswith('pack-')],
+            [],
+            )
+    # only the commit itself is written loose
+    head = commands.rev_parse(repo=tmp, rev='HEAD')
+    eq(_loose(tmp), [head[:2]])
+    packs = os.listdir(os.path.join(tmp, 'objects', 'pack'))
+    eq(len(packs), 2)
+    eq(commands.cat_file(repo=tmp, object='HEAD:quux/bar'), 'BAR')
+    eq(commands.cat_file(repo=tmp, object='HEAD:foo'), 'FOO')
+
+def test_transaction_pack_abort():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    r = repo.Repository(path=tmp)
+    try:
+        with r.transaction(pack=True) as p:
+            with p.child('foo').open('w') as f:
+                f.write('FOO')
+            raise RuntimeError('bad')
+    except RuntimeError:
+        pass
+    eq(_loose(tmp), [])
+    eq(os.listdir(os.path.join(tmp, 'objects', 'pack')), [])
+    eq(commands.rev_parse(repo=tmp, rev='HEAD'), None)
+
+def test_transaction_write_behind():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    r = repo.Repository(path=tmp)
+    with r.transaction(pack=True, write_behind=2) as p:
+        for i in xrange(10):
+            with p.child('f%d' % i).open('w') as f:
+                f.write('data %d' % i)
+    eq(commands.cat_file(repo=tmp, object='HEAD:f9'), 'data 9')
+    eq(len(os.listdir(os.path.join(tmp, 'objects', 'pack'))), 2)
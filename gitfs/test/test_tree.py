@@ -0,0 +1,148 @@
+from nose.tools import eq_ as eq
+
+from gitfs.test.util import (
+    maketemp,
+    )
+
+import os
+
+from gitfs import commands
+from gitfs import tree
+
+def make_repo(repo):
+    commands.init_bare(repo)
+    commands.fast_import(
+        repo=repo,
+        commits=[
+            dict(
+                message='one',
+                committer='John Doe <jdoe@example.com>',
+                commit_time='1216235872 +0300',
+                files=[
+                    dict(
+                        path='quux/foo',
+                        content='FOO',
+                        ),
+                    dict(
+                        path='quux/thud/baz',
+                        content='BAZ',
+                        ),
+                    dict(
+                        path='quux.txt',
+                        content='QUUX',
+                        ),
+                    dict(
+                        path='bar',
+                        content='BAR',
+                        mode='100755',
+                        ),
+                    ],
+                ),
+            ],
+        )
+
+def write_with_index(repo, index, changes):
+    commands.read_tree(repo=repo, treeish='HEAD', index=index)
+    files = []
+    for path, change in sorted(changes.items()):
+        if change is None:
+            files.append(dict(mode='0', object=40*'0', path=path))
+        else:
+            mode, object = change
+            files.append(dict(mode='%o' % mode, object=object, path=path))
+    commands.update_index(repo=repo, index=index, files=files)
+    return commands.write_tree(repo=repo, index=index)
+
+def test_no_changes():
+    tmp = maketemp()
+    make_repo(tmp)
+    base = commands.rev_parse(repo=tmp, rev='HEAD^{tree}')
+    builder = tree.TreeBuilder(repo=tmp, tree=base)
+    eq(builder.write(), base)
+
+def test_edits():
+    tmp = maketemp()
+    repo = os.path.join(tmp, 'repo')
+    make_repo(repo)
+    sha = commands.write_object(repo=repo, content='THUD')
+    changes = {
+        'quux/thud/new': (0100644, sha),
+        'quux/foo': None,
+        'bar': (0100755, sha),
+        'a/b/c': (0100644, sha),
+        'nonexistent': None,
+        }
+    builder = tree.TreeBuilder(
+        repo=repo,
+        tree=commands.rev_parse(repo=repo, rev='HEAD^{tree}'),
+        )
+    builder.update(changes)
+    eq(
+        builder.write(),
+        write_with_index(repo, os.path.join(tmp, 'index'), changes),
+        )
+
+def test_remove_last():
+    tmp = maketemp()
+    repo = os.path.join(tmp, 'repo')
+    make_repo(repo)
+    changes = {
+        'quux/thud/baz': None,
+        }
+    builder = tree.TreeBuilder(
+        repo=repo,
+        tree=commands.rev_parse(repo=repo, rev='HEAD^{tree}'),
+        )
+    builder.update(changes)
+    got = builder.write()
+    eq(got, write_with_index(repo, os.path.join(tmp, 'index'), changes))
+    eq(
+        [d['path'] for d in commands.ls_tree(
+                    repo=repo,
+                    treeish=got,
+                    path='quux',
+                    children=True,
+                    )],
+        ['quux/foo'],
+        )
+
+def test_empty():
+    tmp = maketemp()
+    commands.init_bare(tmp)
+    builder = tree.TreeBuilder(repo=tmp)
+    eq(builder.write(), '4b825dc642cb6eb9a060e54bf8d69288fbee4904')
+    sha = commands.write_object(repo=tmp, content='FOO')
+    builder.set(path='foo', mode=0100644, object=sha)
+    want = commands.write_object(
+        repo=tmp,
+        content='100644 foo\0%s' % sha.decode('hex'),
+        type_='tree',
+        )
+    eq(builder.write(), want)
+
+def test_find_conflicts():
+    tmp = maketemp()
+    make_repo(tmp)
+    base = commands.rev_parse(repo=tmp, rev='HEAD^{tree}')
+    sha = commands.write_object(repo=tmp, content='THUD')
+    other = tree.TreeBuilder(repo=tmp, tree=base)
+    other.update({
+            'bar': (0100644, sha),
+            'quux/thud': (0100644, sha),
+            'quux.txt': None,
+            })
+    other = other.write()
+    got = tree.find_conflicts(
+        repo=tmp,
+        base=base,
+        other=other,
+        changes={
+            # same change on both sides
+            'bar': (0100644, sha),
+            # other side turned the directory into a file
+            'quux/thud/new': (0100644, sha),
+            'quux.txt': (0100644, sha),
+            'quux/foo': None,
+            },
+        )
+    eq(got, ['quux.txt', 'quux/thud/new'])
@@ -0,0 +1,74 @@
+from __future__ import with_statement
+
+from nose.tools import eq_ as eq
+
+from gitfs.test.util import (
+    maketemp,
+    assert_raises,
+    )
+
+import errno
+import os
+
+from gitfs import workfile
+
+def make_file(buffer, mode, closed=None):
+    if closed is None:
+        closed = []
+    return workfile.WorkFile(
+        buffer=buffer,
+        mode=mode,
+        callback=closed.append,
+        )
+
+def test_shared():
+    tmp = maketemp()
+    buffer = workfile.WorkBuffer(
+        path=os.path.join(tmp, 'work'),
+        threshold=100,
+        data='one\ntwo\n',
+        )
+    closed = []
+    r = make_file(buffer, 'r', closed)
+    a = make_file(buffer, 'a', closed)
+    eq(r.readline(), 'one\n')
+    a.write('three\n')
+    eq(a.tell(), 14)
+    eq(list(r), ['two\n', 'three\n'])
+    r.seek(-2, 2)
+    eq(r.read(), 'e\n')
+    e = assert_raises(IOError, r.write, 'x')
+    eq(e.errno, errno.EBADF)
+    w = make_file(buffer, 'w', closed)
+    eq(buffer.size(), 0)
+    w.close()
+    w.close()
+    eq(closed, [w])
+    assert_raises(ValueError, w.write, 'x')
+    eq(buffer.getvalue(), '')
+    eq(os.listdir(tmp), [])
+
+def test_spill():
+    tmp = maketemp()
+    path = os.path.join(tmp, 'work')
+    buffer = workfile.WorkBuffer(path=path, threshold=10)
+    f = make_file(buffer, 'w+')
+    f.write('12345')
+    eq(buffer.spilled, False)
+    eq(os.listdir(tmp), [])
+    f.write('67890X')
+    eq(buffer.spilled, True)
+    f.flush()
+    with file(path) as g:
+        eq(g.read(), '1234567890X')
+    f.seek(2)
+    f.truncate()
+    f.seek(0)
+    eq(f.read(), '12')
+
+def test_spill_initial():
+    tmp = maketemp()
+    path = os.path.join(tmp, 'work')
+    buffer = workfile.WorkBuffer(path=path, threshold=2, data='FOO')
+    eq(buffer.spilled, True)
+    eq(make_file(buffer, 'r').read(), 'FOO')
@@ -0,0 +1,238 @@
+"""
+Build new trees by editing old ones, without an index.
+
+Only the trees on the paths leading to edited entries are read and
+rewritten; every other subtree keeps its sha.
+"""
+
+import binascii
+
+from gitfs import cache
+from gitfs import commands
+
+_TREE_MODE = 040000
+
+def format_tree(entries):
+    """
+    Serialize C{{name: (mode, binary sha)}} into a raw tree object.
+    """
+    def key(name):
+        # git sorts trees as if their names ended in a slash
+        if entries[name][0] == _TREE_MODE:
+            return name + '/'
+        return name
+    pieces = []
+    for name in sorted(entries, key=key):
+        mode, sha = entries[name]
+        pieces.append('%o %s\0%s' % (mode, name, sha))
+    return ''.join(pieces)
+
+class TreeReader(object):
+    """
+    Look up paths in trees, remembering every tree it has parsed.
+    """
+
+    def __init__(self, repo):
+        self.repo = repo
+        self._trees = {}
+
+    def entries(self, sha):
+        """
+        Return the entries of a tree as a C{entries.Listing}.
+        """
+        entries = self._trees.get(sha)
+        if entries is None:
+            entries = cache.object_cache.tree(repo=self.repo, sha=sha)
+            self._trees[sha] = entries
+        return entries
+
+    def lookup(self, tree, path):
+        """
+        Return C{(mode, sha)} for C{path} in C{tree}, or C{None}.
+
+        C{tree} may be C{None}, meaning the empty tree.
+        """
+        found = (_TREE_MODE, tree)
+        for name in path.split('/'):
+            if found[1] is None or found[0] != _TREE_MODE:
+                return None
+            record = self.entries(found[1]).get(name)
+            if record is None:
+                return None
+            found = (record.mode, record.object)
+        return found
+
+def find_conflicts(repo, base, other, changes):
+    """
+    Find the C{changes} made on top of tree C{base} that clash with
+    the changes made to reach tree C{other}.
+
+    A path conflicts if both sides changed it differently, or if the
+    other side replaced a directory leading to it with something that
+    isn't a directory. Returns the conflicting paths, sorted.
+    """
+    reader = TreeReader(repo)
+    conflicts = []
+    for path in sorted(changes):
+        ours = changes[path]
+        theirs = reader.lookup(other, path)
+        if theirs == ours:
+            # both made the same change
+            continue
+        if theirs != reader.lookup(base, path):
+            conflicts.append(path)
+            continue
+        segments = path.split('/')
+        for i in xrange(1, len(segments)):
+            parent = '/'.join(segments[:i])
+            theirs = reader.lookup(other, parent)
+            if (theirs is not None
+                and theirs[0] != _TREE_MODE
+                and theirs != reader.lookup(base, parent)):
+                conflicts.append(path)
+                break
+    return conflicts
+
+class _Dir(object):
+    def __init__(self, sha):
+        # sha of the unmodified tree, or None for a new directory
+        self.sha = sha
+        # name -> (mode, binary sha); None until loaded from the old
+        # tree
+        self.entries = None
+        # name -> _Dir, for subdirectories that have been edited
+        self.subdirs = {}
+
+    def load(self, reader):
+        if self.entries is not None:
+            return
+        if self.sha is None:
+            self.entries = {}
+        else:
+            self.entries = dict(
+                (record.path, (record.mode, record.binsha))
+                for record in reader.entries(self.sha)
+                )
+
+class TreeBuilder(object):
+    """
+    Apply path edits to a tree and write out the result.
+
+    C{tree} is the sha of the tree to start from, or C{None} to start
+    from an empty tree. New trees go to C{pack}, an
+    C{objects.PackWriter}, if given.
+    """
+
+    def __init__(self, repo, tree=None, pack=None):
+        self.repo = repo
+        self.tree = tree
+        self.pack = pack
+        self._root = _Dir(sha=tree)
+        self._reader = TreeReader(repo)
+
+    def __repr__(self):
+        return '%s(repo=%r, tree=%r)' % (
+            self.__class__.__name__,
+            self.repo,
+            self.tree,
+            )
+
+    def _walk(self, path, create):
+        """
+        Return the directory containing C{path} and the last segment.
+
+        Directories on the way are marked modified. If C{create} is
+        false and a directory does not exist, returns C{(None,
+        None)}.
+        """
+        segments = path.split('/')
+        node = self._root
+        for name in segments[:-1]:
+            node.load(self._reader)
+            child = node.subdirs.get(name)
+            if child is None:
+                old = node.entries.get(name)
+                if old is not None and old[0] == _TREE_MODE:
+                    child = _Dir(sha=binascii.hexlify(old[1]))
+                elif create:
+                    # missing, or a file in the way
+                    child = _Dir(sha=None)
+                else:
+                    return None, None
+                node.subdirs[name] = child
+            node = child
+        node.load(self._reader)
+        return node, segments[-1]
+
+    def set(self, path, mode, object):
+        """
+        Make C{path} an entry with the given mode (an int) and sha.
+        """
+        assert path
+        assert not path.startswith('/')
+        assert not path.endswith('/')
+        node, name = self._walk(path, create=True)
+        if mode == _TREE_MODE:
+            # grafting a whole subtree
+            node.subdirs[name] = _Dir(sha=object)
+        else:
+            node.subdirs.pop(name, None)
+        node.entries[name] = (mode, binascii.unhexlify(object))
+
+    def remove(self, path):
+        """
+        Remove C{path}, and everything below it, if it exists.
+        """
+        node, name = self._walk(path, create=False)
+        if node is None:
+            return
+        node.subdirs.pop(name, None)
+        node.entries.pop(name, None)
+
+    def update(self, changes):
+        """
+        Apply C{{path: (mode, sha)}} edits; C{None} removes the path.
+        """
+        for path in sorted(changes):
+            change = changes[path]
+            if change is None:
+                self.remove(path)
+            else:
+                (mode, object) = change
+                self.set(path=path, mode=mode, object=object)
+
+    def _write(self, node):
+        if node.entries is None:
+            # never touched
+            return node.sha
+        for name, child in node.subdirs.iteritems():
+            sha = self._write(child)
+            if sha is None:
+                # git trees can't hold empty directories
+                node.entries.pop(name, None)
+            else:
+                node.entries[name] = (_TREE_MODE, binascii.unhexlify(sha))
+        node.subdirs = {}
+        if not node.entries:
+            node.sha = None
+        else:
+            node.sha = self._store(format_tree(node.entries))
+        return node.sha
+
+    def _store(self, content):
+        if self.pack is not None:
+            return self.pack.add(type_='tree', content=content)
+        return commands.write_object(
+            repo=self.repo,
+            content=content,
+            type_='tree',
+            )
+
+    def write(self):
+        """
+        Write all modified trees and return the sha of the root tree.
+        """
+        sha = self._write(self._root)
+        if sha is None:
+            sha = self._store('')
+        return sha
@@ -0,0 +1,210 @@
+from __future__ import with_statement
+
+import cStringIO
+import errno
+import os
+import threading
+
+class WorkBuffer(object):
+    """
+    Contents of a file being edited, shared by all its users.
+
+    The contents are kept in memory until they grow past
+    C{threshold} bytes, after which they are moved to the file at
+    C{path} and edited there.
+    """
+
+    def __init__(self, path, threshold, data=None):
+        self.path = path
+        self.threshold = threshold
+        self.spilled = False
+        self._lock = threading.Lock()
+        self._file = cStringIO.StringIO()
+        if data:
+            self._file.write(data)
+            if len(data) > threshold:
+                self._spill()
+
+    def __repr__(self):
+        return '%s(path=%r)' % (
+            self.__class__.__name__,
+            self.path,
+            )
+
+    def _spill(self):
+        data = self._file.getvalue()
+        f = file(self.path, 'w+b')
+        f.write(data)
+        self._file = f
+        self.spilled = True
+
+    def size(self):
+        with self._lock:
+            self._file.seek(0, 2)
+            return self._file.tell()
+
+    def read(self, offset, size):
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(size)
+
+    def readline(self, offset, size):
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.readline(size)
+
+    def write(self, offset, data, append=False):
+        """
+        Write C{data} at C{offset}, or at the end if C{append} is
+        true. Returns the offset just past the written data.
+        """
+        with self._lock:
+            if append:
+                self._file.seek(0, 2)
+            else:
+                self._file.seek(offset)
+            end = self._file.tell() + len(data)
+            if (not self.spilled
+                and end > self.threshold):
+                self._spill()
+                self._file.seek(end - len(data))
+            self._file.write(data)
+            return end
+
+    def truncate(self, size):
+        with self._lock:
+            self._file.seek(size)
+            self._file.truncate()
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def getvalue(self):
+        """
+        Return the contents, if they are still in memory.
+        """
+        assert not self.spilled
+        return self._file.getvalue()
+
+    def close(self):
+        """
+        Release the memory or the open file; the file at C{path},
+        if any, is left in place.
+        """
+        with self._lock:
+            self._file.close()
+
+class WorkFile(object):
+    """
+    A file object for one user of a C{WorkBuffer}.
+
+    Every user has its own position and C{mode}, with the usual
+    meanings, while the contents are shared. C{callback} is called
+    with the file when it is closed.
+    """
+
+    def __init__(self, buffer, mode, callback):
+        self.buffer = buffer
+        self.name = buffer.path
+        self.mode = mode
+        self.closed = False
+        self._callback = callback
+        self._readable = mode.startswith('r') or '+' in mode
+        self._writable = not mode.startswith('r') or '+' in mode
+        self._append = mode.startswith('a')
+        if mode.startswith('w'):
+            buffer.truncate(0)
+        self._pos = 0
+
+    def __repr__(self):
+        return '%s(buffer=%r, mode=%r)' % (
+            self.__class__.__name__,
+            self.buffer,
+            self.mode,
+            )
+
+    def _check(self, readable=False, writable=False):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        if ((readable and not self._readable)
+            or (writable and not self._writable)):
+            raise IOError(errno.EBADF, os.strerror(errno.EBADF))
+
+    def read(self, size=-1):
+        self._check(readable=True)
+        if size is None:
+            size = -1
+        data = self.buffer.read(self._pos, size)
+        self._pos += len(data)
+        return data
+
+    def readline(self, size=-1):
+        self._check(readable=True)
+        if size is None:
+            size = -1
+        data = self.buffer.readline(self._pos, size)
+        self._pos += len(data)
+        return data
+
+    def readlines(self):
+        return list(self)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def write(self, data):
+        self._check(writable=True)
+        self._pos = self.buffer.write(
+            offset=self._pos,
+            data=str(data),
+            append=self._append,
+            )
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def seek(self, offset, whence=0):
+        self._check()
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.buffer.size()
+        if offset < 0:
+            raise IOError(
+                errno.EINVAL,
+                os.strerror(errno.EINVAL),
+                )
+        self._pos = offset
+
+    def tell(self):
+        self._check()
+        return self._pos
+
+    def truncate(self, size=None):
+        self._check(writable=True)
+        if size is None:
+            size = self._pos
+        self.buffer.truncate(size)
+
+    def flush(self):
+        self._check()
+        self.buffer.flush()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._callback(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()